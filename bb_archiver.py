@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# bb_archiver.py
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+import zipfile
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+ARCHIVE_AFTER_SECONDS = 6 * 24 * 60 * 60  # completed files older than this are bundled
+ARCHIVE_INTERVAL = 60 * 60  # seconds between scheduled runs
+ARCHIVE_RETENTION_DAYS = 365  # bundles of older days are deleted
+ARCHIVE_MAX_BYTES = 20 * 1024 ** 3  # oldest bundles are deleted while all bundles together exceed this
+SKIP_EXTENSIONS = (".json",)  # request files stay where they are, as before
+STORED_EXTENSIONS = (".xlsx", ".zip", ".gz", ".zst")  # already compressed; deflating again only costs time
+BUNDLE_EXTENSION = ".zip"
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    registered_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pending_mtime ON pending (mtime);
+CREATE TABLE IF NOT EXISTS bundles (
+    name TEXT PRIMARY KEY,  -- <YYYY-MM-DD>.zip, by modification date of its files
+    day TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS archived (
+    id INTEGER PRIMARY KEY,
+    bundle TEXT NOT NULL REFERENCES bundles (name),
+    member TEXT NOT NULL,
+    source_path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    compressed_size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    archived_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS archived_bundle ON archived (bundle);
+CREATE INDEX IF NOT EXISTS archived_member ON archived (member);
+"""
+
+
+class Archiver:
+    """
+    Move old completed files into dated zip bundles, tracked in a SQLite index.
+
+    Files are registered as they are moved into place (register()), so a run only reads the
+    index for files older than archive_after_seconds instead of listing and stat'ing the
+    folder. Those are added to <archive_folder>/<YYYY-MM-DD>.zip, by modification date,
+    and removed. A bundle is never changed in place: it is rebuilt as a temporary copy that
+    replaces it once complete, so an interrupted run can't leave it unreadable. A file that
+    changed since it was registered is left where it is until it has been old enough again.
+    Bundles older than retention_days, then the oldest bundles while all of them
+    exceed max_bytes, are deleted. scan() registers anything that arrived while nothing was
+    registering, including loose files left in the archive folder by earlier versions.
+    """
+    def __init__(self, watch_folders: Iterable[str], archive_folder: str, db_path: str,
+                 archive_after_seconds: float = ARCHIVE_AFTER_SECONDS,
+                 retention_days: Optional[int] = ARCHIVE_RETENTION_DAYS,
+                 max_bytes: Optional[int] = ARCHIVE_MAX_BYTES,
+                 report: Callable[[str], None] = print):
+        self.watch_folders = list(watch_folders)
+        self.archive_folder = archive_folder
+        self.db_path = db_path
+        self.archive_after_seconds = archive_after_seconds
+        self.retention_days = retention_days
+        self.max_bytes = max_bytes
+        self.report = report
+        self._run_lock = threading.Lock()
+        os.makedirs(archive_folder, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(INDEX_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        """Connection committed and closed on exit; one per call so worker threads can register concurrently."""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def archivable(path: str) -> bool:
+        return not path.lower().endswith(SKIP_EXTENSIONS) and not path.lower().endswith(BUNDLE_EXTENSION)
+
+    def register(self, paths: Iterable[str]) -> int:
+        """Add files to the index of files waiting to be archived; returns how many were added."""
+        rows = []
+        now = time.time()
+        for path in paths:
+            if not path or not self.archivable(path):
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            rows.append((os.path.abspath(path), st.st_size, st.st_mtime, now))
+        if rows:
+            with self._connect() as conn:
+                conn.executemany(
+                    "INSERT INTO pending (path, size, mtime, registered_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime",
+                    rows)
+        return len(rows)
+
+    def scan(self) -> int:
+        """Register every archivable file in the watched folders and loose in the archive folder."""
+        paths = []
+        for folder in self.watch_folders + [self.archive_folder]:
+            try:
+                with os.scandir(folder) as entries:
+                    paths.extend(e.path for e in entries if e.is_file())
+            except FileNotFoundError:
+                continue
+        return self.register(paths)
+
+    def run_once(self, now: Optional[float] = None) -> Dict[str, int]:
+        """Bundle due files, then apply retention and the size quota. Returns counts of what was done."""
+        now = time.time() if now is None else now
+        with self._run_lock:
+            archived, bytes_in = self._bundle_due(now)
+            expired = self._expire(now)
+        return {"archived": archived, "bytes_in": bytes_in, "bundles_deleted": expired}
+
+    def _bundle_due(self, now: float):
+        with self._connect() as conn:
+            due = conn.execute("SELECT path, size, mtime FROM pending WHERE mtime <= ? ORDER BY mtime",
+                               (now - self.archive_after_seconds,)).fetchall()
+        by_day: Dict[str, List[Tuple[str, int, float]]] = {}
+        for path, size, mtime in due:
+            by_day.setdefault(datetime.fromtimestamp(mtime).strftime("%Y-%m-%d"), []).append((path, size, mtime))
+
+        archived = bytes_in = 0
+        for day, entries in by_day.items():
+            try:
+                count, size = self._add_to_bundle(day, entries)
+            except Exception as e:
+                self.report(f"Archiving into {day}{BUNDLE_EXTENSION} failed: {e}")
+                continue
+            archived += count
+            bytes_in += size
+        return archived, bytes_in
+
+    @staticmethod
+    def _unchanged(path: str, size: int, mtime: float) -> bool:
+        """Whether the file still has the size and mtime it was registered with."""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        return st.st_size == size and st.st_mtime == mtime
+
+    def _add_to_bundle(self, day: str, entries: List[Tuple[str, int, float]]):
+        bundle = day + BUNDLE_EXTENSION
+        bundle_path = os.path.join(self.archive_folder, bundle)
+        gone = [path for path, _, _ in entries if not os.path.exists(path)]  # removed by hand since they were registered
+        # Rewritten or replaced since registration: register the new version, archive it once it is due
+        changed = [path for path, size, mtime in entries if path not in gone and not self._unchanged(path, size, mtime)]
+        entries = [e for e in entries if e[0] not in gone and e[0] not in changed]
+        self._forget(gone)
+        self.register(changed)
+        if not entries:
+            return 0, 0
+
+        added = []
+        tmp_path = os.path.join(self.archive_folder, f"{day}.tmp{BUNDLE_EXTENSION}")  # never registered by scan()
+        try:
+            if os.path.exists(bundle_path):
+                shutil.copyfile(bundle_path, tmp_path)
+            elif os.path.exists(tmp_path):
+                os.remove(tmp_path)  # left over from an interrupted run
+            with zipfile.ZipFile(tmp_path, "a", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+                names = set(zf.namelist())
+                for path, size, mtime in entries:
+                    member = os.path.basename(path)
+                    if member in names:
+                        member = f"{uuid.uuid4().hex[:8]}_{member}"
+                    compress = zipfile.ZIP_STORED if path.lower().endswith(STORED_EXTENSIONS) else zipfile.ZIP_DEFLATED
+                    zf.write(path, member, compress_type=compress)
+                    names.add(member)
+                    info = zf.getinfo(member)
+                    added.append((path, member, info.file_size, info.compress_size, mtime, size))
+            os.replace(tmp_path, bundle_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        # Index first, delete second: a crash in between leaves a duplicate member, never a lost file
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT INTO bundles (name, day, bytes, updated_at) VALUES (?, ?, ?, ?) "
+                         "ON CONFLICT (name) DO UPDATE SET bytes = excluded.bytes, updated_at = excluded.updated_at",
+                         (bundle, day, os.path.getsize(bundle_path), now))
+            conn.executemany("INSERT INTO archived (bundle, member, source_path, size, compressed_size, mtime, archived_at) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             [(bundle, member, path, size, csize, mtime, now) for path, member, size, csize, mtime, _ in added])
+            conn.executemany("DELETE FROM pending WHERE path = ?", [(a[0],) for a in added])
+        for path, _, _, _, mtime, size in added:
+            # Rewritten while it was being zipped: the bundle has the old version, keep the new one
+            if self._unchanged(path, size, mtime):
+                os.remove(path)
+            else:
+                self.register([path])
+        return len(added), sum(a[2] for a in added)
+
+    def _forget(self, paths: List[str]):
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM pending WHERE path = ?", [(p,) for p in paths])
+
+    def _expire(self, now: float) -> int:
+        with self._connect() as conn:
+            bundles = conn.execute("SELECT name, day, bytes FROM bundles ORDER BY day, name").fetchall()
+        doomed = []
+        if self.retention_days is not None:
+            cutoff = (date.fromtimestamp(now) - timedelta(days=self.retention_days)).isoformat()
+            doomed = [b for b in bundles if b[1] < cutoff]
+        kept = [b for b in bundles if b not in doomed]
+        if self.max_bytes is not None:
+            total = sum(b[2] for b in kept)
+            while kept and total > self.max_bytes:
+                oldest = kept.pop(0)
+                doomed.append(oldest)
+                total -= oldest[2]
+
+        for name, day, size in doomed:
+            try:
+                os.remove(os.path.join(self.archive_folder, name))
+            except FileNotFoundError:
+                pass
+            with self._connect() as conn:
+                conn.execute("DELETE FROM archived WHERE bundle = ?", (name,))
+                conn.execute("DELETE FROM bundles WHERE name = ?", (name,))
+            self.report(f"Deleted archive bundle {name} ({size} bytes)")
+        return len(doomed)
+
+    def find(self, name: str) -> List[Dict]:
+        """Where a file name was archived: bundle, member and metadata, newest first."""
+        # Members renamed to avoid a clash in their bundle carry an 8-character prefix
+        escaped = name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute("SELECT * FROM archived WHERE member = ? OR member LIKE ? ESCAPE '\\' "
+                                "ORDER BY archived_at DESC", (name, "_" * 8 + "\\_" + escaped)).fetchall()
+        return [dict(r) for r in rows]
+
+    def bundles(self) -> List[Dict]:
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute("SELECT b.*, COUNT(a.id) AS files FROM bundles b LEFT JOIN archived a ON a.bundle = b.name "
+                                "GROUP BY b.name ORDER BY b.day").fetchall()
+        return [dict(r) for r in rows]
+
+    def start(self, interval: float = ARCHIVE_INTERVAL) -> threading.Thread:
+        """Run now and then every interval seconds from a daemon thread."""
+        def run():
+            while True:
+                try:
+                    result = self.run_once()
+                    if result["archived"]:
+                        self.report(f"Archived {result['archived']} file(s), {result['bytes_in']} bytes, into bundles")
+                except Exception as e:
+                    # The next run retries whatever is still pending
+                    self.report(f"Archive run failed: {e}")
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, name="archiver", daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Bundle old completed query files and look up what was archived")
+    parser.add_argument("db", help="Index file, e.g. archive_index.sqlite")
+    parser.add_argument("archive_folder", help="Folder the dated bundles are written to")
+    parser.add_argument("--watch", nargs="*", default=[], help="Folders whose files are archived (for --run)")
+    parser.add_argument("--run", action="store_true", help="Register the folders' files and run the archiver once")
+    parser.add_argument("--find", metavar="NAME", help="Print the bundle(s) a file was archived into")
+    args = parser.parse_args()
+
+    archiver = Archiver(args.watch, args.archive_folder, args.db)
+    if args.run:
+        print(f"Registered {archiver.scan()} file(s)")
+        print(archiver.run_once())
+    if args.find:
+        for entry in archiver.find(args.find):
+            print(f"{entry['bundle']}: {entry['member']} ({entry['size']} bytes, "
+                  f"archived {datetime.fromtimestamp(entry['archived_at']):%Y-%m-%d %H:%M})")
+    for bundle in archiver.bundles():
+        print(f"{bundle['name']}: {bundle['files']} file(s), {bundle['bytes']:,} bytes")
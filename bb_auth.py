@@ -8,9 +8,17 @@ import webbrowser
 import http.server
 import socketserver
 import json
+import time
+import random
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse, parse_qs
 from typing import Dict, Any, Optional
 
+from bb_metrics import API_REQUEST_METRIC, endpoint_label, timed
+
 #  keyring_cli
 SERVICE_NAME = "GlobalSecrets"
 
@@ -22,6 +30,28 @@ REDIRECT_URI = secure_keyring.get_password("other.redirect_url") or "http://loca
 # OAuth
 AUTH_URL = "https://app.blackbaud.com/oauth/authorize"
 TOKEN_URL = "https://oauth2.sky.blackbaud.com/token"
+API_BASE_URL = "https://api.sky.blackbaud.com"
+
+# Connection pooling for the long-lived per-subscription-key sessions
+SESSION_POOL_CONNECTIONS = 4  # distinct hosts kept in the pool
+SESSION_POOL_MAXSIZE = 20  # open connections per host, enough for every worker and the poller
+
+# Refresh this long before the access token's expires_in runs out
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+# A failed background refresh is retried after this many seconds, doubling up to the max
+TOKEN_REFRESH_RETRY_SECONDS = 30
+TOKEN_REFRESH_RETRY_MAX_SECONDS = 600
+
+# SKY API subscription limits (standard tier) used by the request governor
+RATE_LIMIT_PER_SECOND = 10
+RATE_LIMIT_BURST = 10
+DAILY_CALL_QUOTA = 25000
+
+# Retries for rate limiting (429, any method) and transient server errors (5xx, GET only)
+MAX_REQUEST_RETRIES = 5
+RETRY_BACKOFF_BASE = 1  # seconds
+RETRY_BACKOFF_MAX = 60  # seconds
+TRANSIENT_STATUS_CODES = (500, 502, 503, 504)
 
 class RequestFailedException(Exception):
     """
@@ -34,33 +64,159 @@ class RequestFailedException(Exception):
         message = f"Request failed with status {status_code}. Response: {error_text}"
         super().__init__(message)
 
-class ResponseStatusCodes(Exception):
-    def __init__(self, status_code: int, message: str, retry_after: Optional[int] = None):
-        self.status_code = status_code
+class ResponseStatusCodes(RequestFailedException):
+    """
+    Rate limiting (429) or a transient server error that was still returned after all retries.
+    retry_after holds the API's Retry-After in seconds, if it sent one.
+    """
+    def __init__(self, status_code: int, message: str, retry_after: Optional[float] = None,
+                 error_json: Optional[dict] = None):
         self.message = message
         self.retry_after = retry_after
-        super().__init__(f"Error {status_code}: {message}")
+        super().__init__(status_code=status_code, error_text=message, error_json=error_json)
 
-class ResponseStatusCodes(Exception):
-    def __init__(self, status_code: int, message: str, retry_after: Optional[int] = None):
-        self.status_code = status_code
-        self.message = message
-        self.retry_after = retry_after
-        super().__init__(f"Error {status_code}: {message}")
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After as seconds; the header may be a number of seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def should_retry(method: str, status_code: int) -> bool:
+    """429 was rejected before doing any work so it is always safe to resend; 5xx only for GET."""
+    return status_code == 429 or (method.upper() == "GET" and status_code in TRANSIENT_STATUS_CODES)
+
+def backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff for the given retry attempt (0-based)."""
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * (2 ** attempt)))
+
+class RateLimitGovernor:
+    """
+    Token bucket shared by every request made through one BlackbaudAuth.
+
+    reserve() takes a token and returns how long the caller must wait before sending, so
+    concurrent workers together stay under RATE_LIMIT_PER_SECOND. A 429's Retry-After
+    pauses the whole bucket. Calls are also counted against DAILY_CALL_QUOTA over a
+    rolling 24 hour window so callers can check budget() before starting big batches.
+    """
+    def __init__(self, rate: float = RATE_LIMIT_PER_SECOND, burst: float = RATE_LIMIT_BURST,
+                 daily_quota: Optional[int] = DAILY_CALL_QUOTA):
+        self.rate = rate
+        self.burst = burst
+        self.daily_quota = daily_quota
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._window_start = time.time()
+        self._window_calls = 0
+        self._throttled = 0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        """Take a token; return the seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = max(0.0, self._paused_until - now)
+            if self._tokens < 0:
+                wait = max(wait, -self._tokens / self.rate)
+
+            if time.time() - self._window_start >= 86400:
+                self._window_start = time.time()
+                self._window_calls = 0
+            self._window_calls += 1
+            return wait
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Hold every caller for seconds (after a 429) and drop any saved-up burst."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens = min(self._tokens, 0.0)
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._throttled += 1
+
+    def budget(self) -> Dict[str, Any]:
+        """Current state of the bucket and the daily quota."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                "tokens_available": max(0.0, self._tokens),
+                "rate_per_second": self.rate,
+                "paused_for_seconds": max(0.0, self._paused_until - now),
+                "daily_quota": self.daily_quota,
+                "daily_calls": self._window_calls,
+                "daily_remaining": None if self.daily_quota is None else max(0, self.daily_quota - self._window_calls),
+                "throttled_responses": self._throttled,
+            }
 
 class BlackbaudAuth:
     def __init__(self):
         """Initialize BlackbaudAuth using keyring for secrets."""
-        self.access_token = secure_keyring.get_password("tokens.access_token")
-        self.refresh_token = secure_keyring.get_password("tokens.refresh_token")
+        self._sessions: Dict[str, requests.Session] = {}  # one per subscription key
+        self._secrets: Dict[str, Optional[str]] = {}  # keyring values, read once
+        self._session_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()  # single-flight: one refresh at a time, others reuse its result
+        self._refresh_timer: Optional[threading.Timer] = None
+        self._refresh_failures = 0  # consecutive failed non-interactive refreshes
+        self._refresh_retry_at = 0.0  # until then, only the scheduled retry tries a non-interactive refresh
+        self._reauthenticated_for: Optional[str] = None  # refresh token the browser login was last opened for
+        self.token_expires_at: Optional[float] = None  # unknown until the first exchange/refresh
+        self.governor = RateLimitGovernor()
 
         if not CLIENT_ID or not CLIENT_SECRET:
             raise ValueError("CLIENT_ID or CLIENT_SECRET not found in keyring. Run `python keyring_cli.py store --key sky_app_information.app_id --value YOUR_CLIENT_ID`")
 
+        self._load_tokens()
+
         # If no refresh token, prompt user to authenticate
         if not self.refresh_token:
             print("No refresh token found. Redirecting to login...")
             self.authenticate_user()
+            self._load_tokens()
+
+    def _load_tokens(self):
+        """Read the stored tokens and expiry, which the login callback also writes, and arm the background refresh."""
+        self.access_token = secure_keyring.get_password("tokens.access_token")
+        self.refresh_token = secure_keyring.get_password("tokens.refresh_token")
+        self.token_expires_at = None
+        if self.refresh_token:
+            # The expiry is stored with the tokens so the background refresh is armed after a restart.
+            # Tokens stored without one (by an older version) are refreshed right away in the background.
+            try:
+                self.token_expires_at = float(secure_keyring.get_password("tokens.expires_at"))
+            except (TypeError, ValueError):
+                self.token_expires_at = time.time()
+        self._update_session_tokens()
+        self._schedule_refresh()
+
+    def close(self):
+        """Stop the background refresh and close the pooled sessions."""
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+            self._refresh_timer = None
+        with self._session_lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
 
     def authenticate_user(self):
         """Perform OAuth authentication by opening the browser for login."""
@@ -86,75 +242,198 @@ class BlackbaudAuth:
         token_data = response.json()
 
         # Store tokens securely in keyring
+        self._store_tokens(token_data)
+
+        print("Authentication successful! Tokens stored securely in keyring.")
+
+    def _store_tokens(self, token_data: Dict[str, Any]):
+        """Save a token response to keyring and memory, and schedule the next background refresh."""
         secure_keyring.set_password("tokens.access_token", token_data["access_token"], "OAuth access token")
         secure_keyring.set_password("tokens.refresh_token", token_data["refresh_token"], "OAuth refresh token")
 
         self.access_token = token_data["access_token"]
         self.refresh_token = token_data["refresh_token"]
+        self._update_session_tokens()
 
-        print("Authentication successful! Tokens stored securely in keyring.")
+        expires_in = token_data.get("expires_in")
+        self.token_expires_at = time.time() + float(expires_in) if expires_in else None
+        secure_keyring.set_password("tokens.expires_at", "" if self.token_expires_at is None else str(self.token_expires_at),
+                                    "OAuth access token expiry (Unix time)")
+        self._schedule_refresh()
 
-    def refresh_access_token(self) -> bool:
-        """Refresh the access token using the refresh token stored in keyring."""
-        if not self.refresh_token:
-            print("No refresh token found. Please re-authenticate.")
-            self.authenticate_user()
-            return False
+    def _schedule_refresh(self, delay: Optional[float] = None):
+        """
+        Arm the background refresh TOKEN_REFRESH_MARGIN_SECONDS before token_expires_at, or
+        after delay seconds, replacing any earlier one.
+        """
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+            self._refresh_timer = None
+        if delay is None:
+            if self.token_expires_at is None:
+                return
+            delay = max(0.0, self.token_expires_at - time.time() - TOKEN_REFRESH_MARGIN_SECONDS)
+        self._refresh_timer = threading.Timer(delay, self._background_refresh, args=(self.access_token,))
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
 
-        payload = {
-            "grant_type": "refresh_token",
-            "refresh_token": self.refresh_token,
-            "client_id": CLIENT_ID,
-            "client_secret": CLIENT_SECRET
-        }
+    def token_expiring(self) -> bool:
+        """True when the access token's known expiry is within TOKEN_REFRESH_MARGIN_SECONDS."""
+        return self.token_expires_at is not None and \
+            time.time() >= self.token_expires_at - TOKEN_REFRESH_MARGIN_SECONDS
 
-        try:
-            response = requests.post(TOKEN_URL, data=payload)
-            response.raise_for_status()
-            token_data = response.json()
-
-            #  Update stored tokens
-            secure_keyring.set_password("tokens.access_token", token_data["access_token"], "OAuth access token")
-            secure_keyring.set_password("tokens.refresh_token", token_data["refresh_token"], "OAuth refresh token")
-
-            self.access_token = token_data["access_token"]
-            self.refresh_token = token_data["refresh_token"]
-            return True
-        except requests.exceptions.RequestException as e:
-            print(f"Error refreshing token: {str(e)}. Please re-authenticate.")
-            self.authenticate_user()
+    def refresh_access_token(self, stale_token: Optional[str] = None, interactive: bool = True) -> bool:
+        """
+        Refresh the access token using the refresh token stored in keyring.
+
+        Only one refresh runs at a time. Pass the token a request was sent with as stale_token:
+        if another caller has already replaced it by the time the lock is free, that result is
+        reused instead of refreshing again.
+
+        With interactive=False (the background refresh and get_session) a failure re-arms the
+        background refresh with backoff, and other non-interactive callers leave the retry to
+        it. With interactive=True (a request got 401) a failure opens the browser login, once
+        per refresh token: callers waiting on the lock pick up the tokens it stored.
+        """
+        with self._refresh_lock:
+            if stale_token is not None and self.access_token and self.access_token != stale_token:
+                return True
+            if not interactive and time.time() < self._refresh_retry_at:
+                return False
+            return self._refresh_locked(interactive)
+
+    def _background_refresh(self, stale_token: Optional[str]):
+        """Timer target: refresh even while a retry is pending, since this is that retry."""
+        with self._refresh_lock:
+            if self.access_token and self.access_token != stale_token:
+                return
+            self._refresh_locked(interactive=False)
+
+    def _refresh_locked(self, interactive: bool) -> bool:
+        """The body of refresh_access_token; the caller holds _refresh_lock."""
+        if self.refresh_token:
+            payload = {
+                "grant_type": "refresh_token",
+                "refresh_token": self.refresh_token,
+                "client_id": CLIENT_ID,
+                "client_secret": CLIENT_SECRET
+            }
+            try:
+                response = requests.post(TOKEN_URL, data=payload)
+                response.raise_for_status()
+                token_data = response.json()
+
+                #  Update stored tokens
+                self._store_tokens(token_data)
+                self._refresh_failures = 0
+                self._refresh_retry_at = 0.0
+                return True
+            except requests.exceptions.RequestException as e:
+                error = f"Error refreshing token: {str(e)}"
+        else:
+            error = "No refresh token found"
+
+        if not interactive:
+            retry_in = min(TOKEN_REFRESH_RETRY_MAX_SECONDS, TOKEN_REFRESH_RETRY_SECONDS * 2 ** self._refresh_failures)
+            self._refresh_failures += 1
+            self._refresh_retry_at = time.time() + retry_in
+            self._schedule_refresh(retry_in)
+            print(f"Background token refresh failed: {error}. Retrying in {retry_in:.0f} seconds.")
             return False
 
-    def get_session(self, use_payment_key=False) -> requests.Session:
-        """Get a configured requests session with appropriate headers. If use_payment_key is True, use the payment subscription key."""
-        if not self.access_token:
-            self.refresh_access_token()  # Ensure valid token
+        if self._reauthenticated_for == self.refresh_token:
+            print(f"{error}. Re-authentication was already attempted; log in again and restart.")
+            return False
+        self._reauthenticated_for = self.refresh_token
+        print(f"{error}. Please re-authenticate.")
+        previous_token = self.access_token
+        self.authenticate_user()
+        self._load_tokens()
+        return bool(self.access_token) and self.access_token != previous_token
+
+    def get_secret(self, key: str) -> Optional[str]:
+        """Read a keyring value, caching it so the audited lookup only happens once per key."""
+        if key not in self._secrets:
+            self._secrets[key] = secure_keyring.get_password(key)
+        return self._secrets[key]
 
-        session = requests.Session()
+    def get_subscription_key(self, use_payment_key=False) -> Optional[str]:
+        """Return the API subscription key, or the payment key (falling back to the API key) if use_payment_key is True."""
         if use_payment_key:
-            sub_key = secure_keyring.get_password("other.payment_subscription_key")
-            if not sub_key:
-                sub_key = secure_keyring.get_password("other.api_subscription_key")
-        else:
-            sub_key = secure_keyring.get_password("other.api_subscription_key")
-        session.headers = {
-            'Bb-Api-Subscription-Key': sub_key,
-            'Authorization': f"Bearer {self.access_token}"
-        }
+            sub_key = self.get_secret("other.payment_subscription_key")
+            if sub_key:
+                return sub_key
+        return self.get_secret("other.api_subscription_key")
+
+    def _update_session_tokens(self):
+        """Point every open session at the current access token."""
+        with self._session_lock:
+            for session in self._sessions.values():
+                session.headers['Authorization'] = f"Bearer {self.access_token}"
+
+    def get_session(self, use_payment_key=False) -> requests.Session:
+        """Get the long-lived session for the API (or payment) subscription key. Connections are reused across calls."""
+        if not self.access_token or self.token_expiring():
+            # Never opens the browser: a token that really has expired is caught by the 401 path
+            self.refresh_access_token(stale_token=self.access_token, interactive=False)
+
+        sub_key = self.get_subscription_key(use_payment_key)
+        with self._session_lock:
+            session = self._sessions.get(sub_key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=SESSION_POOL_CONNECTIONS, pool_maxsize=SESSION_POOL_MAXSIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update({
+                    'Bb-Api-Subscription-Key': sub_key,
+                    'Authorization': f"Bearer {self.access_token}"
+                })
+                self._sessions[sub_key] = session
         return session
 
+    def rate_limit_budget(self) -> Dict[str, Any]:
+        """Remaining request budget as tracked by the governor."""
+        return self.governor.budget()
+
+    def _send(self, session: requests.Session, method: str, url: str,
+              params: Optional[Dict], data: Optional[Dict]) -> requests.Response:
+        """Send through the rate limit governor, retrying 429 (honoring Retry-After) and transient 5xx."""
+        attempt = 0
+        while True:
+            self.governor.acquire()
+            response = session.request(method, url, params=params, json=data)
+            if not should_retry(method, response.status_code) or attempt >= MAX_REQUEST_RETRIES:
+                return response
+
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            delay = retry_after if retry_after is not None else backoff_delay(attempt)
+            if response.status_code == 429:
+                self.governor.pause(delay)  # acquire() waits it out, for every worker
+            else:
+                time.sleep(delay)
+            attempt += 1
+
     def make_request(self, method: str, endpoint: str,
                      params: Optional[Dict] = None,
                      data: Optional[Dict] = None) -> Dict[str, Any]:
         """
         Make an authenticated request. If a 401 with invalid subscription key is returned, retry with payment key.
         If both fail, print the error JSON as specified and return None.
+        429s and transient 5xx responses are retried with backoff; one that persists raises ResponseStatusCodes.
+        The call's latency, retries included, is recorded in bb_metrics under API_REQUEST_METRIC.
         """
-        url = f"https://api.sky.blackbaud.com{endpoint}"
+        with timed(API_REQUEST_METRIC, method=method, endpoint=endpoint_label(endpoint)):
+            return self._make_request(method, endpoint, params, data)
+
+    def _make_request(self, method: str, endpoint: str,
+                      params: Optional[Dict], data: Optional[Dict]) -> Dict[str, Any]:
+        url = f"{API_BASE_URL}{endpoint}"
         # First try with default key
         session = self.get_session(use_payment_key=False)
+        sent_token = self.access_token
         try:
-            response = session.request(method, url, params=params, json=data)
+            response = self._send(session, method, url, params, data)
             if response.status_code == 401:
                 try:
                     error_json = response.json()
@@ -166,7 +445,7 @@ class BlackbaudAuth:
                 if error_json and "invalid subscription key" in error_json.get("message", "").lower():
                     # Try with payment key
                     session = self.get_session(use_payment_key=True)
-                    response = session.request(method, url, params=params, json=data)
+                    response = self._send(session, method, url, params, data)
                     if response.status_code == 401:
                         try:
                             error_json = response.json()
@@ -187,9 +466,9 @@ class BlackbaudAuth:
                 else:
                     # Not a subscription key error, try refresh
                     print("Unauthorized (401). Attempting to refresh token...")
-                    if self.refresh_access_token():
+                    if self.refresh_access_token(stale_token=sent_token):
                         session = self.get_session(use_payment_key=False)
-                        response = session.request(method, url, params=params, json=data)
+                        response = self._send(session, method, url, params, data)
                     else:
                         raise RequestFailedException(
                             status_code=401,
@@ -204,6 +483,13 @@ class BlackbaudAuth:
                 except Exception:
                     error_json = None
                     error_text = response.text.strip()
+                if should_retry(method, status_code):
+                    raise ResponseStatusCodes(
+                        status_code=status_code,
+                        message=error_text,
+                        retry_after=parse_retry_after(response.headers.get("Retry-After")),
+                        error_json=error_json
+                    )
                 raise RequestFailedException(
                     status_code=status_code,
                     error_text=error_text,
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# bb_auth_async.py
+import asyncio
+import functools
+import json
+from typing import Dict, Any, Optional, Tuple
+
+import aiohttp
+
+import bb_auth
+from bb_auth import (BlackbaudAuth, RequestFailedException, ResponseStatusCodes, MAX_REQUEST_RETRIES,
+                     backoff_delay, parse_retry_after, should_retry)
+from bb_metrics import API_REQUEST_METRIC, endpoint_label, timed
+
+MAX_CONNECTIONS = 20  # pooled keep-alive connections to the SKY API
+KEEPALIVE_SECONDS = 60
+REQUEST_TIMEOUT_SECONDS = 300
+
+
+def _error_details(body: bytes) -> Tuple[Optional[dict], str]:
+    """Return (error_json, error_text) for a response body, the same way make_request reports errors."""
+    try:
+        error_json = json.loads(body)
+        return error_json, json.dumps(error_json, indent=2)
+    except Exception:
+        return None, body.decode("utf-8", errors="replace").strip()
+
+
+def _is_invalid_subscription_key(error_json: Optional[dict]) -> bool:
+    return bool(error_json) and isinstance(error_json, dict) and \
+        "invalid subscription key" in error_json.get("message", "").lower()
+
+
+class AsyncBlackbaudAuth(BlackbaudAuth):
+    """
+    asyncio counterpart of BlackbaudAuth.
+
+    make_request is a coroutine and every call goes through one aiohttp session, so
+    connections to the SKY API stay open and are reused instead of paying a new TCP+TLS
+    handshake per request. Token storage, OAuth login and refresh are inherited from
+    BlackbaudAuth; the 401 -> payment key -> token refresh fallback is the same.
+
+        async with AsyncBlackbaudAuth() as auth:
+            results = await asyncio.gather(*(auth.make_request("GET", e) for e in endpoints))
+
+    bb_query_ftp, the job poller and the structure crawler don't use this client; they run
+    concurrently on threads over BlackbaudAuth's pooled sessions. This is for callers
+    that already have an event loop.
+    """
+    def __init__(self, max_connections: int = MAX_CONNECTIONS):
+        super().__init__()
+        self.max_connections = max_connections
+        self._client: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        """Close the pooled HTTP client and stop the background token refresh."""
+        if self._client is not None and not self._client.closed:
+            await self._client.close()
+        self._client = None
+        super().close()
+
+    def get_client(self) -> aiohttp.ClientSession:
+        """Return the shared aiohttp session, creating it on first use inside the running loop."""
+        if self._client is None or self._client.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=KEEPALIVE_SECONDS)
+            self._client = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS)
+            )
+        return self._client
+
+    def get_headers(self, use_payment_key=False) -> Dict[str, str]:
+        """Request headers for the current token."""
+        return {
+            'Bb-Api-Subscription-Key': self.get_subscription_key(use_payment_key),
+            'Authorization': f"Bearer {self.access_token}"
+        }
+
+    async def refresh_access_token_async(self, stale_token: Optional[str] = None, interactive: bool = True) -> bool:
+        """Run the (blocking, single-flight) token refresh in the default executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.refresh_access_token, stale_token=stale_token,
+                                                                  interactive=interactive))
+
+    async def _send(self, method: str, url: str, params: Optional[Dict], data: Optional[Dict],
+                    use_payment_key=False) -> Tuple[int, bytes, Optional[float]]:
+        """Send through the shared rate limit governor, retrying 429 (honoring Retry-After) and transient 5xx."""
+        attempt = 0
+        while True:
+            wait = self.governor.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            async with self.get_client().request(method, url, params=params, json=data,
+                                                 headers=self.get_headers(use_payment_key)) as response:
+                status, body = response.status, await response.read()
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if not should_retry(method, status) or attempt >= MAX_REQUEST_RETRIES:
+                return status, body, retry_after
+
+            delay = retry_after if retry_after is not None else backoff_delay(attempt)
+            if status == 429:
+                self.governor.pause(delay)
+            else:
+                await asyncio.sleep(delay)
+            attempt += 1
+
+    async def make_request(self, method: str, endpoint: str,
+                           params: Optional[Dict] = None,
+                           data: Optional[Dict] = None) -> Dict[str, Any]:
+        """
+        Make an authenticated request. If a 401 with invalid subscription key is returned, retry with payment key.
+        If both fail, print the error JSON as specified and return None.
+        The call's latency is recorded in bb_metrics like BlackbaudAuth.make_request.
+        """
+        with timed(API_REQUEST_METRIC, method=method, endpoint=endpoint_label(endpoint)):
+            return await self._make_request(method, endpoint, params, data)
+
+    async def _make_request(self, method: str, endpoint: str,
+                            params: Optional[Dict], data: Optional[Dict]) -> Dict[str, Any]:
+        url = f"{bb_auth.API_BASE_URL}{endpoint}"
+        if not self.access_token or self.token_expiring():
+            # Never opens the browser: a token that really has expired is caught by the 401 path
+            await self.refresh_access_token_async(stale_token=self.access_token, interactive=False)
+
+        sent_token = self.access_token
+        try:
+            status, body, retry_after = await self._send(method, url, params, data)
+            if status == 401:
+                error_json, error_text = _error_details(body)
+                if _is_invalid_subscription_key(error_json):
+                    # Try with payment key
+                    status, body, retry_after = await self._send(method, url, params, data, use_payment_key=True)
+                    if status == 401:
+                        error_json, error_text = _error_details(body)
+                        if _is_invalid_subscription_key(error_json):
+                            print(error_text)
+                            return None
+                        raise RequestFailedException(
+                            status_code=401,
+                            error_text=error_text,
+                            error_json=error_json
+                        )
+                else:
+                    # Not a subscription key error, try refresh
+                    print("Unauthorized (401). Attempting to refresh token...")
+                    if await self.refresh_access_token_async(stale_token=sent_token):
+                        status, body, retry_after = await self._send(method, url, params, data)
+                    else:
+                        raise RequestFailedException(
+                            status_code=401,
+                            error_text="Re-authentication required; 401 Unauthorized",
+                        )
+            if not 200 <= status < 400:
+                error_json, error_text = _error_details(body)
+                if should_retry(method, status):
+                    raise ResponseStatusCodes(
+                        status_code=status,
+                        message=error_text,
+                        retry_after=retry_after,
+                        error_json=error_json
+                    )
+                raise RequestFailedException(
+                    status_code=status,
+                    error_text=error_text,
+                    error_json=error_json
+                )
+            return json.loads(body)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+            raise RequestFailedException(
+                status_code=-1,
+                error_text=f"Request Exception occurred: {err}"
+            )
@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 # bb_build_query_structure.py
 
+import hashlib
 import json
 import os
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 import re
 from bb_auth import BlackbaudAuth
@@ -14,6 +18,14 @@ NODES_FIELDS_ENDPOINT = "/query/querytypes/{query_type_id}/nodes/{node_id}/avail
 
 OUTPUT_FILE = "bb_query_structure.json"
 LOG_FILE = "bb_query_log.txt"
+CHECKPOINT_FILE = "bb_query_structure.checkpoint.jsonl"
+REFRESH_CHECKPOINT_FILE = "bb_query_structure.refresh.jsonl"
+DIFF_REPORT_FILE = "bb_query_structure_diff_{timestamp}.json"
+
+MAX_CRAWL_WORKERS = 8  # concurrent node fetches; BlackbaudAuth's rate limit governor still applies
+MAX_NODE_DEPTH = 10  # top-level nodes are depth 1; nodes deeper than this are listed but not fetched
+
+_log_lock = threading.Lock()
 
 def load_existing_data():
     """Load existing query structure to avoid redundant API calls."""
@@ -27,15 +39,19 @@ def load_existing_data():
 
 def save_data(data):
     """Save the query structure to a file."""
-    with open(OUTPUT_FILE, "w") as file:
+    tmp_file = OUTPUT_FILE + ".tmp"
+    with open(tmp_file, "w") as file:
         json.dump(data, file, indent=4)
+    os.replace(tmp_file, OUTPUT_FILE)
 
 def log_response(endpoint, response):
     """Logs API responses to a file."""
-    with open(LOG_FILE, "a") as log:
-        log.write(f"\n[{datetime.utcnow().isoformat()}] Endpoint: {endpoint}\n")
-        log.write(json.dumps(response, indent=4))
-        log.write("\n" + "=" * 80 + "\n")
+    entry = (f"\n[{datetime.utcnow().isoformat()}] Endpoint: {endpoint}\n"
+             + json.dumps(response, indent=4)
+             + "\n" + "=" * 80 + "\n")
+    with _log_lock:
+        with open(LOG_FILE, "a") as log:
+            log.write(entry)
 
 def get_query_type_ids():
     """Extract query_type_ids from the log file."""
@@ -78,8 +94,246 @@ def get_fields_for_node(auth, query_type_id, node_id):
     
     return [], []
 
-def build_query_structure():
-    """Retrieve all fields and nodes for each query_type_id and store them in a structured format."""
+def format_fields(fields):
+    """Keep the parts of an availablefields field entry that the structure file stores."""
+    return [{
+        "id": f["id"],
+        "name": f["available_field_name"],
+        "selected_name": f.get("selected_field_name", ""),
+        "value_type": f["value_type"],
+        "allowed_filter_operators": f.get("allowed_filter_operators", [])
+    } for f in fields]
+
+def format_nodes(nodes):
+    return [{
+        "id": n["id"],
+        "name": n["name"]
+    } for n in nodes]
+
+def content_hash(fields, child_nodes):
+    """Hash of a node's fields and child node list; --refresh compares it to spot changed nodes."""
+    payload = json.dumps({"fields": fields, "child_nodes": child_nodes}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class CrawlCheckpoint:
+    """
+    Append-only JSON Lines record of every node fetched so far, so an interrupted crawl
+    resumes at the node it stopped on instead of starting the query type over.
+
+    Each line is {"query_type_id", "node_id", "name", "fields", "child_nodes"}; node_id is
+    None for the query type's own field list, whose child_nodes are its top-level nodes.
+    """
+    def __init__(self, path=CHECKPOINT_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self.records = {}
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # last line cut short by a crash
+                self.records[(record["query_type_id"], record["node_id"])] = record
+
+    def get(self, qt_id, node_id=None):
+        return self.records.get((qt_id, node_id))
+
+    def add(self, record):
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            with open(self.path, "a") as file:
+                file.write(line)
+                file.flush()
+            self.records[(record["query_type_id"], record["node_id"])] = record
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def fetch_node(auth, checkpoint, qt_id, node_id=None, name=None):
+    """
+    Fetch a query type's own fields (node_id None) or one node's fields and child nodes,
+    recording the result in the checkpoint. Already checkpointed nodes aren't fetched again.
+    """
+    record = checkpoint.get(qt_id, node_id)
+    if record is not None:
+        return record
+
+    if node_id is None:
+        child_nodes, fields = get_available_fields(auth, qt_id)
+    else:
+        child_nodes, fields = get_fields_for_node(auth, qt_id, node_id)
+        with _log_lock:
+            print(f"  Processed Node: {name} (ID: {node_id}) of Query Type ID {qt_id}")
+
+    record = {
+        "query_type_id": qt_id,
+        "node_id": node_id,
+        "name": name,
+        "fields": format_fields(fields),
+        "child_nodes": format_nodes(child_nodes)
+    }
+    record["content_hash"] = content_hash(record["fields"], record["child_nodes"])
+    checkpoint.add(record)
+    return record
+
+def crawl_query_types(auth, query_type_ids, checkpoint, max_workers=MAX_CRAWL_WORKERS,
+                      max_depth=MAX_NODE_DEPTH):
+    """
+    Fetch the fields of every query type and of every node below it, down to max_depth,
+    max_workers at a time. A node's children are queued as soon as its own fetch returns.
+
+    Each (query_type_id, node_id) is fetched once however many parents list it, so shared
+    subtrees cost one call and a child that points back at an ancestor ends the descent.
+    A node is expanded at the shallowest depth it is reached at, whatever order fetches
+    finish in. Returns the (query_type_id, node_id) pairs that failed.
+    """
+    failed = []
+    depths = {}  # (query_type_id, node_id) -> shallowest depth reached
+    pending = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="structure_crawl") as executor:
+        def expand(qt_id, record, node_depth):
+            if node_depth >= max_depth:
+                return
+            for child in record["child_nodes"]:
+                visit(qt_id, str(child["id"]), child["name"], node_depth + 1)
+
+        def visit(qt_id, node_id, name, node_depth):
+            key = (qt_id, node_id)
+            known = depths.get(key)
+            if known is not None and known <= node_depth:
+                return
+            depths[key] = node_depth
+            if known is None:
+                pending[executor.submit(fetch_node, auth, checkpoint, qt_id, node_id, name)] = key
+                return
+            # Reached closer to the root than before: children cut off by max_depth may now fit
+            record = checkpoint.get(qt_id, node_id)
+            if record is not None:
+                expand(qt_id, record, node_depth)
+
+        for qt_id, qt_name in query_type_ids.items():
+            print(f"Processing Query Type: {qt_name} (ID: {qt_id})...")
+            visit(qt_id, None, None, 0)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                qt_id, node_id = key = pending.pop(future)
+                try:
+                    record = future.result()
+                except Exception as e:
+                    print(f"  Failed Query Type ID {qt_id} node {node_id}: {e}")
+                    failed.append(key)
+                    continue
+                expand(qt_id, record, depths[key])
+    return failed
+
+def assemble_query_type(checkpoint, qt_id, qt_name, max_depth=MAX_NODE_DEPTH):
+    """
+    Build a query type's structure entry from its checkpointed records. Every node in the
+    tree goes into the one flat "nodes" dict, in breadth-first order.
+    """
+    root = checkpoint.get(qt_id)
+    entry = {
+        "name": qt_name,
+        "nodes": {},
+        "fields": root["fields"],
+        "content_hash": content_hash(root["fields"], root["child_nodes"])
+    }
+    queue = deque((node, 1) for node in root["child_nodes"])
+    while queue:
+        node, node_depth = queue.popleft()
+        node_id = str(node["id"])
+        if node_id in entry["nodes"]:
+            continue
+        record = checkpoint.get(qt_id, node_id)
+        entry["nodes"][node_id] = {
+            "name": node["name"],
+            "fields": record["fields"],
+            "child_nodes": record["child_nodes"],
+            "content_hash": content_hash(record["fields"], record["child_nodes"])
+        }
+        if node_depth < max_depth:
+            queue.extend((child, node_depth + 1) for child in record["child_nodes"])
+    return entry
+
+def _diff_fields(old_fields, new_fields, node_id, report):
+    """Add the fields added, removed or changed between two field lists of one node to report."""
+    old_by_id = {f["id"]: f for f in old_fields}
+    new_by_id = {f["id"]: f for f in new_fields}
+    for field_id, field in new_by_id.items():
+        old = old_by_id.get(field_id)
+        if old is None:
+            report["fields_added"].append({"node_id": node_id, "id": field_id, "name": field["name"]})
+            continue
+        changes = {key: {"old": old.get(key), "new": field.get(key)}
+                   for key in sorted(set(old) | set(field)) if old.get(key) != field.get(key)}
+        if changes:
+            report["fields_changed"].append({"node_id": node_id, "id": field_id, "name": field["name"],
+                                             "changes": changes})
+    for field_id, field in old_by_id.items():
+        if field_id not in new_by_id:
+            report["fields_removed"].append({"node_id": node_id, "id": field_id, "name": field["name"]})
+
+def refresh_query_type(stored, fresh):
+    """
+    Merge a freshly crawled query type into its stored entry. Nodes whose content_hash is
+    unchanged are kept exactly as stored and only the rest are replaced; fields are only
+    compared for nodes whose hash differs. Returns (entry, report) where report lists the
+    nodes and fields added, removed or changed (node_id None means the query type's own fields).
+    """
+    stored = stored or {"name": fresh["name"], "nodes": {}, "fields": []}
+    report = {
+        "name": fresh["name"],
+        "nodes_added": [],
+        "nodes_removed": [],
+        "nodes_rewritten": 0,
+        "fields_added": [],
+        "fields_removed": [],
+        "fields_changed": []
+    }
+    if stored.get("content_hash") != fresh["content_hash"]:
+        _diff_fields(stored["fields"], fresh["fields"], None, report)
+
+    entry = dict(fresh, nodes={})
+    for node_id, node in fresh["nodes"].items():
+        old = stored["nodes"].get(node_id)
+        if old is not None and old.get("content_hash") == node["content_hash"]:
+            entry["nodes"][node_id] = old
+            continue
+        if old is None:
+            report["nodes_added"].append({"id": node_id, "name": node["name"]})
+        _diff_fields(old["fields"] if old else [], node["fields"], node_id, report)
+        report["nodes_rewritten"] += 1
+        entry["nodes"][node_id] = node
+
+    for node_id, old in stored["nodes"].items():
+        if node_id not in fresh["nodes"]:
+            report["nodes_removed"].append({"id": node_id, "name": old["name"]})
+            _diff_fields(old["fields"], [], node_id, report)
+    return entry, report
+
+def save_diff_report(reports):
+    """Write the refresh reports to a timestamped DIFF_REPORT_FILE and return its name."""
+    now = datetime.utcnow()
+    report_file = DIFF_REPORT_FILE.format(timestamp=now.strftime("%Y%m%d_%H%M%S"))
+    with open(report_file, "w") as file:
+        json.dump({"generated_at": now.isoformat(), "query_types": reports}, file, indent=4)
+    return report_file
+
+def build_query_structure(max_workers=MAX_CRAWL_WORKERS, max_depth=MAX_NODE_DEPTH, refresh=False):
+    """
+    Retrieve all fields and nodes for each query_type_id and store them in a structured format.
+    With refresh=True, query types already in the file are crawled again and merged in
+    node by node, and a diff report of what changed is written.
+    """
     auth = BlackbaudAuth()
     existing_data = load_existing_data()
     
@@ -91,52 +345,63 @@ def build_query_structure():
 
     query_structure = existing_data 
 
-    #  Iterate through each query type
+    to_crawl = {}
     for qt_id, qt_name in query_type_ids.items():
-        if qt_id in query_structure:
+        if qt_id in query_structure and not refresh:
             print(f"Skipping Query Type ID {qt_id} - already processed.")
             continue
+        to_crawl[qt_id] = qt_name
+    if not to_crawl:
+        return
 
-        print(f"Processing Query Type: {qt_name} (ID: {qt_id})...")
-        nodes, fields = get_available_fields(auth, qt_id)
-
-        query_structure[qt_id] = {
-            "name": qt_name,
-            "nodes": {},
-            "fields": [{
-                "id": f["id"],
-                "name": f["available_field_name"],
-                "selected_name": f.get("selected_field_name", ""),
-                "value_type": f["value_type"],
-                "allowed_filter_operators": f.get("allowed_filter_operators", [])
-            } for f in fields]
-        }
+    checkpoint_file = REFRESH_CHECKPOINT_FILE if refresh else CHECKPOINT_FILE
+    checkpoint = CrawlCheckpoint(checkpoint_file)
+    if checkpoint.records:
+        print(f"Resuming from {checkpoint_file} ({len(checkpoint.records)} nodes already fetched).")
+
+    start = time.monotonic()
+    failed = crawl_query_types(auth, to_crawl, checkpoint, max_workers, max_depth)
+    if failed:
+        print(f"\n{len(failed)} fetches failed. Completed nodes are kept in {checkpoint_file}; run again to resume.")
+        return
+
+    if refresh:
+        refresh_query_structure(query_structure, to_crawl, checkpoint, max_depth)
+        checkpoint.remove()
+        print(f"Refresh finished in {time.monotonic() - start:.1f}s")
+        return
 
-        # Step 3: Process each node
-        for node in nodes:
-            node_id = str(node["id"])
-            print(f"  Processing Node: {node['name']} (ID: {node_id})...")
-
-            child_nodes, node_fields = get_fields_for_node(auth, qt_id, node_id)
-
-            query_structure[qt_id]["nodes"][node_id] = {
-                "name": node["name"],
-                "fields": [{
-                    "id": f["id"],
-                    "name": f["available_field_name"],
-                    "selected_name": f.get("selected_field_name", ""),
-                    "value_type": f["value_type"],
-                    "allowed_filter_operators": f.get("allowed_filter_operators", [])
-                } for f in node_fields],
-                "child_nodes": [{
-                    "id": cn["id"],
-                    "name": cn["name"]
-                } for cn in child_nodes]
-            }
+    for qt_id, qt_name in to_crawl.items():
+        query_structure[qt_id] = assemble_query_type(checkpoint, qt_id, qt_name, max_depth)
 
     # Save results
     save_data(query_structure)
-    print(f"\nQuery Structure saved to {OUTPUT_FILE}")
+    checkpoint.remove()
+    print(f"\nQuery Structure saved to {OUTPUT_FILE} in {time.monotonic() - start:.1f}s")
+
+def refresh_query_structure(query_structure, query_type_ids, checkpoint, max_depth=MAX_NODE_DEPTH):
+    """Merge freshly crawled query types into query_structure, saving it only if something changed."""
+    reports = {}
+    changed = False
+    for qt_id, qt_name in query_type_ids.items():
+        fresh = assemble_query_type(checkpoint, qt_id, qt_name, max_depth)
+        stored = query_structure.get(qt_id)
+        entry, report = refresh_query_type(stored, fresh)
+        reports[qt_id] = report
+        if entry != stored:
+            query_structure[qt_id] = entry
+            changed = True
+        print(f"{qt_name} (ID: {qt_id}): "
+              f"+{len(report['nodes_added'])}/-{len(report['nodes_removed'])} nodes, "
+              f"+{len(report['fields_added'])}/-{len(report['fields_removed'])}/~{len(report['fields_changed'])} fields, "
+              f"{report['nodes_rewritten']} nodes rewritten")
+
+    if changed:
+        save_data(query_structure)
+        print(f"\nQuery Structure updated in {OUTPUT_FILE}")
+    else:
+        print(f"\nNo changes; {OUTPUT_FILE} left as is")
+    print(f"Diff report saved to {save_diff_report(reports)}")
 
 def display_query_structure():
     """Load and display the stored query structure."""
@@ -168,5 +433,14 @@ def display_query_structure():
     print("=" * 60)
 
 if __name__ == "__main__":
-    build_query_structure()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build bb_query_structure.json from the SKY API query endpoints")
+    parser.add_argument("--workers", type=int, default=MAX_CRAWL_WORKERS, help="Concurrent node fetches")
+    parser.add_argument("--max-depth", type=int, default=MAX_NODE_DEPTH, help="Deepest child node level to fetch")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Re-crawl query types already in the file, update changed nodes and write a diff report")
+    args = parser.parse_args()
+
+    build_query_structure(max_workers=args.workers, max_depth=args.max_depth, refresh=args.refresh)
     display_query_structure()
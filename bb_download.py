@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# bb_download.py
+import base64
+import hashlib
+import math
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import requests
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # bytes written per chunk; memory use stays at roughly this
+DOWNLOAD_MAX_RETRIES = 5  # resume attempts after a broken transfer
+DOWNLOAD_RETRY_DELAY = 2  # seconds, doubled after each failed attempt
+DOWNLOAD_TIMEOUT = (30, 300)  # (connect, read) seconds
+
+# Ranged parallel downloads for large blobs
+PARALLEL_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024  # smaller results use a single stream
+PARALLEL_RANGE_SIZE = 32 * 1024 * 1024  # target bytes per range
+MAX_PARALLEL_RANGES = 8
+
+RETRYABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+
+class DownloadError(Exception):
+    """Raised when a downloaded file is incomplete or fails verification."""
+    pass
+
+
+def _total_length(response: requests.Response) -> Optional[int]:
+    """Full size of the resource, from Content-Range on a 206 or Content-Length on a 200."""
+    if response.headers.get("Content-Encoding"):
+        return None  # decoded bytes won't match the encoded length
+    if response.status_code == 206:
+        match = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("Content-Range", ""))
+        return int(match.group(1)) if match else None
+    length = response.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+
+def _expected_md5(response: requests.Response) -> Optional[bytes]:
+    """MD5 of the whole blob if the server advertised one. Content-MD5 on a 206 only covers the range."""
+    value = response.headers.get("x-ms-blob-content-md5")
+    if not value and response.status_code == 200:
+        value = response.headers.get("Content-MD5")
+    if not value:
+        return None
+    try:
+        return base64.b64decode(value)
+    except ValueError:
+        return None
+
+
+def stream_download(url: str, dest_path: str, chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+                    max_retries: int = DOWNLOAD_MAX_RETRIES, verify: bool = True,
+                    session: Optional[requests.Session] = None) -> str:
+    """
+    Download url to dest_path in fixed-size chunks.
+
+    Data goes to dest_path + ".part" and is renamed over dest_path only once it is complete,
+    so a half-written file never appears under the real name. If the connection breaks, the
+    transfer resumes with an HTTP Range request from the last byte written. With verify=True
+    the final size is checked against Content-Length/Content-Range and the MD5 against
+    Content-MD5 / x-ms-blob-content-md5 when the server sends them.
+    """
+    http = session or requests
+    part_path = dest_path + ".part"
+    written = 0
+    attempt = 0
+    expected_length = None
+    expected_md5 = None
+    md5 = hashlib.md5()
+
+    with open(part_path, "wb") as f:
+        while True:
+            headers = {"Range": f"bytes={written}-"} if written else {}
+            try:
+                with http.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                    r.raise_for_status()
+                    if written and r.status_code != 206:
+                        # Server ignored the Range header and is sending the whole file again
+                        f.seek(0)
+                        f.truncate()
+                        written = 0
+                        md5 = hashlib.md5()
+                    if expected_length is None:
+                        expected_length = _total_length(r)
+                        expected_md5 = _expected_md5(r)
+
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        if chunk:
+                            f.write(chunk)
+                            md5.update(chunk)
+                            written += len(chunk)
+
+                if expected_length is not None and written < expected_length:
+                    raise requests.exceptions.ChunkedEncodingError(
+                        f"Connection closed after {written} of {expected_length} bytes")
+                break
+            except RETRYABLE_ERRORS:
+                attempt += 1
+                if attempt > max_retries:
+                    raise
+                f.flush()
+                time.sleep(DOWNLOAD_RETRY_DELAY * (2 ** (attempt - 1)))
+
+        f.flush()
+        os.fsync(f.fileno())
+
+    try:
+        if verify:
+            if expected_length is not None and written != expected_length:
+                raise DownloadError(f"Size mismatch for {dest_path}: expected {expected_length} bytes, got {written}")
+            if expected_md5 is not None and md5.digest() != expected_md5:
+                raise DownloadError(f"MD5 mismatch for {dest_path}")
+        os.replace(part_path, dest_path)
+    except Exception:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+    return dest_path
+
+
+def probe_blob(url: str, session: Optional[requests.Session] = None) -> Tuple[Optional[int], bool, Optional[bytes]]:
+    """
+    Return (total_length, supports_ranges, md5) for url using a one-byte ranged GET,
+    which works with read-only SAS URIs where HEAD may not be allowed. An empty blob has
+    no byte 0, so its 416 is reported as (0, False, None) and it is simply streamed.
+    """
+    http = session or requests
+    with http.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        if r.status_code == 416:
+            return 0, False, None
+        r.raise_for_status()
+        return _total_length(r), r.status_code == 206, _expected_md5(r)
+
+
+def choose_range_count(total_length: int) -> int:
+    """Number of ranges for a blob of total_length bytes, about PARALLEL_RANGE_SIZE each."""
+    return max(1, min(MAX_PARALLEL_RANGES, math.ceil(total_length / PARALLEL_RANGE_SIZE)))
+
+
+def _download_range(http, url: str, path: str, start: int, end: int,
+                    chunk_size: int, max_retries: int) -> int:
+    """Fetch bytes start..end (inclusive) into the preallocated file at the same offset."""
+    pos = start
+    attempt = 0
+    with open(path, "r+b") as f:
+        while pos <= end:
+            try:
+                with http.get(url, headers={"Range": f"bytes={pos}-{end}"}, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise DownloadError("Server stopped honoring Range requests")
+                    f.seek(pos)
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        if chunk:
+                            f.write(chunk[:end + 1 - pos])
+                            pos += len(chunk)
+                if pos <= end:
+                    raise requests.exceptions.ChunkedEncodingError(
+                        f"Range {start}-{end} closed at byte {pos}")
+            except RETRYABLE_ERRORS:
+                attempt += 1
+                if attempt > max_retries:
+                    raise
+                time.sleep(DOWNLOAD_RETRY_DELAY * (2 ** (attempt - 1)))
+    return end - start + 1
+
+
+def _file_md5(path: str, chunk_size: int) -> bytes:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.digest()
+
+
+def parallel_download(url: str, dest_path: str, total_length: int, ranges: Optional[int] = None,
+                      expected_md5: Optional[bytes] = None, chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+                      max_retries: int = DOWNLOAD_MAX_RETRIES, verify: bool = True,
+                      session: Optional[requests.Session] = None) -> str:
+    """
+    Split a blob of total_length bytes into byte ranges and fetch them concurrently into a
+    preallocated dest_path + ".part", then rename it over dest_path. Each range resumes on
+    its own if its connection breaks.
+    """
+    http = session or requests
+    ranges = ranges or choose_range_count(total_length)
+    part_path = dest_path + ".part"
+    range_size = math.ceil(total_length / ranges)
+    bounds = [(start, min(start + range_size, total_length) - 1)
+              for start in range(0, total_length, range_size)]
+
+    try:
+        with open(part_path, "wb") as f:
+            f.truncate(total_length)
+
+        with ThreadPoolExecutor(max_workers=len(bounds), thread_name_prefix="blob_range") as executor:
+            futures = [executor.submit(_download_range, http, url, part_path, start, end, chunk_size, max_retries)
+                       for start, end in bounds]
+            written = sum(future.result() for future in futures)
+
+        if verify:
+            size = os.path.getsize(part_path)
+            if written != total_length or size != total_length:
+                raise DownloadError(f"Size mismatch for {dest_path}: expected {total_length} bytes, got {size}")
+            if expected_md5 is not None and _file_md5(part_path, chunk_size) != expected_md5:
+                raise DownloadError(f"MD5 mismatch for {dest_path}")
+        os.replace(part_path, dest_path)
+    except Exception:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+    return dest_path
+
+
+def download_blob(url: str, dest_path: str, verify: bool = True,
+                  session: Optional[requests.Session] = None) -> str:
+    """
+    Download a query result. Blobs of at least PARALLEL_DOWNLOAD_THRESHOLD bytes on a server
+    that supports Range are fetched as parallel ranges; everything else is streamed.
+    """
+    total_length, supports_ranges, expected_md5 = probe_blob(url, session=session)
+    if supports_ranges and total_length and total_length >= PARALLEL_DOWNLOAD_THRESHOLD:
+        return parallel_download(url, dest_path, total_length, expected_md5=expected_md5,
+                                 verify=verify, session=session)
+    return stream_download(url, dest_path, verify=verify, session=session)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# bb_email_enrichment.py
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import pandas as pd
+
+EMAIL_COLUMN = "Phone Number"  # the email query returns addresses in the phone number field
+IMPORT_ID_COLUMN = "ImportID"
+STREAMING_THRESHOLD_BYTES = 256 * 1024 ** 2  # bigger results are read in chunks instead of all at once
+CHUNK_ROWS = 200_000
+UPSERT_BATCH = 50_000
+LOOKUP_BATCH = 900  # bound parameters per SELECT, under SQLite's default limit of 999
+# Every column is read as text, blanks included, so the processed file matches the export
+# byte for byte apart from the added ImportID. Type inference would rewrite values (10.50 ->
+# 10.5, 0555 -> 555) and, when streaming, do so differently in each chunk.
+READ_CSV_OPTIONS = {"dtype": str, "keep_default_na": False}
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS import_ids (
+    email TEXT PRIMARY KEY,  -- normalize_email()
+    import_id NOT NULL,  -- no type, so ImportIDs come back as the mapping gave them
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+def normalize_emails(values: pd.Series) -> pd.Series:
+    return values.astype(str).str.strip().str.lower()
+
+
+class ImportIdIndex:
+    """
+    Persistent email -> ImportID index in SQLite.
+
+    Mapping files are upserted into it as they arrive, so it only grows by what changed and
+    is never read in full. Emails are stored normalized (trimmed, lowercase), and lookups
+    normalize the same way, so case differences between the mapping and the query results
+    still match. Only entries containing '@' are kept, so a plain phone number never matches.
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        with self._connect() as conn:
+            conn.executescript(INDEX_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        """Connection committed and closed on exit; one per call so worker threads can share the index."""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def upsert(self, pairs: Iterable[Tuple[str, Any]]) -> int:
+        """Insert or update (email, import_id) pairs; returns how many were written."""
+        now = time.time()
+        written = 0
+        batch = []
+        with self._connect() as conn:
+            for email, import_id in pairs:
+                if import_id is None or "@" not in str(email):
+                    continue
+                batch.append((normalize_email(str(email)), import_id, now))
+                if len(batch) >= UPSERT_BATCH:
+                    written += self._write(conn, batch)
+                    batch = []
+            written += self._write(conn, batch)
+        return written
+
+    @staticmethod
+    def _write(conn: sqlite3.Connection, batch) -> int:
+        conn.executemany(
+            "INSERT INTO import_ids (email, import_id, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (email) DO UPDATE SET import_id = excluded.import_id, updated_at = excluded.updated_at",
+            batch)
+        return len(batch)
+
+    def import_json(self, mapping_file: str) -> int:
+        """Upsert an email_to_importid_mapping.json ({email: import_id}) into the index."""
+        with open(mapping_file, "r") as f:
+            mapping = json.load(f)
+        return self.upsert(mapping.items())
+
+    def lookup(self, emails: Iterable[str]) -> Dict[str, Any]:
+        """ImportIDs of the given normalized emails that are in the index."""
+        emails = list(emails)
+        found = {}
+        with self._connect() as conn:
+            for start in range(0, len(emails), LOOKUP_BATCH):
+                batch = emails[start:start + LOOKUP_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                found.update(conn.execute(
+                    f"SELECT email, import_id FROM import_ids WHERE email IN ({placeholders})", batch))
+        return found
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM import_ids").fetchone()[0]
+
+
+def add_import_ids(df: pd.DataFrame, index: ImportIdIndex) -> pd.DataFrame:
+    """Append IMPORT_ID_COLUMN, looking up only the distinct emails in this frame."""
+    if EMAIL_COLUMN not in df.columns:
+        df[IMPORT_ID_COLUMN] = None
+        return df
+    emails = normalize_emails(df[EMAIL_COLUMN])
+    wanted = emails[emails.str.contains("@", regex=False)].unique()
+    # Object dtype so matched ImportIDs keep their type (no 123 -> 123.0)
+    df[IMPORT_ID_COLUMN] = emails.map(pd.Series(index.lookup(wanted), dtype=object))
+    return df
+
+
+def enrich_csv(src: str, dest: str, index: ImportIdIndex, chunk_rows: Optional[int] = None) -> int:
+    """
+    Write src to dest with an ImportID column appended, matched on the email in EMAIL_COLUMN.
+    Files over STREAMING_THRESHOLD_BYTES (or any file, if chunk_rows is given) are streamed
+    through read_csv in chunks so memory stays bounded; dest only appears once complete.
+    Returns the number of rows written.
+    """
+    if chunk_rows is None and os.path.getsize(src) > STREAMING_THRESHOLD_BYTES:
+        chunk_rows = CHUNK_ROWS
+
+    if not chunk_rows:
+        df = add_import_ids(pd.read_csv(src, **READ_CSV_OPTIONS), index)
+        df.to_csv(dest, index=False)
+        return len(df)
+
+    tmp_dest = dest + ".tmp"
+    rows = 0
+    try:
+        for chunk in pd.read_csv(src, chunksize=chunk_rows, **READ_CSV_OPTIONS):
+            add_import_ids(chunk, index).to_csv(tmp_dest, mode="a" if rows else "w", header=not rows, index=False)
+            rows += len(chunk)
+        if not rows:
+            # Header-only result: nothing was streamed, so write it the simple way
+            return enrich_csv(src, dest, index, chunk_rows=0)
+        os.replace(tmp_dest, dest)
+    finally:
+        if os.path.exists(tmp_dest):
+            os.remove(tmp_dest)
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Maintain the email -> ImportID index used to enrich email query results")
+    parser.add_argument("db", help="Index file, e.g. email_to_importid.sqlite")
+    parser.add_argument("--import-json", metavar="MAPPING", help="Upsert an email_to_importid_mapping.json")
+    parser.add_argument("--lookup", metavar="EMAIL", nargs="+", help="Print the ImportID of each email")
+    args = parser.parse_args()
+
+    index = ImportIdIndex(args.db)
+    if args.import_json:
+        print(f"Upserted {index.import_json(args.import_json):,} entries")
+    if args.lookup:
+        found = index.lookup(normalize_email(e) for e in args.lookup)
+        for email in args.lookup:
+            print(f"{email}: {found.get(normalize_email(email), '(not found)')}")
+    print(f"{len(index):,} emails in {args.db}")
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+# bb_field_catalog.py
+import json
+import os
+import re
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CATALOG_JSON = os.path.join(BASE_DIR, "bb_query_structure_id.json")
+CATALOG_DB = os.path.join(BASE_DIR, "bb_query_structure_id.sqlite")
+CATALOG_SCHEMA_VERSION = 2  # bump when the tables change so old catalog files get rebuilt
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE query_types (id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE nodes (
+    query_type_id INTEGER NOT NULL,
+    node_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (query_type_id, node_id)
+);
+CREATE TABLE node_children (
+    query_type_id INTEGER NOT NULL,
+    node_id INTEGER NOT NULL,
+    child_id INTEGER NOT NULL,
+    child_name TEXT NOT NULL
+);
+CREATE TABLE operators (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE fields (
+    key INTEGER PRIMARY KEY,
+    query_type_id INTEGER NOT NULL,
+    node_id INTEGER,  -- NULL for the query type's own fields
+    id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    selected_name TEXT NOT NULL,
+    value_type TEXT NOT NULL,
+    operator_mask INTEGER NOT NULL,  -- bit n set = operators.id n allowed
+    search_name TEXT NOT NULL DEFAULT '',  -- tokenized name and selected_name, for exact/prefix scoring
+    search_selected_name TEXT NOT NULL DEFAULT '',
+    trigram_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX fields_by_id ON fields (id);
+CREATE INDEX fields_by_selected_name ON fields (selected_name COLLATE NOCASE);
+CREATE INDEX fields_by_query_type ON fields (query_type_id, id);
+CREATE INDEX fields_by_node ON fields (query_type_id, node_id);
+CREATE INDEX children_by_node ON node_children (query_type_id, node_id);
+-- Search indexes over the words of name and selected_name
+CREATE TABLE field_tokens (token TEXT NOT NULL, field_key INTEGER NOT NULL);
+CREATE TABLE field_trigrams (trigram TEXT NOT NULL, field_key INTEGER NOT NULL);
+CREATE INDEX tokens_by_token ON field_tokens (token, field_key);
+CREATE INDEX trigrams_by_trigram ON field_trigrams (trigram, field_key);
+"""
+
+FIELD_COLUMNS = "query_type_id, node_id, id, name, selected_name, value_type, operator_mask"
+SEARCH_LIMIT = 20
+MIN_TRIGRAM_OVERLAP = 0.3  # share of the search text's trigrams a fuzzy match must have
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase words of a field name, the unit of token and prefix matching."""
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def trigrams(tokens: List[str]) -> set:
+    """Character trigrams of each word padded with spaces, so short words and word starts count."""
+    grams = set()
+    for token in tokens:
+        padded = f"  {token} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class FieldCatalog:
+    """
+    Indexed, read-only view of bb_query_structure_id.json.
+
+    The JSON is compiled once into an SQLite file next to it and recompiled only when the
+    JSON changes, so tools that start many times a day open a small indexed file instead of
+    parsing the whole structure. Nothing is opened until the first lookup. Field ids are
+    only unique within a node, so lookups by id or selected_name return every match,
+    optionally narrowed to one query type.
+    """
+    def __init__(self, json_path: str = CATALOG_JSON, db_path: Optional[str] = None):
+        self.json_path = json_path
+        self.db_path = db_path or os.path.splitext(json_path)[0] + ".sqlite"
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._operators: List[str] = []
+        self._search_columns: Optional[Dict[int, tuple]] = None
+
+    def _source_signature(self) -> Optional[str]:
+        try:
+            stat = os.stat(self.json_path)
+        except FileNotFoundError:
+            return None
+        return f"{CATALOG_SCHEMA_VERSION}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def _is_current(self, signature: Optional[str]) -> bool:
+        if not os.path.exists(self.db_path):
+            return False
+        if signature is None:
+            return True  # no JSON to rebuild from; use what's there
+        try:
+            conn = sqlite3.connect(self.db_path)
+            try:
+                row = conn.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+            finally:
+                conn.close()
+        except sqlite3.DatabaseError:
+            return False
+        return row is not None and row[0] == signature
+
+    def compile(self):
+        """(Re)build the SQLite catalog from the JSON, replacing the old file in one step."""
+        with open(self.json_path, "r") as f:
+            structure = json.load(f)
+
+        operators: Dict[str, int] = {}
+
+        def mask(names):
+            value = 0
+            for name in names:
+                bit = operators.setdefault(name, len(operators))
+                value |= 1 << bit
+            return value
+
+        tmp_path = f"{self.db_path}.{os.getpid()}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.executescript(SCHEMA)
+            fields = []
+            for qt_id, qt in structure.items():
+                conn.execute("INSERT INTO query_types VALUES (?, ?)", (int(qt_id), qt["name"]))
+                sections = [(None, qt.get("fields", []))]
+                for node_id, node in qt.get("nodes", {}).items():
+                    conn.execute("INSERT INTO nodes VALUES (?, ?, ?)", (int(qt_id), int(node_id), node["name"]))
+                    conn.executemany("INSERT INTO node_children VALUES (?, ?, ?, ?)",
+                                     [(int(qt_id), int(node_id), int(cn["id"]), cn["name"])
+                                      for cn in node.get("child_nodes", [])])
+                    sections.append((int(node_id), node.get("fields", [])))
+                for node_id, node_fields in sections:
+                    for f in node_fields:
+                        fields.append((len(fields), int(qt_id), node_id, int(f["id"]), f["name"],
+                                       f.get("selected_name") or "", f["value_type"],
+                                       mask(f.get("allowed_filter_operators", []))))
+            conn.executemany(f"INSERT INTO fields (key, {FIELD_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", fields)
+
+            tokens, grams, search_columns = [], [], []
+            for key, _, _, _, name, selected_name, _, _ in fields:
+                name_words, selected_words = tokenize(name), tokenize(selected_name)
+                words = set(name_words) | set(selected_words)
+                field_grams = trigrams(words)
+                tokens.extend((token, key) for token in words)
+                grams.extend((gram, key) for gram in field_grams)
+                search_columns.append((" ".join(name_words), " ".join(selected_words), len(field_grams), key))
+            conn.executemany("INSERT INTO field_tokens VALUES (?, ?)", tokens)
+            conn.executemany("INSERT INTO field_trigrams VALUES (?, ?)", grams)
+            conn.executemany("UPDATE fields SET search_name = ?, search_selected_name = ?, trigram_count = ? "
+                             "WHERE key = ?", search_columns)
+            conn.executemany("INSERT INTO operators VALUES (?, ?)", [(bit, name) for name, bit in operators.items()])
+            conn.execute("INSERT INTO meta VALUES ('source', ?)", (self._source_signature(),))
+            conn.commit()
+        except Exception:
+            conn.close()
+            os.remove(tmp_path)
+            raise
+        conn.close()
+        os.replace(tmp_path, self.db_path)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Open the catalog on first use, compiling it if the JSON is newer."""
+        if self._conn is None:
+            with self._lock:
+                if self._conn is None:
+                    if not self._is_current(self._source_signature()):
+                        self.compile()
+                    conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+                    self._operators = [name for _, name in conn.execute("SELECT id, name FROM operators ORDER BY id")]
+                    self._conn = conn
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self._search_columns = None
+
+    def _query(self, sql: str, params=()) -> List[tuple]:
+        conn = self.conn
+        with self._lock:
+            return conn.execute(sql, params).fetchall()
+
+    def _field(self, row) -> Dict[str, Any]:
+        qt_id, node_id, field_id, name, selected_name, value_type, operator_mask = row
+        return {
+            "query_type_id": qt_id,
+            "node_id": node_id,
+            "id": field_id,
+            "name": name,
+            "selected_name": selected_name,
+            "value_type": value_type,
+            "allowed_filter_operators": [op for bit, op in enumerate(self._operators) if operator_mask >> bit & 1]
+        }
+
+    def _fields(self, where: str, params, query_type_id: Optional[int]) -> List[Dict[str, Any]]:
+        if query_type_id is not None:
+            where += " AND query_type_id = ?"
+            params = (*params, int(query_type_id))
+        return [self._field(row) for row in self._query(f"SELECT {FIELD_COLUMNS} FROM fields WHERE {where}", params)]
+
+    def fields_by_id(self, field_id: int, query_type_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Every field with this id, across query types unless query_type_id is given."""
+        return self._fields("id = ?", (int(field_id),), query_type_id)
+
+    def fields_by_selected_name(self, selected_name: str, query_type_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Every field whose selected_name matches, ignoring case."""
+        return self._fields("selected_name = ? COLLATE NOCASE", (selected_name,), query_type_id)
+
+    def query_type_fields(self, query_type_id: int, node_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """All fields of a query type, or of one of its nodes."""
+        if node_id is None:
+            return self._fields("1", (), query_type_id)
+        return self._fields("node_id = ?", (int(node_id),), query_type_id)
+
+    def query_types(self) -> Dict[int, str]:
+        return dict(self._query("SELECT id, name FROM query_types ORDER BY id"))
+
+    def node(self, query_type_id: int, node_id: int) -> Optional[Dict[str, Any]]:
+        """A node's name and child nodes, or None if the query type has no such node."""
+        row = self._query("SELECT name FROM nodes WHERE query_type_id = ? AND node_id = ?",
+                          (int(query_type_id), int(node_id)))
+        if not row:
+            return None
+        children = self._query("SELECT child_id, child_name FROM node_children WHERE query_type_id = ? AND node_id = ?",
+                               (int(query_type_id), int(node_id)))
+        return {
+            "query_type_id": int(query_type_id),
+            "id": int(node_id),
+            "name": row[0][0],
+            "child_nodes": [{"id": child_id, "name": name} for child_id, name in children]
+        }
+
+    def operators(self) -> List[str]:
+        """Filter operator names, in the order of their operator_mask bits."""
+        self.conn  # loads the operator list
+        return list(self._operators)
+
+    def _filter_sql(self, query_type_id: Optional[int], value_type: Optional[str],
+                    operators: Optional[List[str]]):
+        where, params = [], []
+        if query_type_id is not None:
+            where.append("f.query_type_id = ?")
+            params.append(int(query_type_id))
+        if value_type:
+            where.append("f.value_type = ? COLLATE NOCASE")
+            params.append(value_type)
+        if operators:
+            known = {name.lower(): bit for bit, name in enumerate(self.operators())}
+            required = 0
+            for name in operators:
+                if name.lower() not in known:
+                    raise ValueError(f"Unknown filter operator: {name}")
+                required |= 1 << known[name.lower()]
+            where.append("f.operator_mask & ? = ?")
+            params.extend([required, required])
+        return "".join(f" AND {clause}" for clause in where), params
+
+    def search(self, text: str, query_type_id: Optional[int] = None, value_type: Optional[str] = None,
+               operators: Optional[List[str]] = None, limit: int = SEARCH_LIMIT) -> List[Dict[str, Any]]:
+        """
+        Rank fields whose name or selected_name matches text. Exact names score highest, then
+        names starting with text, then fields where every word of text is a prefix of one of
+        the field's words, with trigram similarity breaking ties and catching typos. Results
+        can be narrowed to a query type, a value_type and fields allowing all given operators.
+        Each result is a field dict with an added "score".
+        """
+        words = tokenize(text)
+        if not words:
+            return []
+        filters, filter_params = self._filter_sql(query_type_id, value_type, operators)
+
+        join = " JOIN fields f ON f.key = {}.field_key" if filters else ""
+        if self._search_columns is None:
+            self._search_columns = {row[0]: row[1:] for row in self._query(
+                "SELECT key, search_name, search_selected_name, trigram_count, selected_name, query_type_id FROM fields")}
+
+        # Token and prefix matches: how many of the search words each field covers
+        word_hits: Dict[int, int] = {}
+        for word in set(words):
+            rows = self._query(f"SELECT DISTINCT k.field_key FROM field_tokens k{join.format('k')} "
+                               f"WHERE k.token >= ? AND k.token < ?{filters}",
+                               (word, word + "\uffff", *filter_params))
+            for (key,) in rows:
+                word_hits[key] = word_hits.get(key, 0) + 1
+
+        # Fuzzy matches: fields sharing enough trigrams with the search text
+        grams = trigrams(words)
+        shared = dict(self._query(
+            f"SELECT t.field_key, COUNT(*) AS shared FROM field_trigrams t{join.format('t')} "
+            f"WHERE t.trigram IN ({', '.join('?' * len(grams))}){filters} GROUP BY t.field_key HAVING shared >= ?",
+            (*grams, *filter_params, max(2, int(len(grams) * MIN_TRIGRAM_OVERLAP)))))
+        candidates = set(word_hits) | set(shared)
+        if not candidates:
+            return []
+
+        # Score from the precomputed columns, then load only the fields that are returned
+        needle = " ".join(words)
+        scores = {}
+        for key in candidates:
+            search_name, search_selected_name, trigram_count, selected_name, qt_id = self._search_columns[key]
+            common = shared.get(key, 0)
+            score = common / (len(grams) + trigram_count - common)
+            score += 1.5 * word_hits.get(key, 0) / len(set(words))
+            if needle in (search_name, search_selected_name):
+                score += 3
+            elif search_name.startswith(needle) or search_selected_name.startswith(needle):
+                score += 2
+            scores[key] = (round(score, 3), selected_name, qt_id)
+        best = sorted(scores, key=lambda k: (-scores[k][0], scores[k][1], scores[k][2], k))[:limit]
+        if not best:
+            return []
+
+        fields = {row[0]: self._field(row[1:]) for row in self._query(
+            f"SELECT key, {FIELD_COLUMNS} FROM fields WHERE key IN ({', '.join('?' * len(best))})", tuple(best))}
+        results = []
+        for key in best:
+            fields[key]["score"] = scores[key][0]
+            results.append(fields[key])
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "catalog": self.db_path,
+            "query_types": self._query("SELECT COUNT(*) FROM query_types")[0][0],
+            "nodes": self._query("SELECT COUNT(*) FROM nodes")[0][0],
+            "fields": self._query("SELECT COUNT(*) FROM fields")[0][0],
+            "operators": self.operators()
+        }
+
+
+_catalog: Optional[FieldCatalog] = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog() -> FieldCatalog:
+    """Shared catalog for the default bb_query_structure_id.json."""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = FieldCatalog(CATALOG_JSON, CATALOG_DB)
+        return _catalog
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compile and query the indexed field catalog")
+    parser.add_argument("--json", default=CATALOG_JSON, help="Query structure JSON to compile")
+    parser.add_argument("--rebuild", action="store_true", help="Recompile even if the catalog is current")
+    parser.add_argument("--id", type=int, help="Look up fields by id")
+    parser.add_argument("--selected-name", help="Look up fields by selected_name")
+    parser.add_argument("--search", help="Search field names and selected names (prefix, word and fuzzy matching)")
+    parser.add_argument("--query-type", type=int, help="Limit lookups to one query type id")
+    parser.add_argument("--value-type", help="Search only fields of this value_type (e.g. Date, Text, Lookup)")
+    parser.add_argument("--operator", action="append", help="Search only fields allowing this filter operator; repeatable")
+    parser.add_argument("--limit", type=int, default=SEARCH_LIMIT, help="Maximum search results")
+    args = parser.parse_args()
+
+    catalog = FieldCatalog(args.json)
+    if args.rebuild:
+        catalog.compile()
+    if args.search:
+        query_types = catalog.query_types()
+        for field in catalog.search(args.search, args.query_type, args.value_type, args.operator, args.limit):
+            node = "" if field["node_id"] is None else f" / node {field['node_id']}"
+            print(f"{field['score']:6.2f}  [{field['id']}] {field['selected_name'] or field['name']} "
+                  f"({field['value_type']}) - {query_types.get(field['query_type_id'])} "
+                  f"(ID: {field['query_type_id']}){node}")
+        raise SystemExit(0)
+    if args.id is not None:
+        results = catalog.fields_by_id(args.id, args.query_type)
+    elif args.selected_name:
+        results = catalog.fields_by_selected_name(args.selected_name, args.query_type)
+    else:
+        results = catalog.stats()
+    print(json.dumps(results, indent=4))
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# bb_folder_watcher.py
+import fnmatch
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    # inotify on Linux, ReadDirectoryChangesW on Windows, FSEvents on macOS
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+STABLE_SECONDS = 0.5  # a file's size and mtime must hold still this long before it is handed over
+SCAN_INTERVAL = 0.5  # fallback: seconds between checks of the folder's own mtime
+RESCAN_SECONDS = 60  # full listing now and then in case an event or mtime change was missed
+
+
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        if event.event_type in ("created", "modified", "closed"):
+            self.watcher._candidate(event.src_path)
+        elif event.event_type == "moved":
+            self.watcher._forget(event.src_path)
+            self.watcher._candidate(event.dest_path)
+        elif event.event_type == "deleted":
+            self.watcher._forget(event.src_path)
+
+
+class FolderWatcher:
+    """
+    Report files that appear in a folder, once they have finished being written.
+
+    Uses watchdog's native file system events when it is installed. Without it, a
+    background thread stats only the folder itself every SCAN_INTERVAL seconds and lists
+    the folder only when its mtime changes. Either way a new file is handed over after its
+    size and mtime have been unchanged for STABLE_SECONDS and it can be opened, so a
+    partially written file is never picked up. Each file is reported once until it leaves
+    the folder. A different file later found under a reported name (a new inode, size or
+    mtime) is reported again, even if the old one's removal was never seen.
+
+    Consume new files either by pulling (get) or through subscribe(callback).
+    """
+    def __init__(self, folder: str, patterns: Iterable[str] = ("*",),
+                 stable_seconds: float = STABLE_SECONDS, scan_interval: float = SCAN_INTERVAL,
+                 include_existing: bool = True):
+        self.folder = folder
+        self.patterns = tuple(patterns)
+        self.stable_seconds = stable_seconds
+        self.scan_interval = scan_interval
+        self.include_existing = include_existing
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._pending: Dict[str, Tuple[int, float, float]] = {}  # path -> (size, mtime, unchanged since)
+        self._reported: Dict[str, Tuple[int, int, int]] = {}  # path -> _signature() when it was reported
+        self._ready = queue.Queue()
+        self._subscribers: List[Callable[[str], None]] = []
+        self._thread = None
+        self._observer = None
+        self._dir_mtime = None
+
+    @property
+    def uses_native_events(self) -> bool:
+        return self._observer is not None
+
+    def subscribe(self, callback: Callable[[str], None]):
+        """Call callback(path) from the watcher thread for each new stable file."""
+        self._subscribers.append(callback)
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        # Before the first listing, so a file arriving between the two still changes the mtime
+        self._folder_changed()
+        if self.include_existing:
+            self._scan()
+        else:
+            with self._lock:
+                self._reported.update(self._list_matching())
+        if Observer is not None:
+            try:
+                self._observer = Observer()
+                self._observer.schedule(_EventHandler(self), self.folder, recursive=False)
+                self._observer.start()
+            except Exception:
+                self._observer = None
+        self._thread = threading.Thread(target=self._run, name="folder_watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join(timeout=2)
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+
+    def get(self, timeout: Optional[float] = None) -> Optional[str]:
+        """Next new stable file, or None if none arrives within timeout seconds."""
+        try:
+            return self._ready.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def get_batch(self, timeout: Optional[float] = None, settle: float = 1.0) -> List[str]:
+        """Wait up to timeout for a new file, then keep collecting until settle seconds pass with none."""
+        first = self.get(timeout)
+        if first is None:
+            return []
+        batch = [first]
+        while True:
+            path = self.get(settle)
+            if path is None:
+                return batch
+            batch.append(path)
+
+    def _matches(self, name: str) -> bool:
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.patterns)
+
+    @staticmethod
+    def _signature(stat: os.stat_result) -> Tuple[int, int, int]:
+        """Identifies one file under a name: a file moved or copied in later differs in at least one."""
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _list_matching(self) -> Dict[str, Tuple[int, int, int]]:
+        try:
+            with os.scandir(self.folder) as entries:
+                return {entry.path: self._signature(entry.stat()) for entry in entries
+                        if entry.is_file() and self._matches(entry.name)}
+        except FileNotFoundError:
+            return {}
+
+    def _candidate(self, path: str, signature: Optional[Tuple[int, int, int]] = None):
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.folder):
+            return
+        if not self._matches(os.path.basename(path)):
+            return
+        with self._lock:
+            reported = self._reported.get(path)
+        if reported is not None:
+            if signature is None:
+                try:
+                    signature = self._signature(os.stat(path))
+                except FileNotFoundError:
+                    return
+            if signature == reported:
+                return
+        with self._lock:
+            if self._reported.get(path) == reported and path not in self._pending:
+                self._reported.pop(path, None)
+                self._pending[path] = (-1, -1.0, time.monotonic())
+        self._wake.set()
+
+    def _forget(self, path: str):
+        with self._lock:
+            self._reported.pop(path, None)
+            self._pending.pop(path, None)
+
+    def _scan(self):
+        """List the folder: queue unseen (or replaced) files as candidates and forget ones that are gone."""
+        present = self._list_matching()
+        with self._lock:
+            for path in [p for p in self._reported if p not in present]:
+                del self._reported[path]
+            for path in list(self._pending):
+                if path not in present:
+                    del self._pending[path]
+        for path, signature in present.items():
+            self._candidate(path, signature)
+
+    def _folder_changed(self) -> bool:
+        try:
+            mtime = os.stat(self.folder).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        changed = mtime != self._dir_mtime
+        self._dir_mtime = mtime
+        return changed
+
+    def _check_pending(self):
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            pending = list(self._pending.items())
+        for path, (size, mtime, since) in pending:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self._forget(path)
+                continue
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                with self._lock:
+                    if path in self._pending:
+                        self._pending[path] = (stat.st_size, stat.st_mtime, now)
+                continue
+            if now - since < self.stable_seconds:
+                continue
+            try:
+                # Fails on Windows while the writer still holds the file open
+                with open(path, "rb"):
+                    pass
+            except OSError:
+                continue
+            with self._lock:
+                if self._pending.pop(path, None) is None:
+                    continue
+                self._reported[path] = self._signature(stat)
+            ready.append(path)
+
+        for path in ready:
+            self._ready.put(path)
+            for callback in self._subscribers:
+                try:
+                    callback(path)
+                except Exception:
+                    pass
+
+    def _run(self):
+        last_rescan = time.monotonic()
+        while not self._stop.is_set():
+            with self._lock:
+                has_pending = bool(self._pending)
+            if has_pending:
+                timeout = min(self.stable_seconds / 2, self.scan_interval)
+            elif self._observer is not None:
+                timeout = RESCAN_SECONDS
+            else:
+                timeout = self.scan_interval
+            self._wake.wait(timeout)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+
+            now = time.monotonic()
+            if now - last_rescan >= RESCAN_SECONDS:
+                self._scan()
+                last_rescan = now
+            elif self._observer is None and self._folder_changed():
+                self._scan()
+            self._check_pending()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# bb_job_poller.py
+
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+JOB_STATUS_ENDPOINT_TEMPLATE = "/query/jobs/{job_id}"
+POLL_INTERVAL = 8  # seconds before the first status check
+MAX_POLL_INTERVAL = 120  # backoff cap for long-running jobs
+POLL_BACKOFF_FACTOR = 1.5
+MAX_POLLING_SECONDS = 604800  # 7 days
+TERMINAL_STATUSES = ("Completed", "Failed", "Cancelled", "Throttled")
+
+
+class PollingTimeoutError(Exception):
+    """Raised through a job's future when it never reaches a terminal status."""
+    def __init__(self, job_id: str, max_seconds: int):
+        self.job_id = job_id
+        self.max_seconds = max_seconds
+        super().__init__(f"Job {job_id} exceeded maximum polling time of {max_seconds} seconds")
+
+
+class _PolledJob:
+    def __init__(self, job_id, endpoint, params, on_status, interval):
+        self.job_id = job_id
+        self.endpoint = endpoint
+        self.params = params
+        self.on_status = on_status
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last_status = None
+        self.future = Future()
+
+
+class JobStatusPoller:
+    """
+    Track every outstanding query job and poll them all from one background thread.
+
+    Each job has its own next-poll deadline. While a job's status stays the same its
+    interval grows by POLL_BACKOFF_FACTOR up to MAX_POLL_INTERVAL, and it drops back to
+    POLL_INTERVAL whenever the status changes. submit() returns a Future that resolves
+    with the final job response (or None if the status endpoint returned nothing).
+    """
+    def __init__(self, auth, endpoint_template: str = JOB_STATUS_ENDPOINT_TEMPLATE,
+                 poll_interval: float = POLL_INTERVAL,
+                 max_interval: float = MAX_POLL_INTERVAL,
+                 backoff_factor: float = POLL_BACKOFF_FACTOR,
+                 max_seconds: float = MAX_POLLING_SECONDS):
+        self.auth = auth
+        self.endpoint_template = endpoint_template
+        self.poll_interval = poll_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.max_seconds = max_seconds
+
+        self._jobs = {}
+        self._schedule = []  # heap of (next_poll_at, seq, job_id)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    @property
+    def pending_count(self) -> int:
+        with self._cond:
+            return len(self._jobs)
+
+    def submit(self, job_id: str, params=None, on_status=None) -> Future:
+        """
+        Start tracking job_id. on_status(job_id, status) is called from the poller thread
+        each time the job's status changes. Submitting a job that is already tracked
+        returns the existing future.
+        """
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("JobStatusPoller has been stopped")
+            if job_id in self._jobs:
+                return self._jobs[job_id].future
+
+            job = _PolledJob(
+                job_id=job_id,
+                endpoint=self.endpoint_template.format(job_id=job_id),
+                params=dict(params or {}),
+                on_status=on_status,
+                interval=self.poll_interval
+            )
+            self._jobs[job_id] = job
+            # The first check happens right away so a job that finished quickly isn't held back
+            heapq.heappush(self._schedule, (time.monotonic(), next(self._seq), job_id))
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="job_status_poller", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+            return job.future
+
+    def stop(self):
+        """Stop polling. Jobs still outstanding are cancelled."""
+        with self._cond:
+            self._stopped = True
+            jobs = list(self._jobs.values())
+            self._jobs.clear()
+            self._schedule.clear()
+            self._cond.notify()
+        for job in jobs:
+            job.future.cancel()
+
+    def _next_due_job(self):
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return None
+                if not self._schedule:
+                    self._cond.wait()
+                    continue
+                next_at, _, job_id = self._schedule[0]
+                delay = next_at - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._schedule)
+                job = self._jobs.get(job_id)
+                if job is not None:
+                    return job
+
+    def _run(self):
+        while True:
+            job = self._next_due_job()
+            if job is None:
+                return
+            try:
+                self._poll(job)
+            except Exception as e:
+                self._finish(job, exception=e)
+
+    def _poll(self, job: _PolledJob):
+        response = self.auth.make_request(method="GET", endpoint=job.endpoint, params=job.params, data=None)
+        if not response:
+            self._finish(job, result=None)
+            return
+
+        status = response.get("status", "")
+        if status != job.last_status:
+            job.last_status = status
+            job.interval = self.poll_interval
+            if job.on_status:
+                try:
+                    job.on_status(job.job_id, status)
+                except Exception:
+                    pass
+        else:
+            job.interval = min(job.interval * self.backoff_factor, self.max_interval)
+
+        if status in TERMINAL_STATUSES:
+            self._finish(job, result=response)
+            return
+
+        elapsed = time.monotonic() - job.started
+        if elapsed >= self.max_seconds:
+            self._finish(job, exception=PollingTimeoutError(job.job_id, self.max_seconds))
+            return
+
+        with self._cond:
+            if job.job_id in self._jobs:
+                next_at = time.monotonic() + min(job.interval, self.max_seconds - elapsed)
+                heapq.heappush(self._schedule, (next_at, next(self._seq), job.job_id))
+
+    def _finish(self, job: _PolledJob, result=None, exception=None):
+        with self._cond:
+            self._jobs.pop(job.job_id, None)
+        if job.future.done():
+            return
+        if exception is not None:
+            job.future.set_exception(exception)
+        else:
+            job.future.set_result(result)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# bb_log_sink.py
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+LOG_QUEUE_SIZE = 10_000  # records waiting to be written; emit() blocks beyond this instead of dropping
+LOG_BATCH_SIZE = 500  # records written per file write
+LOG_FLUSH_INTERVAL = 0.5  # seconds a record may wait for others to batch with
+LOG_MAX_BYTES = 50 * 1024 ** 2  # rotate when the file reaches this size...
+LOG_ROTATE_SECONDS = 24 * 60 * 60  # ...or has been written to for this long
+LOG_BACKUP_COUNT = 30  # rotated files kept; older ones are deleted
+
+_STOP = object()
+
+
+class LogSink:
+    """
+    Write JSON-lines log records from a background thread.
+
+    emit() only puts the record on a bounded queue, so callers never wait on the disk unless
+    the writer falls LOG_QUEUE_SIZE records behind. The writer thread drains the queue in
+    batches of up to LOG_BATCH_SIZE, writes them with one call and rotates the file to
+    <name>.<UTC timestamp> once it exceeds max_bytes or is older than rotate_seconds,
+    keeping the newest backup_count rotated files.
+    """
+    def __init__(self, path: str, max_bytes: int = LOG_MAX_BYTES, rotate_seconds: float = LOG_ROTATE_SECONDS,
+                 backup_count: int = LOG_BACKUP_COUNT, queue_size: int = LOG_QUEUE_SIZE,
+                 batch_size: int = LOG_BATCH_SIZE, flush_interval: float = LOG_FLUSH_INTERVAL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = None
+        self._opened_at = 0.0
+        self._thread = threading.Thread(target=self._run, name="log_sink", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def emit(self, record: Dict[str, Any]):
+        """Queue a record; "ts" (UTC, ISO 8601) is added if missing."""
+        if "ts" not in record:
+            record = {"ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"), **record}
+        self._queue.put(record)
+
+    def close(self, timeout: Optional[float] = 10):
+        """Write everything queued so far and stop the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            stop = batch[-1] is _STOP
+            records = batch[:-1] if stop else batch
+            if records:
+                try:
+                    self._write(records)
+                except Exception as e:
+                    # Logging must never take the process down; report and keep going
+                    print(f"Log sink could not write {len(records)} record(s) to {self.path}: {e}")
+            if stop:
+                if self._file:
+                    self._file.close()
+                    self._file = None
+                return
+
+    def _write(self, records):
+        if self._file is None:
+            self._open()
+        elif self._file.tell() >= self.max_bytes or time.time() - self._opened_at >= self.rotate_seconds:
+            self._rotate()
+        self._file.write("".join(json.dumps(r, default=str) + "\n" for r in records))
+        self._file.flush()
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+        # An existing file counts from when it was created, so restarts don't postpone rotation
+        self._opened_at = os.path.getctime(self.path) if self._file.tell() else time.time()
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S.%f")  # sorts in rotation order
+        os.replace(self.path, f"{self.path}.{stamp}")
+
+        folder, name = os.path.split(self.path)
+        backups = sorted(f for f in os.listdir(folder or ".") if f.startswith(name + "."))
+        for old in backups[:-self.backup_count] if self.backup_count else backups:
+            os.remove(os.path.join(folder, old))
+        self._open()
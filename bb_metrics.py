@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# bb_metrics.py
+import http.server
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+METRICS_PORT = 9108  # local Prometheus scrape endpoint, http://127.0.0.1:9108/metrics
+SUMMARY_INTERVAL = 300  # seconds between summary file rewrites
+RECENT_SAMPLES = 2048  # per series; percentiles are over the most recent samples
+QUANTILES = (0.5, 0.95, 0.99)
+
+STAGE_METRIC = "bb_stage_seconds"
+API_REQUEST_METRIC = "bb_api_request_seconds"
+
+_ID_SEGMENT = re.compile(r"^(\d+|[0-9a-fA-F-]{32,36})$")
+
+
+def endpoint_label(endpoint: str) -> str:
+    """Endpoint with ids replaced by :id, so /query/jobs/<uuid> is one series, not one per job."""
+    path = endpoint.split("?", 1)[0]
+    return "/".join(":id" if _ID_SEGMENT.match(part) else part for part in path.split("/"))
+
+
+def query_label(data) -> str:
+    """
+    Stage label for a request file's contents: the saved query id, or adhoc:<query_type_id>
+    for a generated query (adhoc:<query_type> for one given as a spec, as written).
+    """
+    if not isinstance(data, dict):
+        return "unknown"
+    if "id" in data:
+        return str(data["id"])
+    query = data.get("query") or data.get("spec") or {}
+    return f"adhoc:{query.get('query_type_id', query.get('query_type'))}"
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(q * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+class _Series:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+
+class Span:
+    """Timing of one with timed(...) block; seconds is set when the block exits."""
+    def __init__(self):
+        self.started = time.monotonic()
+        self.seconds: Optional[float] = None
+
+    @property
+    def duration_ms(self) -> float:
+        seconds = self.seconds if self.seconds is not None else time.monotonic() - self.started
+        return seconds * 1000
+
+
+class MetricsRegistry:
+    """
+    Latency distributions keyed by metric name and labels.
+
+    Each series keeps its count, sum and max since startup plus its RECENT_SAMPLES most
+    recent observations, which p50/p95/p99 are computed from. Series are exposed in the
+    Prometheus text format as summaries (name{quantile="0.95"}, name_sum, name_count).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], _Series] = {}
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None)))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series()
+            series.observe(seconds)
+
+    @contextmanager
+    def timed(self, name: str, **labels):
+        """
+        Time the block and record it under name with labels plus outcome="ok", or
+        outcome="error" if it raised. Yields a Span whose duration_ms can go into the log.
+        """
+        span = Span()
+        outcome = "error"
+        try:
+            yield span
+            outcome = "ok"
+        finally:
+            span.seconds = time.monotonic() - span.started
+            self.observe(name, span.seconds, outcome=outcome, **labels)
+
+    def snapshot(self) -> List[Dict]:
+        """One dict per series: name, labels, count, sum, max and the QUANTILES of recent samples."""
+        with self._lock:
+            items = [(name, labels, s.count, s.total, s.max, sorted(s.recent))
+                     for (name, labels), s in self._series.items()]
+        result = []
+        for name, labels, count, total, max_seconds, recent in sorted(items, key=lambda i: (i[0], i[1])):
+            entry = {"name": name, "labels": dict(labels), "count": count,
+                     "sum": round(total, 6), "max": round(max_seconds, 6)}
+            for q in QUANTILES:
+                entry[f"p{int(q * 100)}"] = round(percentile(recent, q), 6)
+            result.append(entry)
+        return result
+
+    def prometheus_text(self) -> str:
+        lines = []
+        typed = set()
+        for entry in self.snapshot():
+            name = entry["name"]
+            if name not in typed:
+                lines.append(f"# TYPE {name} summary")
+                typed.add(name)
+            labels = [f'{k}="{_escape(v)}"' for k, v in entry["labels"].items()]
+            for q in QUANTILES:
+                quantile_labels = ",".join(labels + [f'quantile="{q}"'])
+                lines.append(f"{name}{{{quantile_labels}}} {entry[f'p{int(q * 100)}']}")
+            label_text = "{" + ",".join(labels) + "}" if labels else ""
+            lines.append(f"{name}_sum{label_text} {entry['sum']}")
+            lines.append(f"{name}_count{label_text} {entry['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write_summary(self, path: str):
+        """Write the snapshot as JSON, replacing the previous summary atomically."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"written_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                       "series": self.snapshot()}, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def serve(self, port: int = METRICS_PORT, host: str = "127.0.0.1") -> http.server.ThreadingHTTPServer:
+        """Serve GET /metrics (Prometheus text) and GET /metrics.json from a daemon thread."""
+        registry = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, content_type = registry.prometheus_text().encode(), "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body, content_type = json.dumps(registry.snapshot()).encode(), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics_http", daemon=True).start()
+        return server
+
+    def write_summaries(self, path: str, interval: float = SUMMARY_INTERVAL) -> threading.Thread:
+        """Rewrite the summary file every interval seconds from a daemon thread."""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write_summary(path)
+                except OSError as e:
+                    print(f"Could not write metrics summary {path}: {e}")
+
+        thread = threading.Thread(target=run, name="metrics_summary", daemon=True)
+        thread.start()
+        return thread
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Process-wide registry; modules record into it without passing it around
+REGISTRY = MetricsRegistry()
+observe = REGISTRY.observe
+timed = REGISTRY.timed
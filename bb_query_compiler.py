@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# bb_query_compiler.py
+import json
+import threading
+from typing import Any, Dict, List, Optional
+
+from bb_field_catalog import FieldCatalog, get_catalog
+
+# Keys accepted for each part of an ad-hoc query field entry; the first is what compile_spec writes
+FIELD_ID_KEYS = ("query_field_id", "field_id", "id")
+NODE_ID_KEYS = ("node_id",)
+OPERATOR_KEYS = ("filter_operator", "operator")
+VALUE_KEYS = ("filter_values", "values")
+FIELD_LISTS = ("select_fields", "filter_fields", "sort_fields", "group_filter_fields")
+FILTER_LISTS = ("filter_fields", "group_filter_fields")
+
+# Concrete filter operators -> the allowed_filter_operators group that permits them
+OPERATOR_GROUPS = {
+    "Equals": "Equals",
+    "DoesNotEqual": "DoesNotEqual",
+    "NotEqual": "DoesNotEqual",
+    "OneOf": "OneOf",
+    "NotOneOf": "OneOf",
+    "OneOfEach": "OneOfEach",
+    "Blank": "Blank",
+    "NotBlank": "Blank",
+    "LessThan": "RelativeComparisons",
+    "LessThanOrEqual": "RelativeComparisons",
+    "LessThanOrEqualTo": "RelativeComparisons",
+    "GreaterThan": "RelativeComparisons",
+    "GreaterThanOrEqual": "RelativeComparisons",
+    "GreaterThanOrEqualTo": "RelativeComparisons",
+    "Between": "RelativeComparisons",
+    "NotBetween": "RelativeComparisons",
+    "BeginsWith": "StringComparisons",
+    "DoesNotBeginWith": "StringComparisons",
+    "Contains": "StringComparisons",
+    "DoesNotContain": "StringComparisons",
+    "EndsWith": "StringComparisons",
+    "DoesNotEndWith": "StringComparisons",
+    "SoundsLike": "SoundsLike",
+    "Ask": "Ask",
+}
+NO_VALUE_OPERATORS = {"Blank", "NotBlank", "Ask"}
+VALUE_TYPES = (str, int, float, bool)  # what a single filter value may be
+TWO_VALUE_OPERATORS = {"Between", "NotBetween"}
+
+
+class QueryValidationError(ValueError):
+    """Raised with every problem found in a generated query, before it is sent to the API."""
+    def __init__(self, problems: List[str]):
+        self.problems = problems
+        super().__init__("Invalid generated query:\n  " + "\n  ".join(problems))
+
+
+def _first(entry: Dict[str, Any], keys) -> Any:
+    for key in keys:
+        if key in entry:
+            return entry[key]
+    return None
+
+
+def _as_int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class QueryCompiler:
+    """
+    Check generated (ad-hoc) queries against the field catalog and build them from a
+    compact spec, so a typo'd field id or an operator the field doesn't allow is rejected
+    locally instead of as a failed job.
+
+    Each query type's fields are read from the catalog once and kept in memory, so
+    validating a query is only dictionary lookups.
+    """
+    def __init__(self, catalog: Optional[FieldCatalog] = None):
+        self.catalog = catalog or get_catalog()
+        self._lock = threading.Lock()
+        self._query_types: Optional[Dict[int, str]] = None
+        self._fields: Dict[int, Dict[int, List[Dict[str, Any]]]] = {}
+        self._nodes: Dict[int, set] = {}
+
+    def query_types(self) -> Dict[int, str]:
+        if self._query_types is None:
+            self._query_types = self.catalog.query_types()
+        return self._query_types
+
+    def fields_for(self, query_type_id: int) -> Dict[int, List[Dict[str, Any]]]:
+        """field id -> every occurrence of it (one per node) in the query type."""
+        fields = self._fields.get(query_type_id)
+        if fields is None:
+            with self._lock:
+                if query_type_id in self._fields:
+                    return self._fields[query_type_id]
+                fields = {}
+                for field in self.catalog.query_type_fields(query_type_id):
+                    fields.setdefault(field["id"], []).append(field)
+                self._nodes[query_type_id] = {f["node_id"] for occurrences in fields.values() for f in occurrences}
+                self._fields[query_type_id] = fields
+        return fields
+
+    def check(self, query: Dict[str, Any]) -> List[str]:
+        """Return a list of problems with a generated query's "query" object; empty if valid."""
+        if not isinstance(query, dict):
+            return ["'query' must be an object"]
+        qt_id = _as_int(query.get("query_type_id"))
+        if qt_id is None:
+            return ["'query_type_id' is missing or not a number"]
+        if qt_id not in self.query_types():
+            return [f"Unknown query_type_id {query.get('query_type_id')}"]
+
+        known = self.fields_for(qt_id)
+        problems = []
+        if not query.get("select_fields"):
+            problems.append("'select_fields' is empty")
+
+        for list_name in FIELD_LISTS:
+            entries = query.get(list_name) or []
+            if not isinstance(entries, list):
+                problems.append(f"'{list_name}' must be a list")
+                continue
+            for i, entry in enumerate(entries):
+                where = f"{list_name}[{i}]"
+                if not isinstance(entry, dict):
+                    problems.append(f"{where} must be an object")
+                    continue
+                field_id = _as_int(_first(entry, FIELD_ID_KEYS))
+                if field_id is None:
+                    problems.append(f"{where} has no field id ({'/'.join(FIELD_ID_KEYS)})")
+                    continue
+                occurrences = known.get(field_id)
+                if not occurrences:
+                    problems.append(f"{where}: field {field_id} is not in query type {qt_id}")
+                    continue
+
+                node_value = _first(entry, NODE_ID_KEYS)
+                if node_value is not None:
+                    node_id = _as_int(node_value)
+                    if node_id not in self._nodes[qt_id]:
+                        problems.append(f"{where}: node {node_value} is not in query type {qt_id}")
+                        continue
+                    occurrences = [f for f in occurrences if f["node_id"] == node_id]
+                    if not occurrences:
+                        problems.append(f"{where}: field {field_id} is not in node {node_id}")
+                        continue
+
+                if list_name in FILTER_LISTS:
+                    # Without a node_id the filter may apply to any occurrence, so each must allow it
+                    problems.extend(self._check_filter(where, entry, occurrences))
+        return problems
+
+    def _check_filter(self, where: str, entry: Dict[str, Any], occurrences: List[Dict[str, Any]]) -> List[str]:
+        operator = _first(entry, OPERATOR_KEYS)
+        if operator is None:
+            return [f"{where}: no filter operator ({'/'.join(OPERATOR_KEYS)})"]
+        if not isinstance(operator, str):
+            return [f"{where}: filter operator must be a string, got {type(operator).__name__}"]
+        group = OPERATOR_GROUPS.get(operator)
+        if group is None:
+            return [f"{where}: unknown filter operator '{operator}'"]
+        for field in occurrences:
+            if group not in field["allowed_filter_operators"]:
+                node = f" in node {field['node_id']}" if field["node_id"] is not None else ""
+                return [f"{where}: '{field['selected_name'] or field['name']}'{node} ({field['value_type']}) does not "
+                        f"allow {operator}; allowed: {', '.join(field['allowed_filter_operators']) or 'none'}"]
+
+        values = _first(entry, VALUE_KEYS)
+        if isinstance(values, list):
+            wrong = [v for v in values if not isinstance(v, VALUE_TYPES)]
+            if wrong:
+                return [f"{where}: filter values must be strings or numbers, got {type(wrong[0]).__name__}"]
+            count = len(values)
+        elif values is None or values == "":
+            count = 0
+        elif isinstance(values, VALUE_TYPES):
+            count = 1
+        else:
+            return [f"{where}: filter values must be a list of strings or numbers, got {type(values).__name__}"]
+        if operator in NO_VALUE_OPERATORS:
+            return []
+        if operator in TWO_VALUE_OPERATORS and count != 2:
+            return [f"{where}: {operator} needs exactly 2 values, got {count}"]
+        if count == 0:
+            return [f"{where}: {operator} needs a value"]
+        return []
+
+    def validate(self, query: Dict[str, Any]):
+        """Raise QueryValidationError listing every problem in the query."""
+        problems = self.check(query)
+        if problems:
+            raise QueryValidationError(problems)
+
+    def resolve_query_type(self, ref) -> int:
+        """Query type id from an id or a name (case-insensitive)."""
+        qt_id = _as_int(ref)
+        if qt_id is not None and qt_id in self.query_types():
+            return qt_id
+        for known_id, name in self.query_types().items():
+            if isinstance(ref, str) and name.lower() == ref.lower():
+                return known_id
+        raise QueryValidationError([f"Unknown query type '{ref}'"])
+
+    def resolve_field(self, query_type_id: int, ref) -> Dict[str, Any]:
+        """
+        Field from an id, a selected_name, or {"id"/"name": ..., "node": ...}. A name that matches
+        different field ids resolves to the query type's own field if there is one; otherwise
+        the node has to be given.
+        """
+        node = None
+        if isinstance(ref, dict):
+            node = _as_int(ref.get("node"))
+            ref = ref.get("id", ref.get("name"))
+
+        field_id = _as_int(ref)
+        if field_id is not None:
+            matches = self.fields_for(query_type_id).get(field_id, [])
+        else:
+            matches = self.catalog.fields_by_selected_name(str(ref), query_type_id)
+        if node is not None:
+            matches = [f for f in matches if f["node_id"] == node]
+        if not matches:
+            where = f" node {node} of" if node is not None else ""
+            suggestions = list(dict.fromkeys(f["selected_name"] for f in self.catalog.search(str(ref), query_type_id)))[:3]
+            hint = f"; did you mean {', '.join(suggestions)}?" if suggestions and field_id is None else ""
+            raise QueryValidationError([f"No field '{ref}' in{where} query type {query_type_id}{hint}"])
+
+        if len({f["id"] for f in matches}) > 1:
+            root = [f for f in matches if f["node_id"] is None]
+            if len(root) != 1:
+                options = ", ".join(f"{f['id']} (node {f['node_id']})" for f in matches)
+                raise QueryValidationError([f"Field '{ref}' is ambiguous in query type {query_type_id}: {options}"])
+            return root[0]
+        return matches[0]
+
+    def compile_spec(self, spec: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Build a generated query request from a compact spec:
+
+            {"query_type": "Gift",
+             "select": ["Gift Date", "Gift Amount", {"name": "Constituent ID", "node": 367}],
+             "where": [["Gift Date", "GreaterThan", "2024-01-01"], ["Gift Amount", "Between", 10, 100]],
+             "results_file_name": "gifts"}
+
+        Every other key of the spec (ux_mode, output_format, results_file_name, ...) is
+        copied to the request. The result is validated before it is returned.
+        """
+        qt_id = self.resolve_query_type(spec.get("query_type", spec.get("query_type_id")))
+
+        def field_ref(field):
+            # The field id alone identifies a field within its query type
+            return {FIELD_ID_KEYS[0]: field["id"]}
+
+        problems = []
+        select_fields, filter_fields = [], []
+        for ref in spec.get("select", []):
+            try:
+                select_fields.append(field_ref(self.resolve_field(qt_id, ref)))
+            except QueryValidationError as e:
+                problems.extend(e.problems)
+        for condition in spec.get("where", []):
+            if not isinstance(condition, (list, tuple)) or len(condition) < 2:
+                problems.append(f"where entry {condition!r} must be [field, operator, value...]")
+                continue
+            try:
+                entry = field_ref(self.resolve_field(qt_id, condition[0]))
+            except QueryValidationError as e:
+                problems.extend(e.problems)
+                continue
+            entry[OPERATOR_KEYS[0]] = condition[1]
+            entry[VALUE_KEYS[0]] = list(condition[2:])
+            filter_fields.append(entry)
+        if problems:
+            raise QueryValidationError(problems)
+
+        query = {"query_type_id": qt_id, "select_fields": select_fields}
+        if filter_fields:
+            query["filter_fields"] = filter_fields
+        request = {k: v for k, v in spec.items() if k not in ("query_type", "query_type_id", "select", "where")}
+        request["query"] = query
+        self.validate(query)
+        return request
+
+
+_compiler: Optional[QueryCompiler] = None
+_compiler_lock = threading.Lock()
+
+
+def get_compiler() -> QueryCompiler:
+    """Shared compiler over the default field catalog."""
+    global _compiler
+    with _compiler_lock:
+        if _compiler is None:
+            _compiler = QueryCompiler()
+        return _compiler
+
+
+def validate_query(query: Dict[str, Any]):
+    get_compiler().validate(query)
+
+
+def compile_query_spec(spec: Dict[str, Any]) -> Dict[str, Any]:
+    return get_compiler().compile_spec(spec)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Validate a generated query file, or compile one from a compact spec")
+    parser.add_argument("file", help="generated_query.json (with \"query\") or a spec (with \"spec\")")
+    parser.add_argument("--output", help="Write the compiled request here instead of printing it")
+    args = parser.parse_args()
+
+    with open(args.file, "r") as f:
+        data = json.load(f)
+    try:
+        if "query" in data:
+            validate_query(data["query"])
+            print(f"{args.file}: OK")
+        else:
+            request = compile_query_spec(data.get("spec", data))
+            if args.output:
+                with open(args.output, "w") as f:
+                    json.dump(request, f, indent=4)
+                print(f"Compiled request written to {args.output}")
+            else:
+                print(json.dumps(request, indent=4))
+    except QueryValidationError as e:
+        print(e)
+        raise SystemExit(1)
@@ -1,20 +1,15 @@
 #!/usr/bin/env python
 # bb_query.py
 import os
+import posixpath
 import time
 import json
 import shutil
-import glob
 import uuid
-import pysftp
-import requests
-import pandas as pd
 from datetime import datetime
-from pathlib import Path
 import sys
 import threading
-import warnings
-warnings.filterwarnings("ignore", message="Failed to load HostKeys")
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 sys.path.append(r"C:\Users\parish_report_py_file")
 from parish_report import ParishReport # type: ignore
 
@@ -25,12 +20,25 @@ if ROOT_DIR not in sys.path:
     sys.path.insert(0, ROOT_DIR)
 
 from bb_auth import BlackbaudAuth, RequestFailedException # type: ignore
+from bb_job_poller import JobStatusPoller, PollingTimeoutError # type: ignore
+from bb_download import download_blob # type: ignore
+from bb_archiver import Archiver # type: ignore
+from bb_folder_watcher import FolderWatcher # type: ignore
+from bb_log_sink import LogSink # type: ignore
+from bb_metrics import METRICS_PORT, REGISTRY, STAGE_METRIC, observe, query_label, timed # type: ignore
+from bb_request_scheduler import RequestScheduler, read_request # type: ignore
+from bb_email_enrichment import ImportIdIndex, enrich_csv # type: ignore
+from bb_query_compiler import compile_query_spec, get_compiler # type: ignore
+from bb_sftp_uploader import SFTP_POOL_SIZE, SftpConnectionPool, SftpUploader # type: ignore
+from bb_result_cache import RequestCoalescer, ResultCache, link_or_copy, request_key # type: ignore
 
 EXECUTE_ENDPOINT = "/query/queries/executebyid"
 EXECUTE_ADHOC_ENDPOINT = "/query/queries/execute"
 JOB_STATUS_ENDPOINT_TEMPLATE = "/query/jobs/{job_id}"
 MAX_POLLING_SECONDS = 604800  # 7 days
 POLL_INTERVAL = 8  # seconds
+MAX_POLL_INTERVAL = 120  # seconds, backoff cap for long-running jobs
+MAX_CONCURRENT_JOBS = 4  # request files processed in parallel
 
 # Standard required fields
 REQUIRED_FIELDS_STANDARD = ["id", "product", "module"]
@@ -42,18 +50,35 @@ OPTIONAL_FIELDS_STANDARD = [
 
 # Generated query required field
 REQUIRED_FIELD_GENERATED = "query"
+# A generated query file may give a compact spec instead, compiled by bb_query_compiler
+QUERY_SPEC_FIELD = "spec"
 OPTIONAL_FIELDS_GENERATED = [
     "ux_mode", "output_format", "formatting_mode", "results_file_name",
     "display_code_table_long_description", "time_zone_offset_in_minutes"
 ]
 
+# Opt-in: serve a cached result of the same request if it is at most this many minutes old
+MAX_STALENESS_FIELD = "max_staleness_minutes"
+
+# Request file fields read locally (scheduling, caching etc.) and never sent to the API
+LOCAL_ONLY_FIELDS = ["priority", MAX_STALENESS_FIELD]
+
+RESULT_EXTENSIONS = [".csv", ".json", ".txt"]  # anything else gets .csv appended
+
 BASE_DIR = r"E:\Report Data\API_report_query_request"
 
 REQUEST_FOLDER = os.path.join(BASE_DIR, "query_request")
 COMPLETED_FOLDER = os.path.join(BASE_DIR, "query_completed")
 FAILED_FOLDER = os.path.join(BASE_DIR, "query_failed")
 LOG_FOLDER = os.path.join(BASE_DIR, "api_log")
-ARCHIVE_FOLDER = os.path.join(COMPLETED_FOLDER, "archived")
+LOG_FILE = os.path.join(LOG_FOLDER, "api_log.jsonl")  # one JSON record per line, rotated by bb_log_sink
+METRICS_SUMMARY_FILE = os.path.join(LOG_FOLDER, "metrics_summary.json")  # p50/p95/p99 per stage, rewritten every 5 min
+ARCHIVE_FOLDER = os.path.join(COMPLETED_FOLDER, "archived")  # dated zip bundles of old completed files
+ARCHIVE_INDEX_FILE = os.path.join(BASE_DIR, "archive_index.sqlite")  # files waiting to be archived, and what each bundle holds
+RESULT_CACHE_FOLDER = os.path.join(BASE_DIR, "result_cache")  # must be on the volume results are downloaded to (the working directory)
+# Dropped next to the script with generated_query.json; upserted into IMPORT_ID_INDEX_FILE
+EMAIL_MAPPING_FILE = "email_to_importid_mapping.json"
+IMPORT_ID_INDEX_FILE = os.path.join(BASE_DIR, "email_to_importid.sqlite")
 
 # SFTP details (used for d1_file_import_id.json flows) Example: keyring_cli store --key "" --value "" --description ""
 
@@ -61,6 +86,25 @@ SFTP_HOST = "" # IP address
 SFTP_USERNAME = "" # username
 SFTP_PASSWORD = "" # password in keyring
 SFTP_REMOTE_DIR = "" # remote directory
+SFTP_PARALLEL_UPLOADS = SFTP_POOL_SIZE  # pooled connections, and uploads running at once
+SFTP_COMPRESSION = None  # "gzip" or "zstd" (needs zstandard) to upload <name>.csv.gz plus a manifest; None uploads the raw CSV
+
+# Shared state for concurrent workers
+_log_sink = None
+_log_sink_lock = threading.Lock()
+_archiver = None
+_archiver_lock = threading.Lock()
+_output_names_lock = threading.Lock()
+_output_names = {}  # local download name -> request file that claimed it
+_job_poller = None
+_job_poller_lock = threading.Lock()
+_result_cache = None
+_result_cache_lock = threading.Lock()
+_in_flight = RequestCoalescer()  # identical requests running right now share one job
+_import_id_index = None
+_import_id_index_lock = threading.Lock()
+_sftp_uploader = None
+_sftp_uploader_lock = threading.Lock()
 
 
 def ensure_folders_and_log():
@@ -70,37 +114,42 @@ def ensure_folders_and_log():
             os.makedirs(folder)
             folder_name = os.path.basename(folder)
 
-    # Ensure api_log.txt exists
-    log_file_path = os.path.join(LOG_FOLDER, "api_log.txt")
-    if not os.path.exists(log_file_path):
-        with open(log_file_path, "w") as f:
-            f.write("Log file created\n")
+    get_log_sink()
+
 
+def get_log_sink():
+    """Return the background writer for LOG_FILE, starting it on first use."""
+    global _log_sink
+    with _log_sink_lock:
+        if _log_sink is None:
+            _log_sink = LogSink(LOG_FILE)
+        return _log_sink
 
-def log_event(message, also_print=True):
-    timestamp = datetime.utcnow().strftime('%Y-%m-%d_%H:%M:%S:%f')[:23]
-    log_entry = f"{timestamp}\n{message}\n"
-    log_file = os.path.join(LOG_FOLDER, "api_log.txt")
-    with open(log_file, "a") as f:
-        f.write(log_entry + "\n")
+
+def log_event(message, also_print=True, **fields):
+    """Queue a record for LOG_FILE; keyword arguments that aren't None become fields of the record."""
+    record = {"message": message}
+    record.update((k, v) for k, v in fields.items() if v is not None)
+    get_log_sink().emit(record)
     if also_print:
         print(message)
 
 
-def animate_dots(stop_event, message_prefix):
-    dot_patterns = ["   ", ".  ", ".. ", "...", " ..", "  .", "   "]
-    dot_index = 0
-    
-    while not stop_event.is_set():
-        sys.stdout.write("\r" + " " * 80)  # Clear line with spaces
-        sys.stdout.write(f"\r{message_prefix}{dot_patterns[dot_index]}")
-        sys.stdout.flush()
-        
-
-        dot_index = (dot_index + 1) % len(dot_patterns)
-        
-       
-        time.sleep(0.3)
+def log_job(job_id, request_file, status, output_file=None, error_message=None,
+            stage=None, duration_ms=None, also_print=True):
+    """Log a step of a job: as separate fields in LOG_FILE, as format_job_message on the console."""
+    log_event(
+        status,
+        also_print=False,
+        job_id=job_id,
+        request_file=request_file,
+        stage=stage,
+        duration_ms=round(duration_ms, 1) if duration_ms is not None else None,
+        output_file=output_file,
+        error=error_message
+    )
+    if also_print:
+        print(format_job_message(job_id, request_file, status, output_file, error_message))
 
 
 def format_job_message(job_id, request_file, status, output_file=None, error_message=None):
@@ -124,12 +173,12 @@ def format_job_message(job_id, request_file, status, output_file=None, error_mes
     return "\n".join(message)
 
 
-def wait_for_new_json():
-    while True:
-        json_files = glob.glob(os.path.join(REQUEST_FOLDER, "*.json"))
-        if json_files:
-            return json_files[0]
-        time.sleep(5)
+def wait_for_new_json(watcher, timeout=None):
+    """Return the next fully written request file from the watcher, or None once timeout seconds pass."""
+    req_file = watcher.get(timeout)
+    if req_file and os.path.exists(req_file):
+        return req_file
+    return None
 
 
 def validate_standard_request_json(data):
@@ -141,9 +190,17 @@ def validate_standard_request_json(data):
 
 
 def validate_generated_query_json(data):
-    """ JSON data contains the 'query' field for an ad-hoc request."""
+    """ JSON data contains the 'query' field for an ad-hoc request, and its field ids, nodes and operators exist in the field catalog."""
     if REQUIRED_FIELD_GENERATED not in data:
         raise ValueError(f"Missing required field: {REQUIRED_FIELD_GENERATED}")
+    try:
+        compiler = get_compiler()
+        compiler.query_types()  # opens the catalog, compiling it from the JSON if that changed
+    except Exception as e:
+        # No usable catalog; let the API be the judge as before
+        log_event(f"Skipping field catalog validation: {e}")
+        return True
+    compiler.validate(data[REQUIRED_FIELD_GENERATED])
     return True
 
 
@@ -151,30 +208,136 @@ def generate_uuid():
     return str(uuid.uuid4())
 
 
+def reserve_output_name(req_file, file_name):
+    """Claim a local download name, prefixing it if another running job already holds it."""
+    with _output_names_lock:
+        if file_name in _output_names:
+            file_name = f"{generate_uuid()[:8]}_{file_name}"
+        _output_names[file_name] = req_file
+        return file_name
+
+
+def release_output_names(req_file):
+    with _output_names_lock:
+        for name in [n for n, owner in _output_names.items() if owner == req_file]:
+            del _output_names[name]
+
+
+def result_file_name(file_name):
+    # If file_name doesn't end in .csv/.json/.txt, default to .csv
+    if not any(file_name.lower().endswith(ext) for ext in RESULT_EXTENSIONS):
+        file_name += ".csv"
+    return file_name
+
+
 def download_file(url, file_name):
     try:
-        r = requests.get(url)
-        r.raise_for_status()
-        
-        # If file_name doesn't end in .csv/.json/.txt, default to .csv
-        if not any(file_name.lower().endswith(ext) for ext in [".csv", ".json", ".txt"]):
-            file_name += ".csv"
-            
-        with open(file_name, "wb") as f:
-            f.write(r.content)
+        file_name = result_file_name(file_name)
+
+        # Streams (or for large blobs, fetches byte ranges in parallel) and renames into place when complete
+        download_blob(url, file_name)
 
         return file_name
         
     except Exception as e:
-        log_event(format_job_message(
+        log_job(
             job_id=None,
             request_file="",
             status="Download failed",
             error_message=f"Error downloading file: {str(e)}"
-        ))
+        )
         return None
 
 
+def get_job_poller(auth):
+    """Return the poller shared by every worker, starting it on first use."""
+    global _job_poller
+    with _job_poller_lock:
+        if _job_poller is None:
+            _job_poller = JobStatusPoller(
+                auth,
+                endpoint_template=JOB_STATUS_ENDPOINT_TEMPLATE,
+                poll_interval=POLL_INTERVAL,
+                max_interval=MAX_POLL_INTERVAL,
+                max_seconds=MAX_POLLING_SECONDS
+            )
+        return _job_poller
+
+
+def get_result_cache():
+    """Return the result cache shared by every worker, opening it on first use."""
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache(RESULT_CACHE_FOLDER)
+            _result_cache.start()
+        return _result_cache
+
+
+def serve_cached_result(data, cache_key, req_file, file_name):
+    """
+    If the request sets max_staleness_minutes and an identical request's result is at most
+    that old, link it in as file_name instead of running a new job.
+    Returns (downloaded, job_id of the cached run), or (None, None).
+    """
+    max_staleness = data.get(MAX_STALENESS_FIELD)
+    if max_staleness is None:
+        return None, None
+    try:
+        max_staleness_seconds = float(max_staleness) * 60
+    except (TypeError, ValueError):
+        raise ValueError(f"'{MAX_STALENESS_FIELD}' must be a number of minutes")
+
+    cached = get_result_cache().get(cache_key, max_staleness_seconds)
+    if cached is None:
+        return None, None
+
+    downloaded = link_or_copy(cached["path"], result_file_name(file_name))
+    log_job(
+        job_id=cached["job_id"],
+        request_file=req_file,
+        status=f"Served from result cache ({cached['age_seconds'] / 60:.0f} min old)",
+        output_file=os.path.basename(downloaded)
+    )
+    return downloaded, cached["job_id"]
+
+
+def run_query_once(data, cache_key, req_file, output_name, run_query):
+    """
+    Run run_query() -> (downloaded, job_id), unless an identical request is already running;
+    then wait for that job and link its result in as output_name. The result is cached only
+    if the request sets max_staleness_minutes, i.e. it opted in to cached results.
+    """
+    downloaded, job_id, joined = _in_flight.run(cache_key, result_file_name(output_name), run_query)
+    if joined:
+        log_job(
+            job_id=job_id,
+            request_file=req_file,
+            status="Result shared from identical running request",
+            output_file=os.path.basename(downloaded)
+        )
+    elif data.get(MAX_STALENESS_FIELD) is not None:
+        cache_result(cache_key, downloaded, job_id)
+    return downloaded, job_id
+
+
+def cache_result(cache_key, downloaded, job_id):
+    """
+    Keep a downloaded result for later requests. Caching problems never fail the request; a
+    result downloaded to another volume than RESULT_CACHE_FOLDER can't be linked in and isn't cached.
+    """
+    try:
+        get_result_cache().put(cache_key, downloaded, job_id)
+    except Exception as e:
+        log_job(
+            job_id=job_id,
+            request_file="",
+            status="Result not cached",
+            error_message=str(e),
+            also_print=False
+        )
+
+
 def poll_job_status(auth, job_id, query_params):
 
     params = query_params.copy()
@@ -182,86 +345,60 @@ def poll_job_status(auth, job_id, query_params):
         "include_read_url": "OnceCompleted",
         "content_disposition": "Attachment"
     })
-    job_url = JOB_STATUS_ENDPOINT_TEMPLATE.format(job_id=job_id)
-    elapsed = 0
-    last_status = None
     
-    status_message = format_job_message(
+    log_job(
         job_id=job_id,
         request_file="",
-        status=f"Polling status every {POLL_INTERVAL} seconds..."
+        status=f"Polling status every {POLL_INTERVAL}-{MAX_POLL_INTERVAL} seconds...",
+        also_print=False
     )
-    
-    log_event(status_message, also_print=False)
-    status_line = f"Status: Polling status every {POLL_INTERVAL} seconds..."
-    
-    stop_animation = threading.Event()
-    animation_thread = threading.Thread(
-        target=animate_dots, 
-        args=(stop_animation, status_line)
-    )
-    animation_thread.daemon = True  
-    animation_thread.start()
-    
+
+    def on_status(polled_job_id, status):
+        log_job(
+            job_id=polled_job_id,
+            request_file="",
+            status=f"Job status: {status}",
+            also_print=False
+        )
+
+    future = get_job_poller(auth).submit(job_id, params, on_status=on_status)
     try:
-        while elapsed < MAX_POLLING_SECONDS:
-            response = auth.make_request(method="GET", endpoint=job_url, params=params, data=None)
-            if not response:
-                log_event(format_job_message(
-                    job_id=job_id,
-                    request_file="",
-                    status="Failed to get job status",
-                    error_message="No response from status endpoint"
-                ), also_print=False)  
-                return None
-                
-            status = response.get("status", "")
-            
-            if status != last_status:
-                last_status = status
-                if status != "Running" or elapsed == 0:
-                    log_event(format_job_message(
-                        job_id=job_id,
-                        request_file="",
-                        status=f"Job status: {status}"
-                    ), also_print=False)
-            
-            if status == "Completed":
-                return response
-            elif status in ["Failed", "Cancelled", "Throttled"]:
-                log_event(format_job_message(
-                    job_id=job_id,
-                    request_file="",
-                    status=f"Job failed with status: {status}",
-                    error_message=f"Job status: {status}"
-                ), also_print=False)
-                return response
-                
-            time.sleep(POLL_INTERVAL)
-            elapsed += POLL_INTERVAL
-            
-        log_event(format_job_message(
+        response = future.result()
+    except PollingTimeoutError as e:
+        log_job(
             job_id=job_id,
             request_file="",
             status="Polling timed out",
-            error_message=f"Exceeded maximum polling time of {MAX_POLLING_SECONDS} seconds"
-        ), also_print=False)
+            error_message=str(e),
+            also_print=False
+        )
         return None
-        
-    finally:
-        stop_animation.set()
-        animation_thread.join(timeout=1.0)
-        
-        sys.stdout.write("\r" + " " * 80)
-        sys.stdout.flush()
-        
-        if last_status:
-            final_message = f"Status: Job {last_status}"
-            sys.stdout.write(f"\r{final_message}\n")
-            sys.stdout.flush()
 
+    if not response:
+        log_job(
+            job_id=job_id,
+            request_file="",
+            status="Failed to get job status",
+            error_message="No response from status endpoint",
+            also_print=False
+        )
+        return None
 
-def post_standard_query_request(auth, data):
+    status = response.get("status", "")
+    if status in ["Failed", "Cancelled", "Throttled"]:
+        log_job(
+            job_id=job_id,
+            request_file="",
+            status=f"Job failed with status: {status}",
+            error_message=f"Job status: {status}",
+            also_print=False
+        )
+
+    print(f"Status: Job {status}")
+    return response
+
+
+def build_standard_query_request(data):
 
     query = {
         "product": data["product"],
@@ -273,6 +410,12 @@ def post_standard_query_request(auth, data):
     for field in OPTIONAL_FIELDS_STANDARD:
         if field in data:
             body[field] = data[field]
+    return query, body
+
+
+def post_standard_query_request(auth, data):
+
+    query, body = build_standard_query_request(data)
     response = auth.make_request(
         method="POST",
         endpoint=EXECUTE_ENDPOINT,
@@ -282,17 +425,24 @@ def post_standard_query_request(auth, data):
     return response, query, body
 
 
-def post_generated_query_request(auth, data):
+def build_generated_query_request(data):
 
     params = {
         "product": "RE",
         "module": "None"
     }
+    body = {k: v for k, v in data.items() if k not in LOCAL_ONLY_FIELDS}
+    return params, body
+
+
+def post_generated_query_request(auth, data):
+
+    params, body = build_generated_query_request(data)
     response = auth.make_request(
         method="POST",
         endpoint=EXECUTE_ADHOC_ENDPOINT,
         params=params,
-        data=data
+        data=body
     )
     return response, params
 
@@ -314,25 +464,28 @@ def process_parish_report(downloaded_csv_path):
         return None
 
 
+def get_sftp_uploader():
+    """Return the uploader shared by every worker; its connections stay open between files."""
+    global _sftp_uploader
+    with _sftp_uploader_lock:
+        if _sftp_uploader is None:
+            pool = SftpConnectionPool(SFTP_HOST, SFTP_USERNAME, SFTP_PASSWORD, size=SFTP_PARALLEL_UPLOADS)
+            _sftp_uploader = SftpUploader(pool, remote_dir=SFTP_REMOTE_DIR, workers=SFTP_PARALLEL_UPLOADS)
+        return _sftp_uploader
+
+
 def upload_and_archive_csv(local_file):
     base_name = os.path.basename(local_file)
-    cnopts = pysftp.CnOpts()
-    cnopts.hostkeys = None 
     try:
-        with pysftp.Connection(
-            host=SFTP_HOST,
-            username=SFTP_USERNAME,
-            password=SFTP_PASSWORD,
-            cnopts=cnopts
-        ) as sftp:
-            print(f"'{SFTP_HOST}' established.")
-            sftp.cwd(SFTP_REMOTE_DIR) 
-            folder_name = os.path.basename(SFTP_REMOTE_DIR)
-            remote_path = f"{folder_name}/{base_name}"
-            sftp.put(local_file, base_name) 
-
-            log_event(f"Uploaded: {base_name} to {folder_name}/{base_name}")
-            return True
+        result = get_sftp_uploader().upload(local_file, base_name, compression=SFTP_COMPRESSION)
+        remote_name = posixpath.basename(result["remote_path"])
+        folder_name = os.path.basename(SFTP_REMOTE_DIR)
+        resumed = f", resumed at {result['resumed_from']} bytes" if result["resumed_from"] else ""
+        compressed = (f" from {result['source_bytes']} ({result['rows']} rows, manifest {posixpath.basename(result['manifest_path'])})"
+                      if SFTP_COMPRESSION else "")
+        log_event(f"Uploaded: {base_name} to {folder_name}/{remote_name} "
+                  f"({result['bytes']} bytes{compressed} in {result['seconds']:.1f}s, verified by {result['verified']}{resumed})")
+        return True
     except Exception as e:
         msg = f"Error uploading '{base_name}' to SFTP: {e}"
         print(msg)
@@ -340,34 +493,37 @@ def upload_and_archive_csv(local_file):
         return False
 
 
+def get_import_id_index():
+    """Return the email -> ImportID index shared by every worker, opening it on first use."""
+    global _import_id_index
+    with _import_id_index_lock:
+        if _import_id_index is None:
+            _import_id_index = ImportIdIndex(IMPORT_ID_INDEX_FILE)
+        return _import_id_index
+
+
+def import_email_mapping():
+    """Upsert a newly dropped mapping file into the index. The file is moved away once its query completes."""
+    if not os.path.exists(EMAIL_MAPPING_FILE):
+        return 0
+    upserted = get_import_id_index().import_json(EMAIL_MAPPING_FILE)
+    log_event(f"Upserted {upserted} entries from {EMAIL_MAPPING_FILE} into the ImportID index")
+    return upserted
+
+
 def process_email_query_results(downloaded_file):
 
     try:
-        mapping_file = "email_to_importid_mapping.json"
-        if not os.path.exists(mapping_file):
-            return downloaded_file
-        
-        # Load the mapping
-        with open(mapping_file, 'r') as f:
-            email_to_importid_map = json.load(f)
-        
-        if not email_to_importid_map:
+        import_email_mapping()
+
+        index = get_import_id_index()
+        if not len(index):
             print("Warning: Email to ImportID mapping is empty.")
             return downloaded_file
 
-        df = pd.read_csv(downloaded_file)
-        
-        # Add ImportID column
-        df['ImportID'] = None
-        
-        # Map ImportIDs based on email matches in the Phone Number column
-        for i, row in df.iterrows():
-            phone_number = str(row.get('Phone Number', ''))
-            if '@' in phone_number and phone_number in email_to_importid_map:
-                df.at[i, 'ImportID'] = email_to_importid_map[phone_number]
-        
+        # Distinct emails of each chunk are looked up in the index; large files are streamed
         processed_file = f"processed_{os.path.basename(downloaded_file)}"
-        df.to_csv(processed_file, index=False)
+        enrich_csv(downloaded_file, processed_file, index)
         
         print(f"Results saved: {os.path.basename(processed_file)}")
         log_event(f"Appended ImportID to query results: {os.path.basename(processed_file)}")
@@ -389,13 +545,37 @@ def process_standard_query_file(auth, file_path):
 
     validate_standard_request_json(data)
 
-    log_event(format_job_message(
+    log_job(
         job_id=None,
         request_file=file_name,
         status="Processing"
-    ))
+    )
+
+    # Generate UUID for the file name
+    if os.path.basename(file_path) == "d1_file_import_id.json":
+        file_uuid = generate_uuid()
+        output_name = f"{file_uuid}.csv"
+    else:
+        output_name = reserve_output_name(file_path, data.get("results_file_name", "query_results"))
 
-    post_response, query_params, _ = post_standard_query_request(auth, data)
+    cache_key = request_key(EXECUTE_ENDPOINT, *build_standard_query_request(data))
+    downloaded, job_id = serve_cached_result(data, cache_key, file_name, output_name)
+    if not downloaded:
+        downloaded, job_id = run_query_once(
+            data, cache_key, file_name, output_name,
+            lambda: run_standard_query(auth, data, file_path, output_name)
+        )
+
+    return (file_path, downloaded, job_id)
+
+
+def run_standard_query(auth, data, file_path, output_name):
+    """Submit a saved query, wait for it if synchronous and download the result."""
+    file_name = os.path.basename(file_path)
+
+    query = query_label(data)
+    with timed(STAGE_METRIC, stage="submit", query=query) as span:
+        post_response, query_params, _ = post_standard_query_request(auth, data)
     if not post_response:
         raise Exception("No response from query request")
 
@@ -403,26 +583,32 @@ def process_standard_query_file(auth, file_path):
     if not job_id:
         raise Exception("Job ID not returned in response")
 
-    log_event(format_job_message(
+    log_job(
         job_id=job_id,
         request_file=file_name,
-        status="Job created"
-    ))
+        status="Job created",
+        stage="submit",
+        duration_ms=span.duration_ms
+    )
 
     if data.get("ux_mode", "Asynchronous") == "Synchronous":
-        log_event(format_job_message(
+        log_job(
             job_id=job_id,
             request_file=file_name,
-            status="Polling status every 8 seconds..."
-        ))
+            status=f"Polling status every {POLL_INTERVAL}-{MAX_POLL_INTERVAL} seconds..."
+        )
         
-        job_response = poll_job_status(auth, job_id, query_params)
+        # Mostly the server-side job; the status requests themselves show up under bb_api_request_seconds
+        with timed(STAGE_METRIC, stage="poll", query=query) as span:
+            job_response = poll_job_status(auth, job_id, query_params)
         
-        log_event(format_job_message(
+        log_job(
             job_id=job_id,
             request_file=file_name,
-            status="Polling Completed"
-        ))
+            status="Polling Completed",
+            stage="poll",
+            duration_ms=span.duration_ms
+        )
     else:
         job_response = post_response
 
@@ -433,27 +619,23 @@ def process_standard_query_file(auth, file_path):
     if not sas_uri:
         raise Exception("No SAS URI provided in job response")
 
-    # Generate UUID for the file name
-    if os.path.basename(file_path) == "d1_file_import_id.json":
-        file_uuid = generate_uuid()
-        file_name = f"{file_uuid}.csv"
-    else:
-        file_name = data.get("results_file_name", "query_results")
-
-    downloaded = download_file(sas_uri, file_name)
-    if not downloaded:
-        raise Exception("Download file not generated")
+    with timed(STAGE_METRIC, stage="download", query=query) as span:
+        downloaded = download_file(sas_uri, output_name)
+        if not downloaded:
+            raise Exception("Download file not generated")
 
     downloaded_basename = os.path.basename(downloaded)
 
-    log_event(format_job_message(
+    log_job(
         job_id=job_id,
         request_file=os.path.basename(file_path),
         status="File downloaded",
-        output_file=downloaded_basename
-    ))
+        output_file=downloaded_basename,
+        stage="download",
+        duration_ms=span.duration_ms
+    )
     
-    return (file_path, downloaded, job_id)
+    return downloaded, job_id
 
 
 def process_generated_query_file(auth, file_path):
@@ -463,15 +645,61 @@ def process_generated_query_file(auth, file_path):
     with open(file_path, "r") as f:
         data = json.load(f)
 
+    # Labelled from the file as dropped, like the queue and request stages
+    query = query_label(data)
+    if REQUIRED_FIELD_GENERATED not in data and QUERY_SPEC_FIELD in data:
+        spec = data.pop(QUERY_SPEC_FIELD)
+        data = {**data, **compile_query_spec(spec)}
+
     validate_generated_query_json(data)
 
-    log_event(format_job_message(
+    log_job(
         job_id=None,
         request_file=file_name,
         status="Processing"
-    ))
+    )
+
+    # If it's "d1_file_import_id.json", override file name with a UUID
+    if os.path.basename(file_path) == "d1_file_import_id.json":
+        output_name = generate_uuid()
+    else:
+        output_name = reserve_output_name(file_path, data.get("results_file_name", "query_results"))
 
-    post_response, query_params = post_generated_query_request(auth, data)
+    cache_key = request_key(EXECUTE_ADHOC_ENDPOINT, *build_generated_query_request(data))
+    downloaded, job_id = serve_cached_result(data, cache_key, file_name, output_name)
+    if not downloaded:
+        downloaded, job_id = run_query_once(
+            data, cache_key, file_name, output_name,
+            lambda: run_generated_query(auth, data, file_path, output_name, query)
+        )
+
+    # If this is an email query, process the results to append ImportID
+    if os.path.basename(file_path) == "generated_query.json":
+        with timed(STAGE_METRIC, stage="enrich", query=query) as span:
+            processed_file = process_email_query_results(downloaded)
+        if processed_file != downloaded:
+            processed_basename = os.path.basename(processed_file)
+            
+            log_job(
+                job_id=job_id,
+                request_file=os.path.basename(file_path),
+                status="File processed with ImportID",
+                output_file=processed_basename,
+                stage="enrich",
+                duration_ms=span.duration_ms
+            )
+            
+            return processed_file, job_id
+    
+    return downloaded, job_id
+
+
+def run_generated_query(auth, data, file_path, output_name, query):
+    """Submit a generated query, wait for it if synchronous and download the result. query is its stage label."""
+    file_name = os.path.basename(file_path)
+
+    with timed(STAGE_METRIC, stage="submit", query=query) as span:
+        post_response, query_params = post_generated_query_request(auth, data)
     if not post_response:
         raise Exception("No response from request")
 
@@ -479,27 +707,33 @@ def process_generated_query_file(auth, file_path):
     if not job_id:
         raise Exception("Job ID not returned in generated query response")
 
-    log_event(format_job_message(
+    log_job(
         job_id=job_id,
         request_file=file_name,
-        status="Job created"
-    ))
+        status="Job created",
+        stage="submit",
+        duration_ms=span.duration_ms
+    )
 
     if data.get("ux_mode", "Asynchronous") == "Synchronous":
 
-        log_event(format_job_message(
+        log_job(
             job_id=job_id,
             request_file=file_name,
-            status="Polling status every 8 seconds..."
-        ))
+            status=f"Polling status every {POLL_INTERVAL}-{MAX_POLL_INTERVAL} seconds..."
+        )
         
-        job_response = poll_job_status(auth, job_id, query_params)
+        # Mostly the server-side job; the status requests themselves show up under bb_api_request_seconds
+        with timed(STAGE_METRIC, stage="poll", query=query) as span:
+            job_response = poll_job_status(auth, job_id, query_params)
         
-        log_event(format_job_message(
+        log_job(
             job_id=job_id,
             request_file=file_name,
-            status="Polling Completed"
-        ))
+            status="Polling Completed",
+            stage="poll",
+            duration_ms=span.duration_ms
+        )
     else:
         job_response = post_response
 
@@ -510,79 +744,48 @@ def process_generated_query_file(auth, file_path):
     if not sas_uri:
         raise Exception("No SAS URI provided in job response")
 
-    # If it's "d1_file_import_id.json", override file name with a UUID
-    if os.path.basename(file_path) == "d1_file_import_id.json":
-        file_name = generate_uuid()
-    else:
-        file_name = data.get("results_file_name", "query_results")
-
-    downloaded = download_file(sas_uri, file_name)
-    if not downloaded:
-        raise Exception("Download file not generated")
+    with timed(STAGE_METRIC, stage="download", query=query) as span:
+        downloaded = download_file(sas_uri, output_name)
+        if not downloaded:
+            raise Exception("Download file not generated")
 
     downloaded_basename = os.path.basename(downloaded)
     
-    log_event(format_job_message(
+    log_job(
         job_id=job_id,
         request_file=os.path.basename(file_path),
         status="File downloaded",
-        output_file=downloaded_basename
-    ))
-    
-    # If this is an email query, process the results to append ImportID
-    if os.path.basename(file_path) == "generated_query.json":
-        processed_file = process_email_query_results(downloaded)
-        if processed_file != downloaded:
-            processed_basename = os.path.basename(processed_file)
-            
-            log_event(format_job_message(
-                job_id=job_id,
-                request_file=os.path.basename(file_path),
-                status="File processed with ImportID",
-                output_file=processed_basename
-            ))
-            
-            return processed_file, job_id
+        output_file=downloaded_basename,
+        stage="download",
+        duration_ms=span.duration_ms
+    )
     
     return downloaded, job_id
 
 
-def archive_old_files():
+def get_archiver():
+    """Return the archiver of COMPLETED_FOLDER, opening its index on first use."""
+    global _archiver
+    with _archiver_lock:
+        if _archiver is None:
+            _archiver = Archiver([COMPLETED_FOLDER], ARCHIVE_FOLDER, ARCHIVE_INDEX_FILE, report=log_event)
+        return _archiver
 
-    now = time.time()
-    threshold = 6 * 24 * 60 * 60
-    Path(ARCHIVE_FOLDER).mkdir(exist_ok=True, parents=True)
-    files_archived = 0
-    
+
+def register_for_archive(*paths):
+    """Queue files just moved into place for the scheduled archiver; a failure here never fails the job."""
     try:
-        for filename in os.listdir(COMPLETED_FOLDER):
-            file_path = os.path.join(COMPLETED_FOLDER, filename)
-            if filename.lower().endswith('.json') or os.path.isdir(file_path):
-                continue
-                
-            try:
-                mod_time = os.path.getmtime(file_path)
-                file_age = now - mod_time
-                age_days = file_age / (24 * 60 * 60)
-                                
-                if file_age > threshold:
-                    date_prefix = datetime.fromtimestamp(mod_time).strftime('%Y-%m-%d_')
-                    new_filename = date_prefix + filename
-                    archive_path = os.path.join(ARCHIVE_FOLDER, new_filename)
-                    
-                    if os.path.exists(archive_path):
-                        unique_id = str(uuid.uuid4())[:8]
-                        new_filename = f"{date_prefix}{unique_id}_{filename}"
-                        archive_path = os.path.join(ARCHIVE_FOLDER, new_filename)
-                    
-                    shutil.move(file_path, archive_path)
-                    files_archived += 1
-            except Exception as e:
-                print(f"  ERROR with file {filename}: {str(e)}")
+        get_archiver().register(paths)
     except Exception as e:
-        print(f"Error listing directory: {str(e)}")
+        log_event(f"Could not register {', '.join(os.path.basename(p) for p in paths if p)} for archiving: {e}")
+
 
-    return files_archived
+def start_archiver():
+    """Register anything that arrived while the processor wasn't running, then archive on a schedule."""
+    archiver = get_archiver()
+    registered = archiver.scan()
+    log_event(f"Archiver started, {registered} completed file(s) registered")
+    archiver.start()
 
 
 def move_processed_files(src_json, downloaded_file, success=True, job_id=None):
@@ -601,166 +804,227 @@ def move_processed_files(src_json, downloaded_file, success=True, job_id=None):
         dest_file = os.path.join(dest_folder, downloaded_name)
         shutil.move(downloaded_file, dest_file)
         destination_file = dest_file
+        register_for_archive(dest_file)
     
-    log_event(format_job_message(
+    log_job(
         job_id=job_id,
         request_file=src_json_name,
         status=status,
         output_file=downloaded_name
-    ))
+    )
     
     return destination_file
 
 
-def main():
-    ensure_folders_and_log()
-
-    auth = BlackbaudAuth()
-    log_event("Starting query processor... \nMonitoring folder 'query_request'")
+def process_request_file(auth, req_file):
+    """Run one request file through submit, poll, download and post-processing."""
+    req_file_name = os.path.basename(req_file)
+    query = query_label(read_request(req_file))
+    log_event(f"New request file: {req_file_name}\n", request_file=req_file_name, stage="start")
+    started = time.monotonic()
+    outcome = "error"
 
-    while True:
-        try:
-            req_file = wait_for_new_json()
-            req_file_name = os.path.basename(req_file)
-            log_event(f"New request file: {req_file_name}\n")
+    downloaded_file = None
+    job_id = None
+    
+    try:
+        filename_only = os.path.basename(req_file)
+        
+        if filename_only == "generated_query.json":
+            # Process generated query
+            downloaded_file, job_id = process_generated_query_file(auth, req_file)
+            move_processed_files(req_file, downloaded_file, success=True, job_id=job_id)
             
-            downloaded_file = None
-            job_id = None
+            # Also move the mapping file if it exists; its entries are already in the ImportID index
+            mapping_file = EMAIL_MAPPING_FILE
+            if os.path.exists(mapping_file):
+                dest_mapping = os.path.join(COMPLETED_FOLDER, mapping_file)
+                shutil.move(mapping_file, dest_mapping)
+                log_job(
+                    job_id=job_id,
+                    request_file=mapping_file,
+                    status="Moved mapping file"
+                )
             
-            try:
-                filename_only = os.path.basename(req_file)
+        elif filename_only == "parish_trans_report.json":
+            # Process parish report JSON
+            json_file, downloaded_csv, job_id = process_standard_query_file(auth, req_file)
+            
+            # Generate the parish report Excel file
+            log_job(
+                job_id=job_id, 
+                request_file=filename_only,
+                status="Generating parish report"
+            )
+            
+            with timed(STAGE_METRIC, stage="parish_report", query=query):
+                excel_report = process_parish_report(downloaded_csv)
+            
+            if excel_report and os.path.exists(excel_report):
+                dest_json = os.path.join(COMPLETED_FOLDER, os.path.basename(req_file))
+                shutil.move(req_file, dest_json)
                 
-                if filename_only == "generated_query.json":
-                    # Process generated query
-                    downloaded_file, job_id = process_generated_query_file(auth, req_file)
-                    move_processed_files(req_file, downloaded_file, success=True, job_id=job_id)
-                    
-                    # Also move the mapping file if it exists
-                    mapping_file = "email_to_importid_mapping.json"
-                    if os.path.exists(mapping_file):
-                        dest_mapping = os.path.join(COMPLETED_FOLDER, mapping_file)
-                        shutil.move(mapping_file, dest_mapping)
-                        log_event(format_job_message(
-                            job_id=job_id,
-                            request_file=mapping_file,
-                            status="Moved mapping file"
-                        ))
-                    
-                elif filename_only == "parish_trans_report.json":
-                    # Process parish report JSON
-                    json_file, downloaded_csv, job_id = process_standard_query_file(auth, req_file)
-                    
-                    # Generate the parish report Excel file
-                    log_event(format_job_message(
-                        job_id=job_id, 
-                        request_file=filename_only,
-                        status="Generating parish report"
-                    ))
-                    
-                    excel_report = process_parish_report(downloaded_csv)
-                    
-                    if excel_report and os.path.exists(excel_report):
-                        dest_json = os.path.join(COMPLETED_FOLDER, os.path.basename(req_file))
-                        shutil.move(req_file, dest_json)
-                        
-                        excel_name = os.path.basename(excel_report)
-                        dest_excel = os.path.join(COMPLETED_FOLDER, excel_name)
-                        shutil.move(excel_report, dest_excel)
-                        
-                        csv_name = os.path.basename(downloaded_csv)
-                        dest_csv = os.path.join(ARCHIVE_FOLDER, csv_name)
-                        shutil.move(downloaded_csv, dest_csv)
-                        
-                        log_event(format_job_message(
-                            job_id=job_id,
-                            request_file=os.path.basename(req_file),
-                            status="Complete",
-                            output_file=f"{excel_name}\n"
-                        ))
-                    else:
-                        move_processed_files(req_file, downloaded_csv, success=False, job_id=job_id)
+                excel_name = os.path.basename(excel_report)
+                dest_excel = os.path.join(COMPLETED_FOLDER, excel_name)
+                shutil.move(excel_report, dest_excel)
                 
-                elif filename_only == "d1_file_import_id.json":
-                    # Existing d1_file_import_id.json logic
-                    json_file, downloaded_file, job_id = process_standard_query_file(auth, req_file)
-                    
-                    log_event(format_job_message(
-                        job_id=job_id,
-                        request_file=filename_only,
-                        status="Uploading to SFTP",
-                        output_file=os.path.basename(downloaded_file)
-                    ))
-                    
-                    upload_success = upload_and_archive_csv(downloaded_file)
-                    
-                    if upload_success:
-                        # Only move files if upload was successful
-                        move_processed_files(req_file, downloaded_file, success=True, job_id=job_id)
-                    else:
-                        if os.path.exists(downloaded_file):
-                            move_processed_files(req_file, downloaded_file, success=False, job_id=job_id)
-                        else:
-                            move_processed_files(req_file, None, success=False, job_id=job_id)
-                else:
-                    # Normal flow for other files
-                    json_file, downloaded_file, job_id = process_standard_query_file(auth, req_file)
-                    move_processed_files(req_file, downloaded_file, success=True, job_id=job_id)
-
-                # After all processing is complete, run the archive function
-                try:
-                    archive_count = archive_old_files()
-                    if archive_count > 0:
-                        log_event(f"Archived {archive_count} old files")
-                except Exception as e:
-                    log_event(f"Archive process error: {str(e)}", also_print=True)
-
-            except RequestFailedException as ex:
-                error_msg = f"HTTP Error: {ex.status_code}\nResponse Error: {ex.error_text}"
-                log_event(format_job_message(
-                    job_id=job_id,
-                    request_file=req_file_name,
-                    status="FAILED",
-                    error_message=error_msg
-                ))
+                csv_name = os.path.basename(downloaded_csv)
+                dest_csv = os.path.join(ARCHIVE_FOLDER, csv_name)
+                shutil.move(downloaded_csv, dest_csv)
+                register_for_archive(dest_excel, dest_csv)
                 
-                if os.path.exists(req_file):
+                log_job(
+                    job_id=job_id,
+                    request_file=os.path.basename(req_file),
+                    status="Complete",
+                    output_file=f"{excel_name}\n"
+                )
+            else:
+                move_processed_files(req_file, downloaded_csv, success=False, job_id=job_id)
+        
+        elif filename_only == "d1_file_import_id.json":
+            # Existing d1_file_import_id.json logic
+            json_file, downloaded_file, job_id = process_standard_query_file(auth, req_file)
+            
+            log_job(
+                job_id=job_id,
+                request_file=filename_only,
+                status="Uploading to SFTP",
+                output_file=os.path.basename(downloaded_file)
+            )
+            
+            with timed(STAGE_METRIC, stage="upload", query=query):
+                upload_success = upload_and_archive_csv(downloaded_file)
+            
+            if upload_success:
+                # Only move files if upload was successful
+                move_processed_files(req_file, downloaded_file, success=True, job_id=job_id)
+            else:
+                if os.path.exists(downloaded_file):
+                    move_processed_files(req_file, downloaded_file, success=False, job_id=job_id)
+                else:
                     move_processed_files(req_file, None, success=False, job_id=job_id)
+        else:
+            # Normal flow for other files
+            json_file, downloaded_file, job_id = process_standard_query_file(auth, req_file)
+            move_processed_files(req_file, downloaded_file, success=True, job_id=job_id)
+        outcome = "ok"
+
+    except RequestFailedException as ex:
+        error_msg = f"HTTP Error: {ex.status_code}\nResponse Error: {ex.error_text}"
+        log_job(
+            job_id=job_id,
+            request_file=req_file_name,
+            status="FAILED",
+            error_message=error_msg
+        )
+        
+        if os.path.exists(req_file):
+            move_processed_files(req_file, None, success=False, job_id=job_id)
+
+    except Exception as e:
+        import traceback
+        error_msg = str(e)
+        trace_msg = traceback.format_exc()
+        
+        log_job(
+            job_id=job_id,
+            request_file=req_file_name,
+            status="FAILED",
+            error_message=error_msg
+        )
+        
+        # traceback
+        log_event(f"Traceback for {req_file_name}:\n{trace_msg}")
+        
+        if os.path.exists(req_file):
+            move_processed_files(req_file, None, success=False, job_id=job_id)
+    finally:
+        release_output_names(req_file)
+        seconds = time.monotonic() - started
+        observe(STAGE_METRIC, seconds, stage="request", query=query, outcome=outcome)
+        log_job(
+            job_id=job_id,
+            request_file=req_file_name,
+            status="Request finished",
+            stage="request",
+            duration_ms=seconds * 1000,
+            also_print=False
+        )
+
+    log_event("Monitoring 'query_request' folder\n")
+
+
+def start_metrics(port=METRICS_PORT):
+    """Serve stage and API latencies on http://127.0.0.1:<port>/metrics and keep METRICS_SUMMARY_FILE current."""
+    if port:
+        try:
+            REGISTRY.serve(port)
+            log_event(f"Metrics at http://127.0.0.1:{port}/metrics")
+        except OSError as e:
+            log_event(f"Metrics endpoint not started on port {port}: {e}")
+    REGISTRY.write_summaries(METRICS_SUMMARY_FILE)
+
+
+def main(max_workers=MAX_CONCURRENT_JOBS, metrics_port=METRICS_PORT):
+    ensure_folders_and_log()
+    start_metrics(metrics_port)
+    start_archiver()
+
+    auth = BlackbaudAuth()
+    log_event(f"Starting query processor ({max_workers} worker(s))... \nMonitoring folder 'query_request'")
+
+    in_flight = {}
+    watcher = FolderWatcher(REQUEST_FOLDER, patterns=("*.json",)).start()
+    scheduler = RequestScheduler()
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="query_job") as executor:
+        while True:
+            try:
+                for done_file in [f for f, fut in in_flight.items() if fut.done()]:
+                    in_flight.pop(done_file)
+                    scheduler.finish(done_file)
+
+                # Queue everything that has arrived so priorities are compared across all of it.
+                # Short timeout so finished jobs free their slot promptly
+                req_file = wait_for_new_json(watcher, timeout=1)
+                while req_file:
+                    if not scheduler.add(req_file):
+                        log_event(f"{os.path.basename(req_file)} arrived again while its previous run is finishing; "
+                                  "it will run after that")
+                    req_file = wait_for_new_json(watcher, timeout=0)
+
+                while len(in_flight) < max_workers:
+                    req_file = scheduler.next_ready()
+                    if not req_file:
+                        break
+                    in_flight[req_file] = executor.submit(process_request_file, auth, req_file)
+
+                if len(in_flight) >= max_workers:
+                    wait(list(in_flight.values()), return_when=FIRST_COMPLETED)
 
             except Exception as e:
+                # Catch-all for errors that could occur outside the request processing
                 import traceback
-                error_msg = str(e)
+                error_msg = f"Critical error in main loop: {str(e)}"
                 trace_msg = traceback.format_exc()
-                
-                log_event(format_job_message(
-                    job_id=job_id,
-                    request_file=req_file_name,
-                    status="FAILED",
-                    error_message=error_msg
-                ))
-                
-                # traceback
-                log_event(f"Traceback for {req_file_name}:\n{trace_msg}")
-                
-                if os.path.exists(req_file):
-                    move_processed_files(req_file, None, success=False, job_id=job_id)
-            
-            log_event("Monitoring 'query_request' folder\n")
-            
-        except Exception as e:
-            # Catch-all for errors that could occur outside the request processing
-            import traceback
-            error_msg = f"Critical error in main loop: {str(e)}"
-            trace_msg = traceback.format_exc()
-            log_event(error_msg)
-            log_event(f"Traceback:\n{trace_msg}")
-            
-            time.sleep(5)
-            # Continue the loop rather than crashing
-            log_event("Recovering from error. \nMonitoring for new files in 'query_request' folder\n")
-            continue
-            
-        time.sleep(2)
+                log_event(error_msg)
+                log_event(f"Traceback:\n{trace_msg}")
+
+                time.sleep(5)
+                # Continue the loop rather than crashing
+                log_event("Recovering from error. \nMonitoring for new files in 'query_request' folder\n")
+                continue
 
 
 if __name__ == "__main__":
-    main()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Process Blackbaud query request files")
+    parser.add_argument("--workers", type=int, default=MAX_CONCURRENT_JOBS,
+                        help="Number of request files processed concurrently")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Port of the local Prometheus metrics endpoint (0 to disable)")
+    args = parser.parse_args()
+
+    main(max_workers=max(1, args.workers), metrics_port=args.metrics_port)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# bb_request_scheduler.py
+import json
+import os
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from bb_metrics import STAGE_METRIC, observe, query_label
+
+DEFAULT_PRIORITY = 0
+# Request files that get a higher default when they don't set "priority" themselves
+FILE_PRIORITIES = {
+    "d1_file_import_id.json": 100,  # SFTP import feed has an SLA
+}
+AGE_PROMOTION_SECONDS = 300  # every 5 minutes of waiting adds 1 to a request's priority
+DEFAULT_GROUP_LIMIT = 3  # running requests per (product, module) unless listed below
+GROUP_LIMITS: Dict[Tuple[str, str], int] = {}
+
+
+class _QueuedRequest:
+    def __init__(self, path, priority, group, query, seq):
+        self.path = path
+        self.priority = priority
+        self.group = group
+        self.query = query
+        self.seq = seq
+        self.queued_at = time.monotonic()
+
+    def effective_priority(self, now: float, age_promotion_seconds: float) -> float:
+        return self.priority + (now - self.queued_at) / age_promotion_seconds
+
+
+def read_request(path: str) -> Dict[str, Any]:
+    """A request file's JSON object, or {} if it can't be read (it fails later in processing)."""
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def read_request_meta(path: str) -> Tuple[float, Tuple[str, str], str]:
+    """
+    Return (priority, (product, module), stage label) for a request file. Generated queries
+    have no product/module and run as RE/None. Unreadable files get the defaults and fail
+    later in processing like they always have.
+    """
+    data = read_request(path)
+
+    priority = data.get("priority", FILE_PRIORITIES.get(os.path.basename(path), DEFAULT_PRIORITY))
+    try:
+        priority = float(priority)
+    except (TypeError, ValueError):
+        priority = DEFAULT_PRIORITY
+    group = (str(data.get("product", "RE")), str(data.get("module", "None")))
+    return priority, group, query_label(data)
+
+
+class RequestScheduler:
+    """
+    Decide which queued request file runs next.
+
+    Highest effective priority wins, where effective priority is the request's "priority"
+    field (or FILE_PRIORITIES / DEFAULT_PRIORITY) plus one point per AGE_PROMOTION_SECONDS
+    spent waiting, so low-priority requests still get their turn. Requests whose
+    (product, module) group is already at its concurrency limit are skipped until one of
+    that group finishes. Ties go to the file that arrived first. A file added again while
+    its previous run is still finishing is queued once that run finishes.
+    """
+    def __init__(self, group_limits: Optional[Dict[Tuple[str, str], int]] = None,
+                 default_group_limit: Optional[int] = DEFAULT_GROUP_LIMIT,
+                 age_promotion_seconds: float = AGE_PROMOTION_SECONDS):
+        self.group_limits = dict(GROUP_LIMITS if group_limits is None else group_limits)
+        self.default_group_limit = default_group_limit
+        self.age_promotion_seconds = age_promotion_seconds
+        self._queued: Dict[str, _QueuedRequest] = {}
+        self._running: Dict[str, Tuple[str, str]] = {}
+        self._running_per_group: Dict[Tuple[str, str], int] = {}
+        self._rerun = set()  # paths dropped again while running; queued by finish()
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._queued)
+
+    def add(self, path: str) -> bool:
+        """
+        Queue a request file. A file that is already queued is ignored. One that is running
+        is a new file dropped under the same name (the old one has already been moved out),
+        so it is queued when the running one finishes. Returns False in that case.
+        """
+        if path in self._queued:
+            return True
+        if path in self._running:
+            self._rerun.add(path)
+            return False
+        self._queue(path)
+        return True
+
+    def _queue(self, path: str):
+        priority, group, query = read_request_meta(path)
+        self._seq += 1
+        self._queued[path] = _QueuedRequest(path, priority, group, query, self._seq)
+
+    def _has_capacity(self, group: Tuple[str, str]) -> bool:
+        limit = self.group_limits.get(group, self.default_group_limit)
+        return limit is None or self._running_per_group.get(group, 0) < limit
+
+    def next_ready(self) -> Optional[str]:
+        """Pop and mark running the best request that may start now, or None."""
+        now = time.monotonic()
+        best = None
+        best_key = None
+        for request in list(self._queued.values()):
+            if not os.path.exists(request.path):
+                del self._queued[request.path]
+                continue
+            if not self._has_capacity(request.group):
+                continue
+            key = (-request.effective_priority(now, self.age_promotion_seconds), request.seq)
+            if best_key is None or key < best_key:
+                best, best_key = request, key
+        if best is None:
+            return None
+
+        del self._queued[best.path]
+        # Wait in query_request/ from the moment the file was ready until a worker took it
+        observe(STAGE_METRIC, now - best.queued_at, stage="queue", query=best.query, outcome="ok")
+        self._running[best.path] = best.group
+        self._running_per_group[best.group] = self._running_per_group.get(best.group, 0) + 1
+        return best.path
+
+    def finish(self, path: str):
+        """Release the group slot held by a request started with next_ready."""
+        group = self._running.pop(path, None)
+        if group is not None:
+            self._running_per_group[group] -= 1
+        if path in self._rerun:
+            self._rerun.discard(path)
+            if os.path.exists(path):
+                self._queue(path)
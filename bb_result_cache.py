@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# bb_result_cache.py
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+RESULT_CACHE_TTL_SECONDS = 24 * 60 * 60  # entries older than this are never served and get purged
+RESULT_CACHE_MAX_BYTES = 5 * 1024 ** 3  # least recently used results are evicted beyond this
+RESULT_CACHE_PURGE_INTERVAL = 60 * 60  # seconds between purges of expired results by start()
+# Request keys that only name or deliver the output, not what the query returns
+NON_RESULT_FIELDS = ("results_file_name", "ux_mode")
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    job_id TEXT
+);
+CREATE INDEX IF NOT EXISTS results_by_last_used ON results (last_used);
+"""
+
+
+def _normalize(value):
+    """Sort lists of objects (e.g. ask_fields) so their order doesn't change the key."""
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, list):
+        items = [_normalize(v) for v in value]
+        if all(isinstance(v, dict) for v in items):
+            items.sort(key=lambda v: json.dumps(v, sort_keys=True))
+        return items
+    return value
+
+
+def request_key(endpoint: str, params: Optional[Dict[str, Any]], body: Dict[str, Any]) -> str:
+    """Hash identifying what a query request returns, ignoring key order and output naming."""
+    body = {k: v for k, v in body.items() if k not in NON_RESULT_FIELDS}
+    canonical = json.dumps({"endpoint": endpoint, "params": params or {}, "body": _normalize(body)},
+                           sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def link_or_copy(src: str, dest: str) -> str:
+    """Hard link src to dest, copying instead across volumes or where links aren't supported."""
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+    return dest
+
+
+class ResultCache:
+    """
+    Downloaded query results on disk, keyed by request_key.
+
+    An SQLite index in the cache folder records each result's size, when it was produced
+    and when it was last served. get() only returns a result younger than both the caller's
+    max staleness and RESULT_CACHE_TTL_SECONDS; put() evicts least recently used results
+    once the folder holds more than RESULT_CACHE_MAX_BYTES. Results are only ever hard linked
+    in, so caching never doubles disk use: put() fails for a file on another volume than the
+    cache folder. Expired results are purged as results are added, and by start() between
+    additions, so the cache doesn't keep the data of files removed elsewhere alive for long.
+    """
+    def __init__(self, folder: str, max_bytes: int = RESULT_CACHE_MAX_BYTES,
+                 ttl_seconds: float = RESULT_CACHE_TTL_SECONDS):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        with self._index() as conn:
+            conn.executescript(INDEX_SCHEMA)
+
+    @contextmanager
+    def _index(self):
+        """Connection to the index, committed and closed on exit."""
+        conn = sqlite3.connect(os.path.join(self.folder, "index.sqlite"), timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _path(self, file_name: str) -> str:
+        return os.path.join(self.folder, file_name)
+
+    def get(self, key: str, max_staleness_seconds: float) -> Optional[Dict[str, Any]]:
+        """
+        The cached result for key if it was produced within max_staleness_seconds, as a dict
+        with path, job_id and age_seconds; otherwise None.
+        """
+        now = time.time()
+        oldest = now - min(max_staleness_seconds, self.ttl_seconds)
+        with self._lock, self._index() as conn:
+            row = conn.execute("SELECT file_name, created_at, job_id FROM results WHERE key = ? AND created_at >= ?",
+                               (key, oldest)).fetchone()
+            if row is None:
+                return None
+            file_name, created_at, job_id = row
+            path = self._path(file_name)
+            if not os.path.exists(path):
+                conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key))
+        return {"path": path, "job_id": job_id, "age_seconds": now - created_at}
+
+    def put(self, key: str, src_path: str, job_id: Optional[str] = None) -> str:
+        """
+        Store a downloaded result under key, replacing any older one, and enforce the size bound.
+        Raises OSError if src_path can't be hard linked into the cache folder.
+        """
+        file_name = key + os.path.splitext(src_path)[1]
+        path = self._path(file_name)
+        now = time.time()
+        with self._lock:
+            if os.path.exists(path):
+                os.remove(path)
+            os.link(src_path, path)
+            with self._index() as conn:
+                conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                             (key, file_name, os.path.getsize(path), now, now, job_id))
+            self._evict()
+        return path
+
+    def _evict(self):
+        """Drop expired results, then least recently used ones until the cache fits max_bytes."""
+        cutoff = time.time() - self.ttl_seconds
+        with self._index() as conn:
+            rows = conn.execute("SELECT key, file_name, size, created_at FROM results ORDER BY last_used").fetchall()
+            total = sum(size for _, _, size, _ in rows)
+            for key, file_name, size, created_at in rows:
+                if created_at >= cutoff and total <= self.max_bytes:
+                    continue
+                try:
+                    os.remove(self._path(file_name))
+                except FileNotFoundError:
+                    pass
+                conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                total -= size
+
+    def purge_expired(self):
+        with self._lock:
+            self._evict()
+
+    def start(self, interval: float = RESULT_CACHE_PURGE_INTERVAL) -> threading.Thread:
+        """Purge expired results now and then every interval seconds from a daemon thread."""
+        def run():
+            while True:
+                try:
+                    self.purge_expired()
+                except Exception:
+                    pass  # retried on the next run, or by the next put()
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, name="result_cache_purge", daemon=True)
+        thread.start()
+        return thread
+
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.copies: List[str] = []  # output names of the requests that joined this run
+        self.delivered: Dict[str, Any] = {}  # output name -> linked path, or the error linking it
+        self.job_id: Optional[str] = None
+        self.error: Optional[BaseException] = None
+
+
+class RequestCoalescer:
+    """
+    Lets identical requests that overlap share one job.
+
+    The first caller for a key runs the query; callers arriving with the same key while it
+    is still running register the output name they want and wait. When the run finishes,
+    its result is hard linked (or copied) to every registered name, so each request still
+    ends up with its own file. If the run fails, every waiting caller gets the same error.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running: Dict[str, _InFlight] = {}
+
+    def run(self, key: str, output_name: str,
+            run_query: Callable[[], Tuple[str, Optional[str]]]) -> Tuple[str, Optional[str], bool]:
+        """
+        Return (path, job_id, joined). run_query() -> (downloaded path, job_id) is only called
+        if no identical request is running; otherwise its result is linked to output_name
+        and joined is True.
+        """
+        with self._lock:
+            flight = self._running.get(key)
+            joined = flight is not None
+            if joined:
+                flight.copies.append(output_name)
+            else:
+                flight = self._running[key] = _InFlight()
+
+        if joined:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            delivered = flight.delivered[output_name]
+            if isinstance(delivered, BaseException):
+                raise delivered
+            return delivered, flight.job_id, True
+
+        try:
+            downloaded, job_id = run_query()
+        except BaseException as e:
+            with self._lock:
+                del self._running[key]
+            flight.error = e
+            flight.done.set()
+            raise
+
+        # Nobody can join once the key is gone, so the copies list is final
+        with self._lock:
+            del self._running[key]
+        for name in flight.copies:
+            try:
+                flight.delivered[name] = link_or_copy(downloaded, name)
+            except OSError as e:
+                flight.delivered[name] = e
+        flight.job_id = job_id
+        flight.done.set()
+        return downloaded, job_id, False
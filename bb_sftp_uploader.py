@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+# bb_sftp_uploader.py
+import hashlib
+import json
+import os
+import posixpath
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, Optional
+
+import paramiko
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional
+    zstandard = None
+
+SFTP_PORT = 22
+SFTP_POOL_SIZE = 3  # persistent connections, and uploads running at once
+SFTP_KEEPALIVE_SECONDS = 30  # keeps idle pooled connections from being dropped by firewalls/servers
+SFTP_CONNECT_TIMEOUT = 30
+SFTP_WINDOW_SIZE = 16 * 1024 ** 2  # SSH flow-control window; paramiko's 2 MB default stalls on high-latency links
+SFTP_MAX_PACKET_SIZE = 256 * 1024
+SFTP_WRITE_BLOCK = 1024 ** 2  # bytes handed to each pipelined write
+SFTP_UPLOAD_RETRIES = 3  # reconnect and resume this many times before giving up
+PARTIAL_SUFFIX = ".part"  # files are uploaded under this suffix and renamed once verified
+MANIFEST_SUFFIX = ".manifest.json"  # written next to a compressed upload, after it is in place
+
+# compression -> (extension, default level)
+COMPRESSIONS = {"gzip": (".gz", 6), "zstd": (".zst", 3)}
+
+HASH_BLOCK = 1024 ** 2
+
+
+def file_sha256(f) -> str:
+    digest = hashlib.sha256()
+    for block in iter(lambda: f.read(HASH_BLOCK), b""):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+class UploadVerificationError(IOError):
+    """Raised when the uploaded file doesn't match the local one."""
+
+
+class CsvRowCounter:
+    """Counts CSV records in a byte stream fed in blocks, ignoring newlines inside quoted fields."""
+    def __init__(self):
+        self.records = 0
+        self._in_quotes = False
+        self._last_byte = b""
+
+    def feed(self, block: bytes):
+        if not block:
+            return
+        if not self._in_quotes and b'"' not in block:
+            self.records += block.count(b"\n")
+        else:
+            # Pieces between quotes alternate outside/inside; an escaped "" is an empty piece, so parity holds
+            for piece in block.split(b'"'):
+                if not self._in_quotes:
+                    self.records += piece.count(b"\n")
+                self._in_quotes = not self._in_quotes
+            self._in_quotes = not self._in_quotes  # split gives one more piece than there are quotes
+        self._last_byte = block[-1:]
+
+    @property
+    def data_rows(self) -> int:
+        """Records after the header line, counting a last line without a trailing newline."""
+        records = self.records + (1 if self._last_byte not in (b"", b"\n") else 0)
+        return max(0, records - 1)
+
+
+class CompressedCsv:
+    """
+    A CSV compressed on the fly, block by block, with no compressed copy on disk. Rows and
+    sha256 of both the source and the compressed stream are tallied as blocks go by. The
+    output is deterministic (gzip without mtime/filename; single-threaded zstd), so an
+    interrupted upload can be resumed by compressing again and skipping what was sent.
+    """
+    def __init__(self, path: str, compression: str, level: Optional[int] = None):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression '{compression}'; use one of {', '.join(COMPRESSIONS)}")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package (pip install zstandard)")
+        self.path = path
+        self.compression = compression
+        self.extension, default_level = COMPRESSIONS[compression]
+        self.level = default_level if level is None else level
+        self.rows = 0
+        self.source_bytes = 0
+        self.source_sha256 = None
+        self.bytes = 0
+        self.sha256 = None
+
+    def _compressor(self):
+        if self.compression == "gzip":
+            return zlib.compressobj(self.level, zlib.DEFLATED, 31)  # wbits 31: gzip header, mtime 0
+        return zstandard.ZstdCompressor(level=self.level).compressobj()
+
+    def blocks(self) -> Iterator[bytes]:
+        compressor = self._compressor()
+        counter = CsvRowCounter()
+        source_hash, compressed_hash = hashlib.sha256(), hashlib.sha256()
+        self.source_bytes = self.bytes = 0
+        with open(self.path, "rb") as src:
+            for block in iter(lambda: src.read(SFTP_WRITE_BLOCK), b""):
+                counter.feed(block)
+                source_hash.update(block)
+                self.source_bytes += len(block)
+                out = compressor.compress(block)
+                if out:
+                    compressed_hash.update(out)
+                    self.bytes += len(out)
+                    yield out
+        out = compressor.flush()
+        if out:
+            compressed_hash.update(out)
+            self.bytes += len(out)
+            yield out
+        self.rows = counter.data_rows
+        self.source_sha256 = source_hash.hexdigest()
+        self.sha256 = compressed_hash.hexdigest()
+
+    def manifest(self, remote_name: str) -> Dict[str, Any]:
+        return {
+            "file": remote_name,
+            "source_file": os.path.basename(self.path),
+            "compression": self.compression,
+            "rows": self.rows,
+            "source_bytes": self.source_bytes,
+            "source_sha256": self.source_sha256,
+            "bytes": self.bytes,
+            "sha256": self.sha256,
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        }
+
+
+class _PooledConnection:
+    def __init__(self, transport: paramiko.Transport, sftp: paramiko.SFTPClient):
+        self.transport = transport
+        self.sftp = sftp
+
+    def is_alive(self) -> bool:
+        return self.transport.is_active()
+
+    def close(self):
+        try:
+            self.sftp.close()
+        finally:
+            self.transport.close()
+
+
+class SftpConnectionPool:
+    """
+    Up to `size` authenticated SFTP sessions, reused across uploads.
+
+    Connections are opened on demand, kept alive with SSH keepalives while idle and
+    replaced if they die. Sessions use a larger flow-control window and packet size than
+    paramiko's defaults, so pipelined writes aren't throttled waiting for window updates.
+    Host keys aren't checked, as with the pysftp CnOpts(hostkeys=None) this replaces.
+    """
+    def __init__(self, host: str, username: str, password: str, port: int = SFTP_PORT,
+                 size: int = SFTP_POOL_SIZE, keepalive_seconds: int = SFTP_KEEPALIVE_SECONDS,
+                 window_size: int = SFTP_WINDOW_SIZE, max_packet_size: int = SFTP_MAX_PACKET_SIZE,
+                 connect_timeout: float = SFTP_CONNECT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.keepalive_seconds = keepalive_seconds
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.connect_timeout = connect_timeout
+        self._idle = queue.LifoQueue()  # most recently used first, so spare connections can time out
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+
+    def _connect(self) -> _PooledConnection:
+        transport = paramiko.Transport((self.host, self.port), default_window_size=self.window_size,
+                                       default_max_packet_size=self.max_packet_size)
+        try:
+            transport.banner_timeout = self.connect_timeout
+            transport.connect(username=self.username, password=self.password)
+            transport.set_keepalive(self.keepalive_seconds)
+            sftp = paramiko.SFTPClient.from_transport(transport, window_size=self.window_size,
+                                                      max_packet_size=self.max_packet_size)
+        except Exception:
+            transport.close()
+            raise
+        return _PooledConnection(transport, sftp)
+
+    def _checkout(self) -> _PooledConnection:
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if conn.is_alive():
+                return conn
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow an SFTPClient. It goes back to the pool if the block succeeds; after an error
+        it is closed, since the session may be in an unknown state.
+        """
+        if self._closed:
+            raise RuntimeError("SftpConnectionPool has been closed")
+        with self._slots:
+            conn = self._checkout()
+            try:
+                yield conn.sftp
+            except BaseException:
+                conn.close()
+                raise
+            if self._closed:
+                conn.close()
+            else:
+                self._idle.put(conn)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class SftpUploader:
+    """
+    Queue of uploads run `workers` at a time over a SftpConnectionPool.
+
+    Each file is written as <name>.part with pipelined writes, then renamed to <name> once
+    its size matches (and, for resumed uploads, its sha256). If a transfer is interrupted,
+    the next attempt, on a fresh connection, continues from the size of the .part file
+    on the server. A later upload of the same file also continues from there.
+
+    With compression ("gzip", or "zstd" if zstandard is installed) the file is compressed
+    while it is sent, uploaded as <name>.gz / <name>.zst, and followed by
+    <name>.gz.manifest.json with the row count and sha256 of the source and of the upload.
+    The manifest only appears once the compressed file is in place.
+    """
+    def __init__(self, pool: SftpConnectionPool, remote_dir: str = "", workers: int = SFTP_POOL_SIZE,
+                 retries: int = SFTP_UPLOAD_RETRIES):
+        self.pool = pool
+        self.remote_dir = remote_dir
+        self.retries = retries
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sftp_upload")
+
+    def submit(self, local_path: str, remote_name: Optional[str] = None,
+               compression: Optional[str] = None) -> Future:
+        """Queue an upload; the future resolves with upload()'s result or raises its error."""
+        source = CompressedCsv(local_path, compression) if compression else None  # bad settings fail here
+        remote_name = remote_name or os.path.basename(local_path)
+        if source:
+            remote_name += source.extension
+        return self._executor.submit(self._upload_with_retries, local_path, remote_name, source)
+
+    def upload(self, local_path: str, remote_name: Optional[str] = None,
+               compression: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Upload and wait. Returns remote_path, bytes (total size uploaded), sent (bytes actually
+        transferred), resumed_from, verified ("size" or "sha256") and seconds. Compressed
+        uploads also return source_bytes, rows and manifest_path.
+        """
+        return self.submit(local_path, remote_name, compression).result()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.pool.close()
+
+    def _upload_with_retries(self, local_path: str, remote_name: str,
+                             source: Optional[CompressedCsv]) -> Dict[str, Any]:
+        attempt = 0
+        restarted = False
+        while True:
+            try:
+                with self.pool.connection() as sftp:
+                    return self._upload(sftp, local_path, remote_name, source)
+            except UploadVerificationError:
+                # The bad .part has been removed; one clean upload from the start, then give up
+                if restarted:
+                    raise
+                restarted = True
+            except (OSError, EOFError, paramiko.SSHException):
+                if attempt >= self.retries:
+                    raise
+                time.sleep(min(2 ** attempt, 30))
+                attempt += 1
+
+    def _upload(self, sftp: paramiko.SFTPClient, local_path: str, remote_name: str,
+                source: Optional[CompressedCsv]) -> Dict[str, Any]:
+        started = time.monotonic()
+        remote_path = posixpath.join(self.remote_dir, remote_name) if self.remote_dir else remote_name
+        partial_path = remote_path + PARTIAL_SUFFIX
+
+        try:
+            offset = sftp.stat(partial_path).st_size
+        except FileNotFoundError:
+            offset = 0
+        if source is None and offset > os.path.getsize(local_path):
+            offset = 0  # left over from a different file of the same name
+
+        with sftp.open(partial_path, "r+b" if offset else "wb", bufsize=SFTP_WRITE_BLOCK) as dst:
+            # Don't wait for each write's acknowledgement; errors surface at close()
+            dst.set_pipelined(True)
+            dst.seek(offset)
+            for block in self._blocks(local_path, source, offset):
+                dst.write(block)
+
+        size = source.bytes if source else os.path.getsize(local_path)
+        remote_size = sftp.stat(partial_path).st_size
+        verified = "size"
+        problem = None
+        if remote_size != size:
+            problem = f"remote size {remote_size} != local size {size}"
+        elif offset:
+            # The part written by an earlier attempt can't be trusted by size alone
+            verified = "sha256"
+            if source:
+                local_hash = source.sha256
+            else:
+                with open(local_path, "rb") as f:
+                    local_hash = file_sha256(f)
+            with sftp.open(partial_path, "rb", bufsize=HASH_BLOCK) as f:
+                f.prefetch(size)
+                remote_hash = file_sha256(f)
+            if remote_hash != local_hash:
+                problem = f"sha256 of resumed upload differs ({remote_hash} != {local_hash})"
+        if problem:
+            sftp.remove(partial_path)  # the next upload starts clean
+            raise UploadVerificationError(f"Upload of {local_path} to {partial_path} failed verification: {problem}")
+        self._replace(sftp, partial_path, remote_path)
+
+        result = {"remote_path": remote_path, "bytes": size, "sent": size - offset, "resumed_from": offset,
+                  "verified": verified}
+        if source:
+            manifest_path = remote_path + MANIFEST_SUFFIX
+            with sftp.open(manifest_path + PARTIAL_SUFFIX, "w") as f:
+                f.write(json.dumps(source.manifest(remote_name), indent=2))
+            self._replace(sftp, manifest_path + PARTIAL_SUFFIX, manifest_path)
+            result.update(source_bytes=source.source_bytes, rows=source.rows, manifest_path=manifest_path)
+        result["seconds"] = time.monotonic() - started
+        return result
+
+    @staticmethod
+    def _blocks(local_path: str, source: Optional[CompressedCsv], offset: int) -> Iterator[bytes]:
+        """Bytes of the upload from offset on."""
+        if source is None:
+            with open(local_path, "rb") as src:
+                src.seek(offset)
+                yield from iter(lambda: src.read(SFTP_WRITE_BLOCK), b"")
+            return
+        # A compressed stream can't be seeked: compress from the start and drop what was already sent
+        for block in source.blocks():
+            if offset >= len(block):
+                offset -= len(block)
+                continue
+            yield block[offset:] if offset else block
+            offset = 0
+
+    @staticmethod
+    def _replace(sftp: paramiko.SFTPClient, src: str, dest: str):
+        try:
+            sftp.posix_rename(src, dest)
+        except IOError:
+            # Servers without the posix-rename extension refuse to replace an existing file
+            try:
+                sftp.remove(dest)
+            except FileNotFoundError:
+                pass
+            sftp.rename(src, dest)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# bench_bb_auth.py
+"""
+Requests/sec of BlackbaudAuth.make_request vs AsyncBlackbaudAuth.make_request against a
+local stub of the SKY API. Keyring is swapped for an in-memory stub so only the HTTP
+path is measured; nothing is sent to Blackbaud. --latency-ms adds a server-side delay
+per request to stand in for the round trip to api.sky.blackbaud.com (0 measures raw
+loopback overhead, where the single-process stub itself becomes the bottleneck).
+
+    python bench_bb_auth.py --requests 2000 --concurrency 20 --latency-ms 25
+"""
+import argparse
+import asyncio
+import http.server
+import json
+import threading
+import time
+
+import bb_auth
+from bb_auth import BlackbaudAuth, RateLimitGovernor
+from bb_auth_async import AsyncBlackbaudAuth
+
+STUB_RESPONSE = json.dumps({"id": "00000000-0000-0000-0000-000000000000", "status": "Running"}).encode()
+STUB_LATENCY_SECONDS = 0.0
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """Answers every GET with a small job-status body over a keep-alive connection."""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body are separate writes; avoid delayed-ACK stalls on reused sockets
+
+    def do_GET(self):
+        if STUB_LATENCY_SECONDS:
+            time.sleep(STUB_LATENCY_SECONDS)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(STUB_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(STUB_RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StubKeyring:
+    """Stands in for secure_keyring so the benchmark never reads or writes real secrets."""
+    values = {
+        "tokens.access_token": "bench-token",
+        "tokens.refresh_token": "bench-refresh",
+        "other.api_subscription_key": "bench-key",
+        # Far enough out that the background refresh never fires during a run
+        "tokens.expires_at": str(time.time() + 3600),
+    }
+
+    def get_password(self, key):
+        return self.values.get(key)
+
+    def set_password(self, key, value, description=None):
+        pass
+
+
+def unthrottled_governor():
+    """The stub has no rate limit; keep the governor from capping the numbers being measured."""
+    return RateLimitGovernor(rate=1e9, burst=1e9, daily_quota=None)
+
+
+def bench_sync(total):
+    auth = BlackbaudAuth()
+    auth.governor = unthrottled_governor()
+    try:
+        auth.make_request("GET", "/query/jobs/bench")  # open the pool before timing
+        start = time.perf_counter()
+        for _ in range(total):
+            auth.make_request("GET", "/query/jobs/bench")
+        return total / (time.perf_counter() - start)
+    finally:
+        auth.close()
+
+
+async def bench_async(total, concurrency):
+    auth = AsyncBlackbaudAuth(max_connections=concurrency)
+    auth.governor = unthrottled_governor()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await auth.make_request("GET", "/query/jobs/bench")
+
+    try:
+        await auth.make_request("GET", "/query/jobs/bench")  # open the pool before timing
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(total)))
+        return total / (time.perf_counter() - start)
+    finally:
+        await auth.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sync vs async SKY API request paths against a local stub")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per run")
+    parser.add_argument("--concurrency", type=int, default=20, help="Concurrent requests for the async client")
+    parser.add_argument("--latency-ms", type=float, default=25, help="Simulated server round trip per request")
+    args = parser.parse_args()
+
+    global STUB_LATENCY_SECONDS
+    STUB_LATENCY_SECONDS = args.latency_ms / 1000
+
+    server = start_stub_server()
+    bb_auth.API_BASE_URL = f"http://127.0.0.1:{server.server_address[1]}"
+    bb_auth.secure_keyring = StubKeyring()
+    bb_auth.CLIENT_ID = bb_auth.CLIENT_ID or "bench-client"
+    bb_auth.CLIENT_SECRET = bb_auth.CLIENT_SECRET or "bench-secret"
+    try:
+        sync_rps = bench_sync(args.requests)
+        async_rps = asyncio.run(bench_async(args.requests, args.concurrency))
+    finally:
+        server.shutdown()
+
+    print(f"BlackbaudAuth.make_request (sequential): {sync_rps:10.1f} req/s")
+    print(f"AsyncBlackbaudAuth.make_request (pooled, {args.concurrency} concurrent): {async_rps:10.1f} req/s")
+    print(f"Speedup: {async_rps / sync_rps:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ import logging
 import requests
 from datetime import datetime
 import keyring
+from bb_folder_watcher import FolderWatcher
 
 # Constants and configuration
 SERVICE_NAME = "GlobalSecrets"
@@ -84,12 +85,12 @@ def send_pushover_notification(title, message, files):
         return False
 
 
-def check_for_new_files():
-    """Check for new files in the COMPLETED_FOLDER and send notifications."""
+def check_for_new_files(filenames=None):
+    """Check for new files in the COMPLETED_FOLDER and send notifications. Lists the folder unless filenames are given."""
     processed_files = load_processed_files()
     
     new_files = []
-    for filename in os.listdir(COMPLETED_FOLDER):
+    for filename in (os.listdir(COMPLETED_FOLDER) if filenames is None else filenames):
         file_path = os.path.join(COMPLETED_FOLDER, filename)
         
         # Skip directories (like the "archived" folder) and already processed files
@@ -113,15 +114,22 @@ def check_for_new_files():
 
 
 def run_as_daemon():
-    """Run as a daemon process, checking periodically for new files."""
+    """Run as a daemon process, notifying as soon as new files land in COMPLETED_FOLDER."""
     logger.info("Starting Pushover notification daemon...")
+    watcher = FolderWatcher(COMPLETED_FOLDER, include_existing=False).start()
+    
+    # Catch up on anything that arrived while the daemon wasn't running
+    check_for_new_files()
     
     while True:
         try:
-            check_for_new_files()
-            time.sleep(60)  # Check every minute
+            # Files finished together go out in one notification
+            new_paths = watcher.get_batch(timeout=60)
+            if new_paths:
+                check_for_new_files([os.path.basename(p) for p in new_paths])
         except KeyboardInterrupt:
             logger.info("Notification daemon stopped by user")
+            watcher.stop()
             break
         except Exception as e:
             logger.error(f"Error in notification daemon: {str(e)}")
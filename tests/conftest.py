@@ -0,0 +1,30 @@
+import importlib.util
+import os
+import sys
+import types
+
+# The scripts live at the repository root and import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _fake_secure_keyring():
+    module = types.ModuleType("secure_keyring")
+    module.store = {}
+    module.get_password = lambda key: module.store.get(key)
+    module.set_password = lambda key, value, description=None: module.store.__setitem__(key, value)
+    return module
+
+
+def _fake_keyring():
+    module = types.ModuleType("keyring")
+    module.store = {}
+    module.get_password = lambda service, username: module.store.get((service, username))
+    module.set_password = lambda service, username, password: module.store.__setitem__((service, username), password)
+    return module
+
+
+# bb_auth imports the audited secure_keyring wrapper (and keyring) at load time. Neither is
+# installed outside the production machines, so the tests run against in-memory fakes.
+for _name, _fake in (("secure_keyring", _fake_secure_keyring), ("keyring", _fake_keyring)):
+    if importlib.util.find_spec(_name) is None:
+        sys.modules[_name] = _fake()
@@ -0,0 +1,211 @@
+import os
+import time
+import zipfile
+from datetime import datetime, timedelta
+
+import pytest
+
+from bb_archiver import Archiver
+
+DAY = 24 * 60 * 60
+NOW = datetime(2024, 6, 30, 12).timestamp()
+
+
+@pytest.fixture
+def folders(tmp_path):
+    completed = tmp_path / "query_completed"
+    completed.mkdir()
+    return completed, tmp_path / "query_completed" / "archived"
+
+
+def make_archiver(folders, tmp_path, **kwargs):
+    completed, archive = folders
+    return Archiver([str(completed)], str(archive), str(tmp_path / "archive_index.sqlite"),
+                    report=lambda message: None, **kwargs)
+
+
+def completed_file(folder, name, days_old, content=None):
+    path = folder / name
+    path.write_bytes(content if content is not None else name.encode() * 100)
+    mtime = NOW - days_old * DAY
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def members(bundle):
+    with zipfile.ZipFile(bundle) as zf:
+        return {name: zf.read(name) for name in zf.namelist()}
+
+
+def archive_day(days_old):
+    return (datetime.fromtimestamp(NOW) - timedelta(days=days_old)).strftime("%Y-%m-%d") + ".zip"
+
+
+def test_old_files_are_bundled_by_day_and_removed(folders, tmp_path):
+    completed, archive = folders
+    old = completed_file(completed, "gifts.csv", 10)
+    report = completed_file(completed, "report.xlsx", 10)
+    older = completed_file(completed, "older.csv", 12)
+    recent = completed_file(completed, "recent.csv", 1)
+    request = completed_file(completed, "gifts.json", 10)
+    archiver = make_archiver(folders, tmp_path)
+    assert archiver.scan() == 4
+
+    assert archiver.run_once(NOW) == {"archived": 3, "bytes_in": 2900, "bundles_deleted": 0}
+    bundle = archive / archive_day(10)
+    assert members(bundle) == {"gifts.csv": b"gifts.csv" * 100, "report.xlsx": b"report.xlsx" * 100}
+    with zipfile.ZipFile(bundle) as zf:
+        assert zf.getinfo("report.xlsx").compress_type == zipfile.ZIP_STORED
+    assert not old.exists() and not report.exists() and not older.exists()
+    assert recent.exists() and request.exists()
+    assert sorted(os.listdir(archive)) == [archive_day(12), archive_day(10)]
+
+    found = archiver.find("gifts.csv")
+    assert [(f["bundle"], f["member"], f["source_path"]) for f in found] == [(archive_day(10), "gifts.csv", str(old))]
+
+
+def test_later_files_are_added_to_the_existing_bundle(folders, tmp_path):
+    completed, archive = folders
+    archiver = make_archiver(folders, tmp_path)
+    archiver.register([str(completed_file(completed, "gifts.csv", 10))])
+    archiver.run_once(NOW)
+    # A file with the same name and day lands next to the first one, under a prefixed name
+    archiver.register([str(completed_file(completed, "gifts.csv", 10, b"second"))])
+    archiver.register([str(completed_file(completed, "other.csv", 10))])
+    assert archiver.run_once(NOW)["archived"] == 2
+
+    bundle = members(archive / archive_day(10))
+    assert bundle.pop("gifts.csv") == b"gifts.csv" * 100
+    assert bundle.pop("other.csv") == b"other.csv" * 100
+    (renamed, content), = bundle.items()
+    assert renamed.endswith("_gifts.csv") and content == b"second"
+    assert [f["member"] for f in archiver.find("gifts.csv")] in ([renamed, "gifts.csv"], ["gifts.csv", renamed])
+    assert os.listdir(archive) == [archive_day(10)]
+    assert archiver.bundles()[0]["files"] == 3
+
+
+def test_failed_run_leaves_the_existing_bundle_intact(folders, tmp_path, monkeypatch):
+    completed, archive = folders
+    archiver = make_archiver(folders, tmp_path)
+    archiver.register([str(completed_file(completed, "gifts.csv", 10))])
+    archiver.run_once(NOW)
+    bundle = archive / archive_day(10)
+    before = bundle.read_bytes()
+
+    late = [completed_file(completed, name, 10) for name in ("late1.csv", "late2.csv")]
+    archiver.register(str(path) for path in late)
+    write = zipfile.ZipFile.write
+
+    def disk_full_after_one(self, filename, *args, **kwargs):
+        if filename.endswith("late2.csv"):
+            raise OSError("disk full")
+        write(self, filename, *args, **kwargs)
+
+    monkeypatch.setattr(zipfile.ZipFile, "write", disk_full_after_one)
+    assert archiver.run_once(NOW)["archived"] == 0
+    assert bundle.read_bytes() == before
+    assert all(path.exists() for path in late)
+    assert os.listdir(archive) == [archive_day(10)]
+
+    monkeypatch.undo()
+    assert archiver.run_once(NOW)["archived"] == 2
+    assert set(members(bundle)) == {"gifts.csv", "late1.csv", "late2.csv"}
+
+
+def test_file_changed_since_registration_is_kept(folders, tmp_path):
+    completed, archive = folders
+    archiver = make_archiver(folders, tmp_path)
+    path = completed_file(completed, "gifts.csv", 10)
+    archiver.register([str(path)])
+    # Replaced by a new result under the same name before the archiver ran
+    completed_file(completed, "gifts.csv", 0, b"new result")
+
+    assert archiver.run_once(NOW)["archived"] == 0
+    assert path.read_bytes() == b"new result"
+    assert not (archive / archive_day(10)).exists()
+    # Archived once the new version is old enough
+    assert archiver.run_once(NOW + 7 * DAY)["archived"] == 1
+    assert members(archive / archive_day(0)) == {"gifts.csv": b"new result"}
+
+
+def test_file_rewritten_while_it_is_zipped_is_kept(folders, tmp_path, monkeypatch):
+    completed, archive = folders
+    archiver = make_archiver(folders, tmp_path)
+    path = completed_file(completed, "gifts.csv", 10)
+    archiver.register([str(path)])
+    write = zipfile.ZipFile.write
+
+    def write_then_replace(self, filename, *args, **kwargs):
+        write(self, filename, *args, **kwargs)
+        completed_file(completed, "gifts.csv", 0, b"new result")
+
+    monkeypatch.setattr(zipfile.ZipFile, "write", write_then_replace)
+    archiver.run_once(NOW)
+
+    assert members(archive / archive_day(10)) == {"gifts.csv": b"gifts.csv" * 100}
+    assert path.read_bytes() == b"new result"
+    monkeypatch.undo()
+    assert archiver.run_once(NOW + 7 * DAY)["archived"] == 1
+    assert not path.exists()
+
+
+def test_files_removed_by_hand_are_forgotten(folders, tmp_path):
+    completed, archive = folders
+    archiver = make_archiver(folders, tmp_path)
+    path = completed_file(completed, "gifts.csv", 10)
+    archiver.register([str(path)])
+    path.unlink()
+
+    assert archiver.run_once(NOW)["archived"] == 0
+    assert archiver.bundles() == []
+    with archiver._connect() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM pending").fetchone()[0] == 0
+
+
+def test_bundles_past_retention_are_deleted(folders, tmp_path):
+    completed, archive = folders
+    archiver = make_archiver(folders, tmp_path, retention_days=30)
+    for days_old in (10, 40):
+        archiver.register([str(completed_file(completed, f"gifts{days_old}.csv", days_old))])
+
+    assert archiver.run_once(NOW)["bundles_deleted"] == 1
+    assert os.listdir(archive) == [archive_day(10)]
+    assert archiver.find("gifts40.csv") == []
+    assert [b["name"] for b in archiver.bundles()] == [archive_day(10)]
+
+
+def test_oldest_bundles_are_deleted_beyond_the_size_quota(folders, tmp_path):
+    completed, archive = folders
+    archiver = make_archiver(folders, tmp_path, retention_days=None, max_bytes=2500)
+    for days_old in (10, 11, 12):
+        archiver.register([str(completed_file(completed, f"feed{days_old}.csv", days_old, os.urandom(1000)))])
+
+    assert archiver.run_once(NOW)["bundles_deleted"] == 1
+    assert sorted(os.listdir(archive)) == [archive_day(11), archive_day(10)]
+    assert sum(b["bytes"] for b in archiver.bundles()) <= 2500
+
+
+def test_scan_picks_up_loose_files_in_the_archive_folder(folders, tmp_path):
+    completed, archive = folders
+    archiver = make_archiver(folders, tmp_path)
+    loose = completed_file(archive, "from_an_older_version.csv", 20)
+    assert archiver.scan() == 1
+    archiver.run_once(NOW)
+
+    assert not loose.exists()
+    assert set(members(archive / archive_day(20))) == {"from_an_older_version.csv"}
+    assert archiver.scan() == 0
+
+
+def test_start_runs_in_the_background(folders, tmp_path):
+    completed, archive = folders
+    # Runs on the real clock, where the test files' day is long past the default retention
+    archiver = make_archiver(folders, tmp_path, retention_days=None)
+    archiver.register([str(completed_file(completed, "gifts.csv", 10))])
+    archiver.start(interval=3600)
+
+    deadline = time.monotonic() + 5
+    while not archiver.bundles():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert archiver.bundles()[0]["files"] == 1
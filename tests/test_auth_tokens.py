@@ -0,0 +1,269 @@
+import http.server
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import pytest
+
+pytest.importorskip("requests")
+
+import bb_auth
+from bb_auth import (TOKEN_REFRESH_MARGIN_SECONDS, TOKEN_REFRESH_RETRY_SECONDS, BlackbaudAuth,
+                     RateLimitGovernor, RequestFailedException)
+
+
+class SkyStub:
+    """Local token endpoint and API. POST /token issues access-2, access-3, ...; GETs need the newest token."""
+    def __init__(self):
+        self.posts = []
+        self.token_status = 200
+        self.token_delay = 0.0
+        self.valid_token = "access-1"
+        self.issued = 1
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                form = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+                with stub.lock:
+                    stub.posts.append(form)
+                time.sleep(stub.token_delay)
+                if stub.token_status != 200:
+                    return self.reply(stub.token_status, {"error": "unavailable"})
+                with stub.lock:
+                    stub.issued += 1
+                    stub.valid_token = f"access-{stub.issued}"
+                self.reply(200, {"access_token": stub.valid_token, "refresh_token": f"refresh-{stub.issued}",
+                                 "expires_in": 3600})
+
+            def do_GET(self):
+                if self.headers["Authorization"] == f"Bearer {stub.valid_token}":
+                    self.reply(200, {"ok": True})
+                else:
+                    self.reply(401, {"statusCode": 401, "message": "Access token is expired"})
+
+            def reply(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def sky(monkeypatch):
+    stub = SkyStub()
+    monkeypatch.setattr(bb_auth, "TOKEN_URL", stub.url + "/token")
+    monkeypatch.setattr(bb_auth, "API_BASE_URL", stub.url)
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def keyring_store(monkeypatch):
+    store = {"tokens.access_token": "access-1", "tokens.refresh_token": "refresh-1",
+             "other.api_subscription_key": "api-key"}
+    monkeypatch.setattr(bb_auth.secure_keyring, "get_password", lambda key: store.get(key))
+    monkeypatch.setattr(bb_auth.secure_keyring, "set_password", lambda key, value, *args: store.__setitem__(key, value))
+    monkeypatch.setattr(bb_auth, "CLIENT_ID", "client")
+    monkeypatch.setattr(bb_auth, "CLIENT_SECRET", "secret")
+    return store
+
+
+class Browser(list):
+    """Records logins instead of opening a browser; set login to the (access, refresh) tokens a login stores."""
+    login = None
+
+    def authenticate_user(self, auth):
+        self.append(auth)
+        if self.login:
+            bb_auth.secure_keyring.set_password("tokens.access_token", self.login[0])
+            bb_auth.secure_keyring.set_password("tokens.refresh_token", self.login[1])
+
+
+@pytest.fixture
+def browser(monkeypatch):
+    logins = Browser()
+    monkeypatch.setattr(BlackbaudAuth, "authenticate_user", lambda self: logins.authenticate_user(self))
+    return logins
+
+
+@pytest.fixture
+def make_auth(keyring_store, sky, browser):
+    created = []
+
+    def make(expires_in=3600):
+        if expires_in is None:
+            keyring_store.pop("tokens.expires_at", None)
+        else:
+            keyring_store["tokens.expires_at"] = str(time.time() + expires_in)
+        auth = BlackbaudAuth()
+        auth.governor = RateLimitGovernor(rate=1e9, burst=1e9, daily_quota=None)
+        created.append(auth)
+        return auth
+
+    yield make
+    for auth in created:
+        auth.close()
+
+
+def test_stored_expiry_arms_the_background_refresh_at_startup(make_auth, sky):
+    auth = make_auth()
+    assert auth.token_expires_at == pytest.approx(time.time() + 3600, abs=5)
+    assert auth._refresh_timer is not None and auth._refresh_timer.is_alive()
+    assert auth._refresh_timer.interval == pytest.approx(3600 - TOKEN_REFRESH_MARGIN_SECONDS, abs=5)
+    assert not auth.token_expiring()
+    assert sky.posts == []
+
+
+def test_tokens_without_stored_expiry_are_refreshed_at_startup(make_auth, sky, keyring_store):
+    auth = make_auth(expires_in=None)
+    auth._refresh_timer.join(timeout=5)
+    assert [post["refresh_token"] for post in sky.posts] == [["refresh-1"]]
+    assert auth.access_token == keyring_store["tokens.access_token"] == "access-2"
+
+
+def test_storing_tokens_persists_the_expiry(make_auth, keyring_store):
+    auth = make_auth()
+    auth._store_tokens({"access_token": "access-2", "refresh_token": "refresh-2", "expires_in": 3600})
+    assert float(keyring_store["tokens.expires_at"]) == pytest.approx(time.time() + 3600, abs=5)
+
+    restarted = BlackbaudAuth()
+    try:
+        assert restarted.token_expires_at == pytest.approx(auth.token_expires_at)
+        assert restarted._refresh_timer.is_alive()
+    finally:
+        restarted.close()
+
+
+def run_at_once(workers, fn):
+    barrier = threading.Barrier(workers)
+
+    def call(_):
+        barrier.wait()
+        return fn()
+
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(call, range(workers)))
+
+
+def test_workers_finding_the_token_expiring_share_one_refresh(make_auth, sky, browser):
+    auth = make_auth()
+    auth.token_expires_at = time.time()  # due now, with the background refresh not fired yet
+    sky.token_delay = 0.2  # every worker arrives while the refresh is in flight
+
+    sessions = run_at_once(8, auth.get_session)
+    assert len(sky.posts) == 1
+    assert len({id(session) for session in sessions}) == 1
+    assert sessions[0].headers["Authorization"] == "Bearer access-2"
+    assert browser == []
+
+
+def test_requests_rejected_with_an_expired_token_share_one_refresh(make_auth, sky, browser):
+    auth = make_auth()
+    sky.valid_token = None  # expired on the server before the local expiry says so
+    sky.token_delay = 0.2
+
+    results = run_at_once(8, lambda: auth.make_request("GET", "/constituent/v1/constituents/1"))
+    assert results == [{"ok": True}] * 8
+    assert len(sky.posts) == 1
+    assert browser == []
+
+
+def test_failed_background_refresh_is_retried_with_backoff(make_auth, sky, browser):
+    sky.token_status = 503
+    auth = make_auth(expires_in=None)
+    startup = auth._refresh_timer
+    startup.join(timeout=5)
+    assert len(sky.posts) == 1
+    retry = auth._refresh_timer
+    assert retry is not startup and retry.interval == TOKEN_REFRESH_RETRY_SECONDS
+    retry.cancel()
+
+    # Workers leave the retry to the timer instead of each trying, or opening the browser
+    auth.get_session()
+    auth.get_session()
+    assert len(sky.posts) == 1
+
+    auth._background_refresh("access-1")
+    assert len(sky.posts) == 2 and auth._refresh_timer.interval == 2 * TOKEN_REFRESH_RETRY_SECONDS
+    auth._refresh_timer.cancel()
+
+    sky.token_status = 200
+    auth._background_refresh("access-1")
+    assert auth.access_token == "access-2"
+    assert auth._refresh_timer.interval == pytest.approx(3600 - TOKEN_REFRESH_MARGIN_SECONDS, abs=5)
+    auth.get_session()
+    assert len(sky.posts) == 3 and browser == []
+
+
+def test_browser_login_is_tried_once_per_refresh_token(make_auth, sky, browser):
+    auth = make_auth()
+    sky.valid_token = None
+    sky.token_status = 400  # refresh token revoked
+
+    for _ in range(2):
+        with pytest.raises(RequestFailedException):
+            auth.make_request("GET", "/constituent/v1/constituents/1")
+    assert len(browser) == 1
+
+
+def test_tokens_from_the_browser_login_are_used(make_auth, sky, browser):
+    auth = make_auth()
+    sky.valid_token = "access-9"
+    sky.token_status = 400
+    browser.login = ("access-9", "refresh-9")
+
+    assert auth.make_request("GET", "/constituent/v1/constituents/1") == {"ok": True}
+    assert len(browser) == 1
+    assert auth.refresh_token == "refresh-9"
+    assert auth.get_session().headers["Authorization"] == "Bearer access-9"
+
+
+def test_one_session_per_subscription_key_is_reused(make_auth, keyring_store):
+    keyring_store["other.payment_subscription_key"] = "payment-key"
+    auth = make_auth()
+    api, payment = auth.get_session(), auth.get_session(use_payment_key=True)
+
+    assert api is not payment
+    assert auth.get_session() is api and auth.get_session(use_payment_key=True) is payment
+    assert api.headers["Bb-Api-Subscription-Key"] == "api-key"
+    assert payment.headers["Bb-Api-Subscription-Key"] == "payment-key"
+
+
+def test_refreshed_token_updates_the_open_sessions(make_auth):
+    auth = make_auth()
+    api, payment = auth.get_session(), auth.get_session(use_payment_key=True)
+    auth._store_tokens({"access_token": "access-2", "refresh_token": "refresh-2", "expires_in": 3600})
+
+    assert auth.get_session() is api
+    assert api.headers["Authorization"] == payment.headers["Authorization"] == "Bearer access-2"
+
+
+def test_subscription_keys_are_read_from_keyring_once(make_auth, keyring_store, monkeypatch):
+    auth = make_auth()
+    reads = []
+    monkeypatch.setattr(bb_auth.secure_keyring, "get_password", lambda key: reads.append(key) or keyring_store.get(key))
+    for _ in range(3):
+        auth.get_session()
+        auth.get_session(use_payment_key=True)
+        assert auth.get_subscription_key() == "api-key"
+
+    # No payment key is stored, so it falls back to the API key; the miss is cached too
+    assert sorted(reads) == ["other.api_subscription_key", "other.payment_subscription_key"]
@@ -0,0 +1,126 @@
+import re
+import threading
+
+import pytest
+
+pytest.importorskip("requests")
+
+import bb_build_query_structure
+from bb_build_query_structure import (CrawlCheckpoint, assemble_query_type, crawl_query_types,
+                                      refresh_query_structure, refresh_query_type)
+
+# node -> child nodes; None is the query type itself. 2 and 3 are reached from two parents,
+# 3 points back at 1, and 5 sits below max_depth=3.
+TREE = {None: ["1", "2"], "1": ["2", "3"], "2": ["3"], "3": ["4", "1"], "4": ["5"], "5": []}
+
+
+class FakeAuth:
+    """Answers the availablefields endpoints from a tree; after fail_after fetches every call fails."""
+    def __init__(self, tree, fields=None, fail_after=None):
+        self.tree = tree
+        self.fields = fields or {}
+        self.fail_after = fail_after
+        self.calls = []  # node ids of the fetches that succeeded
+        self.lock = threading.Lock()
+
+    def make_request(self, method, endpoint, params=None, data=None):
+        node_id = re.fullmatch(r"/query/querytypes/\d+(?:/nodes/(\d+))?/availablefields", endpoint).group(1)
+        with self.lock:
+            if self.fail_after is not None and len(self.calls) >= self.fail_after:
+                raise ConnectionError("connection reset")
+            self.calls.append(node_id)
+        fields = self.fields.get(node_id, [(100, f"Field of {node_id}", "Text")])
+        return {
+            "nodes": [{"id": int(child), "name": f"Node {child}"} for child in self.tree[node_id]],
+            "fields": [{"id": field_id, "available_field_name": name, "selected_field_name": name,
+                        "value_type": value_type} for field_id, name, value_type in fields]
+        }
+
+
+@pytest.fixture(autouse=True)
+def files(tmp_path, monkeypatch):
+    monkeypatch.setattr(bb_build_query_structure, "LOG_FILE", str(tmp_path / "bb_query_log.txt"))
+    monkeypatch.setattr(bb_build_query_structure, "OUTPUT_FILE", str(tmp_path / "bb_query_structure.json"))
+    monkeypatch.setattr(bb_build_query_structure, "DIFF_REPORT_FILE", str(tmp_path / "diff_{timestamp}.json"))
+    return tmp_path
+
+
+def crawl(auth, checkpoint, max_depth=3, max_workers=4):
+    return crawl_query_types(auth, {"10": "Gift"}, checkpoint, max_workers=max_workers, max_depth=max_depth)
+
+
+def test_shared_and_cyclic_nodes_are_fetched_once(files):
+    auth = FakeAuth(TREE)
+    checkpoint = CrawlCheckpoint(str(files / "checkpoint.jsonl"))
+    assert crawl(auth, checkpoint) == []
+    assert sorted(auth.calls, key=str) == ["1", "2", "3", "4", None]
+
+    entry = assemble_query_type(checkpoint, "10", "Gift", max_depth=3)
+    assert list(entry["nodes"]) == ["1", "2", "3", "4"]
+    # 5 is listed under 4 but lies below max_depth
+    assert entry["nodes"]["4"]["child_nodes"] == [{"id": 5, "name": "Node 5"}]
+    assert entry["fields"] == [{"id": 100, "name": "Field of None", "selected_name": "Field of None",
+                                "value_type": "Text", "allowed_filter_operators": []}]
+
+
+def test_interrupted_crawl_resumes_from_the_checkpoint(files):
+    path = str(files / "checkpoint.jsonl")
+    first = FakeAuth(TREE, fail_after=3)
+    failed = crawl(first, CrawlCheckpoint(path), max_workers=2)
+    assert failed and len(first.calls) == 3
+    with open(path, "a") as file:
+        file.write('{"query_type_id": "10", "node_')  # killed halfway through a write
+
+    checkpoint = CrawlCheckpoint(path)
+    assert len(checkpoint.records) == 3
+    second = FakeAuth(TREE)
+    assert crawl(second, checkpoint) == []
+
+    fetched = first.calls + second.calls
+    assert len(fetched) == len(set(fetched)) == 5
+    assert list(assemble_query_type(checkpoint, "10", "Gift", max_depth=3)["nodes"]) == ["1", "2", "3", "4"]
+
+
+def crawled_entry(files, tree, fields=None):
+    checkpoint = CrawlCheckpoint(str(files / "checkpoint.jsonl"))
+    checkpoint.remove()
+    checkpoint.records.clear()
+    assert crawl(FakeAuth(tree, fields), checkpoint) == []
+    return assemble_query_type(checkpoint, "10", "Gift", max_depth=3)
+
+
+def test_refresh_keeps_unchanged_nodes_and_reports_the_differences(files):
+    stored = crawled_entry(files, TREE)
+    # 2 is dropped (and with it nothing else: 3 is still reached from 1), 6 is new,
+    # and 3's field changes type while gaining a second field
+    tree = {**TREE, None: ["1"], "1": ["3", "6"], "6": []}
+    fresh = crawled_entry(files, tree, fields={"3": [(100, "Field of 3", "Number"), (101, "New", "Date")]})
+
+    entry, report = refresh_query_type(stored, fresh)
+    assert entry == fresh
+    assert entry["nodes"]["1"] is fresh["nodes"]["1"]  # its child list changed
+    assert entry["nodes"]["4"] is stored["nodes"]["4"]
+    assert report["nodes_added"] == [{"id": "6", "name": "Node 6"}]
+    assert report["nodes_removed"] == [{"id": "2", "name": "Node 2"}]
+    assert report["nodes_rewritten"] == 3  # 1, 3 and 6
+    assert report["fields_added"] == [{"node_id": "3", "id": 101, "name": "New"},
+                                      {"node_id": "6", "id": 100, "name": "Field of 6"}]
+    assert report["fields_removed"] == [{"node_id": "2", "id": 100, "name": "Field of 2"}]
+    assert report["fields_changed"] == [{"node_id": "3", "id": 100, "name": "Field of 3",
+                                         "changes": {"value_type": {"old": "Text", "new": "Number"}}}]
+
+
+def test_refresh_without_changes_leaves_the_file_alone(files, monkeypatch):
+    stored = crawled_entry(files, TREE)
+    checkpoint = CrawlCheckpoint(str(files / "checkpoint.jsonl"))
+    saves = []
+    monkeypatch.setattr(bb_build_query_structure, "save_data", saves.append)
+
+    structure = {"10": stored}
+    refresh_query_structure(structure, {"10": "Gift"}, checkpoint, max_depth=3)
+    assert saves == [] and structure["10"] is stored
+
+    entry, report = refresh_query_type(stored, assemble_query_type(checkpoint, "10", "Gift", max_depth=3))
+    assert report["nodes_rewritten"] == 0
+    assert all(entry["nodes"][node_id] is stored["nodes"][node_id] for node_id in stored["nodes"])
+    assert not report["fields_added"] and not report["fields_removed"] and not report["fields_changed"]
@@ -0,0 +1,72 @@
+import pytest
+
+pytest.importorskip("pandas")
+
+from bb_email_enrichment import ImportIdIndex, enrich_csv
+
+EXPORT = """Constituent ID,Amount,Name,Phone Number
+1,10.50,Ann,Donor1@Example.org
+2,20,Bob,0555-1234
+3,,Cy,
+4,40,Di,someone@example.com
+"""
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = ImportIdIndex(str(tmp_path / "import_ids.sqlite"))
+    index.upsert([("donor1@example.org", "IMP001"), ("5551234", "not an email"), (" Someone@Example.com ", 77)])
+    return index
+
+
+def enrich(tmp_path, index, text, **kwargs):
+    src = tmp_path / "export.csv"
+    src.write_text(text)
+    dest = tmp_path / "export_processed.csv"
+    rows = enrich_csv(str(src), str(dest), index, **kwargs)
+    return rows, dest.read_text()
+
+
+def test_import_ids_are_appended_by_normalized_email(tmp_path, index):
+    rows, output = enrich(tmp_path, index, EXPORT)
+    assert rows == 4
+    assert output.splitlines() == [
+        "Constituent ID,Amount,Name,Phone Number,ImportID",
+        "1,10.50,Ann,Donor1@Example.org,IMP001",
+        "2,20,Bob,0555-1234,",
+        "3,,Cy,,",
+        "4,40,Di,someone@example.com,77",
+    ]
+
+
+def test_columns_pass_through_as_exported(tmp_path, index):
+    export = "Constituent ID,Amount,Note,Phone Number\n007,1e3,NA,0555\n8,,null,\n"
+    _, output = enrich(tmp_path, index, export)
+    assert output.splitlines() == ["Constituent ID,Amount,Note,Phone Number,ImportID",
+                                   "007,1e3,NA,0555,", "8,,null,,"]
+
+
+def test_chunked_output_matches_in_memory_output(tmp_path, index):
+    # Amount is blank in the first chunk only, so per-chunk type inference would write 5 and 5.0
+    lines = [f"{i},{i if i > 7 else ''},Name {i},donor{i % 3}@example.org" if i % 4 else
+             f"{i},{i if i > 7 else ''},Name {i},555{i:04d}" for i in range(50)]
+    export = "Constituent ID,Amount,Name,Phone Number\n" + "\n".join(lines) + "\n"
+    in_memory = enrich(tmp_path, index, export, chunk_rows=0)
+    chunked = enrich(tmp_path, index, export, chunk_rows=7)
+    assert chunked == in_memory
+    assert in_memory[0] == 50
+    assert [line.rsplit(",", 1)[0] for line in in_memory[1].splitlines()] == export.splitlines()
+
+
+def test_header_only_export(tmp_path, index):
+    assert enrich(tmp_path, index, "Constituent ID,Phone Number\n", chunk_rows=5) == \
+        (0, "Constituent ID,Phone Number,ImportID\n")
+
+
+def test_mapping_file_is_upserted(tmp_path, index):
+    mapping = tmp_path / "email_to_importid_mapping.json"
+    mapping.write_text('{"DONOR1@example.org": "IMP999", "new@example.org": "IMP002", "5550000": "x"}')
+    assert index.import_json(str(mapping)) == 2
+    assert index.lookup(["donor1@example.org", "new@example.org", "5550000"]) == {
+        "donor1@example.org": "IMP999", "new@example.org": "IMP002"}
+    assert len(index) == 3
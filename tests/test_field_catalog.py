@@ -0,0 +1,155 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+from bb_field_catalog import FieldCatalog
+
+STRUCTURE = {
+    "10": {
+        "name": "Gift",
+        "fields": [
+            {"id": 1, "name": "Date", "selected_name": "Gift Date", "value_type": "Date",
+             "allowed_filter_operators": ["Equals", "RelativeComparisons", "Blank"]},
+            {"id": 2, "name": "Amount", "selected_name": "Gift Amount", "value_type": "Currency",
+             "allowed_filter_operators": ["Equals", "RelativeComparisons"]},
+        ],
+        "nodes": {
+            "367": {
+                "name": "Constituent",
+                "child_nodes": [{"id": 368, "name": "Address"}],
+                "fields": [
+                    {"id": 7, "name": "Name", "selected_name": "Constituent Name", "value_type": "Text",
+                     "allowed_filter_operators": ["Equals", "StringComparisons"]},
+                    {"id": 1, "name": "Date added", "selected_name": "Date Added", "value_type": "Date",
+                     "allowed_filter_operators": ["Equals"]},
+                ],
+            },
+        },
+    },
+    "20": {
+        "name": "Constituent",
+        "fields": [
+            {"id": 7, "name": "Name", "selected_name": "Constituent Name", "value_type": "Text",
+             "allowed_filter_operators": ["Equals", "StringComparisons", "SoundsLike"]},
+        ],
+    },
+}
+
+
+def write_structure(path, structure):
+    path.write_text(json.dumps(structure))
+
+
+@pytest.fixture
+def json_path(tmp_path):
+    path = tmp_path / "bb_query_structure_id.json"
+    write_structure(path, STRUCTURE)
+    return path
+
+
+@pytest.fixture
+def catalog(json_path):
+    catalog = FieldCatalog(str(json_path))
+    yield catalog
+    catalog.close()
+
+
+def test_catalog_is_compiled_next_to_the_json_on_first_lookup(catalog, json_path):
+    db_path = json_path.with_suffix(".sqlite")
+    assert not db_path.exists()
+    assert catalog.query_types() == {10: "Gift", 20: "Constituent"}
+    assert db_path.exists()
+    assert catalog.stats()["fields"] == 5
+
+
+def test_lookups_by_id_and_selected_name(catalog):
+    by_id = catalog.fields_by_id(1)
+    assert [(f["query_type_id"], f["node_id"], f["selected_name"]) for f in by_id] == \
+        [(10, None, "Gift Date"), (10, 367, "Date Added")]
+    assert by_id[0]["allowed_filter_operators"] == ["Equals", "RelativeComparisons", "Blank"]
+
+    names = catalog.fields_by_selected_name("constituent name")
+    assert sorted(f["query_type_id"] for f in names) == [10, 20]
+    assert [f["query_type_id"] for f in catalog.fields_by_selected_name("Constituent Name", 20)] == [20]
+    assert [f["id"] for f in catalog.query_type_fields(10, node_id=367)] == [7, 1]
+
+
+def test_node_and_operators(catalog):
+    assert catalog.node(10, 367) == {"query_type_id": 10, "id": 367, "name": "Constituent",
+                                     "child_nodes": [{"id": 368, "name": "Address"}]}
+    assert catalog.node(10, 999) is None
+    assert set(catalog.operators()) == {"Equals", "RelativeComparisons", "Blank", "StringComparisons", "SoundsLike"}
+
+
+def test_current_catalog_is_reused_and_a_changed_json_is_recompiled(catalog, json_path):
+    catalog.query_types()
+    catalog.close()
+    db_path = json_path.with_suffix(".sqlite")
+    compiled_at = db_path.stat().st_mtime_ns
+
+    reopened = FieldCatalog(str(json_path))
+    assert reopened.query_types() == {10: "Gift", 20: "Constituent"}
+    assert db_path.stat().st_mtime_ns == compiled_at
+    reopened.close()
+
+    structure = dict(STRUCTURE)
+    structure["30"] = {"name": "Action", "fields": []}
+    write_structure(json_path, structure)
+    updated = FieldCatalog(str(json_path))
+    assert updated.query_types() == {10: "Gift", 20: "Constituent", 30: "Action"}
+    updated.close()
+
+
+def test_failed_compile_keeps_the_old_catalog_and_leaves_no_temporary_file(catalog, json_path):
+    catalog.query_types()
+    catalog.close()
+    broken = dict(STRUCTURE)
+    broken["30"] = {"name": "Action", "fields": [{"id": 1}]}  # no name or value_type
+    write_structure(json_path, broken)
+
+    with pytest.raises(KeyError):
+        FieldCatalog(str(json_path)).query_types()
+    assert sorted(os.listdir(json_path.parent)) == ["bb_query_structure_id.json", "bb_query_structure_id.sqlite"]
+    with sqlite3.connect(str(json_path.with_suffix(".sqlite"))) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM query_types").fetchone() == (2,)
+
+
+def test_catalog_without_its_json_uses_the_compiled_file(catalog, json_path):
+    catalog.query_types()
+    catalog.close()
+    json_path.unlink()
+    assert FieldCatalog(str(json_path)).query_types() == {10: "Gift", 20: "Constituent"}
+
+
+def names(results):
+    return [(f["query_type_id"], f["selected_name"]) for f in results]
+
+
+def test_search_ranks_exact_then_prefix_then_word_matches(catalog):
+    results = catalog.search("gift date")
+    assert names(results)[0] == (10, "Gift Date")
+    assert results[0]["score"] > results[1]["score"]
+    assert sorted(names(catalog.search("gift"))[:2]) == [(10, "Gift Amount"), (10, "Gift Date")]
+    assert (10, "Date Added") in names(catalog.search("date"))
+
+
+def test_search_tolerates_typos(catalog):
+    assert names(catalog.search("constituant name"))[:2] == [(10, "Constituent Name"), (20, "Constituent Name")]
+    assert catalog.search("zzzz") == []
+    assert catalog.search("  ") == []
+
+
+def test_search_filters(catalog):
+    assert names(catalog.search("name", query_type_id=20)) == [(20, "Constituent Name")]
+    assert sorted(names(catalog.search("date", value_type="date"))) == [(10, "Date Added"), (10, "Gift Date")]
+    assert names(catalog.search("name", operators=["soundslike"])) == [(20, "Constituent Name")]
+    assert names(catalog.search("date", operators=["Blank", "Equals"])) == [(10, "Gift Date")]
+    with pytest.raises(ValueError, match="Unknown filter operator"):
+        catalog.search("date", operators=["Nope"])
+
+
+def test_search_limit(catalog):
+    assert len(catalog.search("e", limit=2)) <= 2
+    assert len(catalog.search("gift", limit=1)) == 1
@@ -0,0 +1,88 @@
+import os
+import time
+
+import pytest
+
+import bb_folder_watcher
+from bb_folder_watcher import FolderWatcher
+
+
+@pytest.fixture(params=["polling", "native"])
+def make_watcher(request, monkeypatch, tmp_path):
+    if request.param == "polling":
+        monkeypatch.setattr(bb_folder_watcher, "Observer", None)
+    elif bb_folder_watcher.Observer is None:
+        pytest.skip("watchdog is not installed")
+    folder = tmp_path / "query_request"
+    folder.mkdir()
+    watchers = []
+
+    def make(**kwargs):
+        options = dict(patterns=("*.json",), stable_seconds=0.1, scan_interval=0.05)
+        options.update(kwargs)
+        watcher = FolderWatcher(str(folder), **options)
+        watchers.append(watcher)
+        return watcher
+
+    make.folder = folder
+    yield make
+    for watcher in watchers:
+        watcher.stop()
+
+
+def write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def test_new_file_is_reported_once(make_watcher):
+    watcher = make_watcher().start()
+    path = str(make_watcher.folder / "a.json")
+    write(path, "{}")
+    write(str(make_watcher.folder / "ignored.txt"), "x")
+
+    assert watcher.get(timeout=5) == path
+    assert watcher.get(timeout=0.5) is None
+
+
+def test_existing_files_are_reported_unless_excluded(make_watcher):
+    write(str(make_watcher.folder / "old.json"), "{}")
+    assert make_watcher().start().get(timeout=5) == str(make_watcher.folder / "old.json")
+    assert make_watcher(include_existing=False).start().get(timeout=0.5) is None
+
+
+def test_file_still_being_written_is_held_back(make_watcher):
+    watcher = make_watcher(stable_seconds=0.5).start()
+    path = str(make_watcher.folder / "big.json")
+    with open(path, "w") as f:
+        for _ in range(6):
+            f.write("x" * 1000)
+            f.flush()
+            time.sleep(0.15)
+            assert watcher.get(timeout=0) is None
+    assert watcher.get(timeout=5) == path
+
+
+def test_file_dropped_again_after_the_first_was_moved_out_is_reported_again(make_watcher, tmp_path):
+    watcher = make_watcher().start()
+    path = str(make_watcher.folder / "d1_file_import_id.json")
+    write(path, '{"run": 1}')
+    assert watcher.get(timeout=5) == path
+
+    # The worker moves the request out and the next one lands under the same name in one step,
+    # before the watcher sees the folder without it
+    os.replace(path, str(tmp_path / "completed.json"))
+    write(str(tmp_path / "incoming.json"), '{"run": 2}')
+    os.replace(str(tmp_path / "incoming.json"), path)
+    assert watcher.get(timeout=5) == path
+
+
+def test_subscribers_are_called_with_each_file(make_watcher):
+    seen = []
+    watcher = make_watcher()
+    watcher.subscribe(seen.append)
+    watcher.start()
+    path = str(make_watcher.folder / "a.json")
+    write(path, "{}")
+    assert watcher.get(timeout=5) == path
+    assert seen == [path]
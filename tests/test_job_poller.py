@@ -0,0 +1,104 @@
+import threading
+
+import pytest
+
+from bb_job_poller import JobStatusPoller, PollingTimeoutError
+
+
+class FakeAuth:
+    """make_request returns the next scripted status of each job; the last one repeats."""
+    def __init__(self, statuses):
+        self.statuses = {job_id: list(seq) for job_id, seq in statuses.items()}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def make_request(self, method, endpoint, params=None, data=None):
+        job_id = endpoint.rsplit("/", 1)[-1]
+        with self.lock:
+            self.calls.append((job_id, dict(params or {})))
+            seq = self.statuses[job_id]
+            status = seq.pop(0) if len(seq) > 1 else seq[0]
+        if isinstance(status, Exception):
+            raise status
+        if status is None:
+            return None
+        return {"id": job_id, "status": status}
+
+
+def make_poller(auth, **kwargs):
+    options = dict(poll_interval=0.01, max_interval=0.05, backoff_factor=2, max_seconds=5)
+    options.update(kwargs)
+    return JobStatusPoller(auth, **options)
+
+
+def test_resolves_with_final_response_and_reports_each_status_change():
+    auth = FakeAuth({"job1": ["Pending", "Pending", "Running", "Running", "Completed"]})
+    seen = []
+    poller = make_poller(auth)
+    future = poller.submit("job1", params={"include_read_url": "Always"},
+                           on_status=lambda job_id, status: seen.append((job_id, status)))
+
+    assert future.result(timeout=5) == {"id": "job1", "status": "Completed"}
+    assert seen == [("job1", "Pending"), ("job1", "Running"), ("job1", "Completed")]
+    assert len(auth.calls) == 5
+    assert all(params == {"include_read_url": "Always"} for _, params in auth.calls)
+    assert poller.pending_count == 0
+    poller.stop()
+
+
+def test_polls_many_jobs_from_one_thread():
+    auth = FakeAuth({f"job{i}": ["Running"] * i + ["Completed"] for i in range(10)})
+    poller = make_poller(auth)
+    futures = [poller.submit(f"job{i}") for i in range(10)]
+
+    assert [f.result(timeout=5)["status"] for f in futures] == ["Completed"] * 10
+    pollers = [t for t in threading.enumerate() if t.name == "job_status_poller"]
+    assert len(pollers) == 1
+    poller.stop()
+
+
+def test_submitting_a_tracked_job_returns_its_future():
+    auth = FakeAuth({"job1": ["Running"]})
+    poller = make_poller(auth)
+    assert poller.submit("job1") is poller.submit("job1")
+    poller.stop()
+
+
+def test_empty_response_resolves_with_none():
+    poller = make_poller(FakeAuth({"job1": [None]}))
+    assert poller.submit("job1").result(timeout=5) is None
+    poller.stop()
+
+
+def test_request_errors_fail_the_job():
+    poller = make_poller(FakeAuth({"job1": ["Running", RuntimeError("boom")]}))
+    with pytest.raises(RuntimeError, match="boom"):
+        poller.submit("job1").result(timeout=5)
+    poller.stop()
+
+
+def test_job_that_never_finishes_times_out():
+    poller = make_poller(FakeAuth({"job1": ["Running"]}), max_seconds=0.2)
+    with pytest.raises(PollingTimeoutError) as info:
+        poller.submit("job1").result(timeout=5)
+    assert info.value.job_id == "job1"
+    poller.stop()
+
+
+def test_unchanged_status_backs_off_to_the_cap():
+    auth = FakeAuth({"job1": ["Running"]})
+    poller = make_poller(auth, poll_interval=0.01, max_interval=0.2, backoff_factor=2, max_seconds=0.6)
+    with pytest.raises(PollingTimeoutError):
+        poller.submit("job1").result(timeout=5)
+    # Fixed 10 ms polling would take ~60 requests; backing off to 200 ms needs far fewer
+    assert len(auth.calls) < 15
+    poller.stop()
+
+
+def test_stop_cancels_outstanding_jobs():
+    poller = make_poller(FakeAuth({"job1": ["Running"]}))
+    future = poller.submit("job1")
+    poller.stop()
+    assert future.cancelled()
+    with pytest.raises(RuntimeError):
+        poller.submit("job2")
@@ -0,0 +1,78 @@
+import json
+import os
+
+from bb_log_sink import LogSink
+
+
+def read_records(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def rotated(tmp_path, name="api_log.jsonl"):
+    return sorted(f for f in os.listdir(tmp_path) if f.startswith(name + "."))
+
+
+def test_close_writes_every_queued_record_in_order(tmp_path):
+    path = str(tmp_path / "logs" / "api_log.jsonl")
+    sink = LogSink(path, batch_size=7, flush_interval=10)
+    for i in range(100):
+        sink.emit({"event": i})
+    sink.close()
+
+    records = read_records(path)
+    assert [r["event"] for r in records] == list(range(100))
+    assert all(r["ts"].endswith("+00:00") for r in records)
+
+
+def test_given_timestamp_is_kept_and_values_are_stringified(tmp_path):
+    path = str(tmp_path / "api_log.jsonl")
+    sink = LogSink(path)
+    sink.emit({"ts": "2024-01-01T00:00:00", "path": tmp_path})
+    sink.close()
+    assert read_records(path) == [{"ts": "2024-01-01T00:00:00", "path": str(tmp_path)}]
+
+
+def test_restarted_sink_appends(tmp_path):
+    path = str(tmp_path / "api_log.jsonl")
+    for i in range(2):
+        sink = LogSink(path)
+        sink.emit({"run": i})
+        sink.close()
+    assert [r["run"] for r in read_records(path)] == [0, 1]
+
+
+def test_full_file_is_rotated_and_old_backups_are_deleted(tmp_path):
+    path = str(tmp_path / "api_log.jsonl")
+    # One record per write, and every write finds the file full
+    sink = LogSink(path, max_bytes=1, backup_count=2, batch_size=1)
+    for i in range(5):
+        sink.emit({"event": i})
+    sink.close()
+
+    backups = rotated(tmp_path)
+    assert len(backups) == 2
+    assert [read_records(str(tmp_path / b))[0]["event"] for b in backups] == [2, 3]
+    assert [r["event"] for r in read_records(path)] == [4]
+
+
+def test_old_file_is_rotated(tmp_path):
+    path = str(tmp_path / "api_log.jsonl")
+    sink = LogSink(path, rotate_seconds=0, batch_size=1)
+    sink.emit({"event": 0})
+    sink.emit({"event": 1})
+    sink.close()
+
+    assert len(rotated(tmp_path)) == 1
+    assert [r["event"] for r in read_records(path)] == [1]
+
+
+def test_write_errors_are_reported_without_stopping_the_sink(tmp_path, capsys):
+    blocker = tmp_path / "not_a_folder"
+    blocker.write_text("")
+    sink = LogSink(str(blocker / "api_log.jsonl"))
+    sink.emit({"event": 0})
+    sink.close()
+
+    assert "Log sink could not write 1 record(s)" in capsys.readouterr().out
+    assert not sink._thread.is_alive()
@@ -0,0 +1,97 @@
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from bb_metrics import MetricsRegistry, endpoint_label, percentile, query_label
+
+
+@pytest.mark.parametrize("endpoint, label", [
+    ("/query/jobs/12345", "/query/jobs/:id"),
+    ("/query/jobs/3f2b8c1e-9a4d-4e5f-8b6a-0c1d2e3f4a5b?include_read_url=Always", "/query/jobs/:id"),
+    ("/query/querytypes/15/structure", "/query/querytypes/:id/structure"),
+    ("/query/queries/executebyid", "/query/queries/executebyid"),
+])
+def test_endpoint_label_collapses_ids(endpoint, label):
+    assert endpoint_label(endpoint) == label
+
+
+@pytest.mark.parametrize("data, label", [
+    ({"id": 12345, "product": "RE", "module": "None"}, "12345"),
+    ({"query": {"query_type_id": 15}}, "adhoc:15"),
+    ({"spec": {"query_type": "Gift"}}, "adhoc:Gift"),
+    ([], "unknown"),
+])
+def test_query_label(data, label):
+    assert query_label(data) == label
+
+
+def test_percentile_is_nearest_rank():
+    values = [float(v) for v in range(1, 101)]
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.95) == 95
+    assert percentile(values, 0.99) == 99
+    assert percentile([7.0], 0.99) == 7
+    assert percentile([], 0.5) == 0.0
+
+
+def test_snapshot_summarizes_each_label_set():
+    registry = MetricsRegistry()
+    for seconds in range(1, 11):
+        registry.observe("stage", float(seconds), stage="download", query=None)
+    registry.observe("stage", 0.5, stage="submit")
+
+    download, submit = registry.snapshot()
+    assert download == {"name": "stage", "labels": {"stage": "download"}, "count": 10, "sum": 55.0,
+                        "max": 10.0, "p50": 5.0, "p95": 10.0, "p99": 10.0}
+    assert submit["labels"] == {"stage": "submit"} and submit["count"] == 1
+
+
+def test_timed_records_the_outcome():
+    registry = MetricsRegistry()
+    with registry.timed("stage", stage="poll") as span:
+        pass
+    assert span.seconds is not None and span.duration_ms >= 0
+    with pytest.raises(RuntimeError):
+        with registry.timed("stage", stage="poll"):
+            raise RuntimeError("boom")
+
+    outcomes = {s["labels"]["outcome"]: s["count"] for s in registry.snapshot()}
+    assert outcomes == {"ok": 1, "error": 1}
+
+
+def test_prometheus_text_format():
+    registry = MetricsRegistry()
+    registry.observe("bb_api_request_seconds", 0.25, endpoint='/a"b', status=200)
+    registry.observe("bb_api_request_seconds", 0.75, endpoint='/a"b', status=200)
+
+    assert registry.prometheus_text().splitlines() == [
+        "# TYPE bb_api_request_seconds summary",
+        'bb_api_request_seconds{endpoint="/a\\"b",status="200",quantile="0.5"} 0.25',
+        'bb_api_request_seconds{endpoint="/a\\"b",status="200",quantile="0.95"} 0.75',
+        'bb_api_request_seconds{endpoint="/a\\"b",status="200",quantile="0.99"} 0.75',
+        'bb_api_request_seconds_sum{endpoint="/a\\"b",status="200"} 1.0',
+        'bb_api_request_seconds_count{endpoint="/a\\"b",status="200"} 2',
+    ]
+
+
+def test_summary_file_and_http_endpoint(tmp_path):
+    registry = MetricsRegistry()
+    registry.observe("stage", 1.5, stage="enrich")
+    path = tmp_path / "metrics_summary.json"
+    registry.write_summary(str(path))
+    assert json.loads(path.read_text())["series"] == registry.snapshot()
+
+    server = registry.serve(port=0)
+    try:
+        base = f"http://127.0.0.1:{server.server_address[1]}"
+        with urllib.request.urlopen(base + "/metrics") as response:
+            assert response.read().decode() == registry.prometheus_text()
+        with urllib.request.urlopen(base + "/metrics.json") as response:
+            assert json.loads(response.read()) == registry.snapshot()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(base + "/other")
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,132 @@
+import json
+
+import pytest
+
+from bb_field_catalog import FieldCatalog
+from bb_query_compiler import QueryCompiler, QueryValidationError
+
+STRUCTURE = {
+    "10": {
+        "name": "Gift",
+        "fields": [
+            {"id": 1, "name": "Date", "selected_name": "Gift Date", "value_type": "Date",
+             "allowed_filter_operators": ["Equals", "RelativeComparisons", "Blank"]},
+            {"id": 2, "name": "Amount", "selected_name": "Gift Amount", "value_type": "Currency",
+             "allowed_filter_operators": ["Equals", "RelativeComparisons"]},
+            {"id": 5, "name": "Type", "selected_name": "Gift Type", "value_type": "Lookup",
+             "allowed_filter_operators": ["Equals", "OneOf"]},
+        ],
+        "nodes": {
+            "367": {
+                "name": "Constituent",
+                "child_nodes": [],
+                "fields": [
+                    {"id": 5, "name": "Type", "selected_name": "Constituent Type", "value_type": "Lookup",
+                     "allowed_filter_operators": ["Equals"]},
+                    {"id": 7, "name": "Name", "selected_name": "Name", "value_type": "Text",
+                     "allowed_filter_operators": ["Equals", "StringComparisons"]},
+                ],
+            },
+        },
+    },
+}
+
+
+@pytest.fixture
+def compiler(tmp_path):
+    json_path = tmp_path / "structure.json"
+    json_path.write_text(json.dumps(STRUCTURE))
+    catalog = FieldCatalog(str(json_path))
+    yield QueryCompiler(catalog)
+    catalog.close()
+
+
+def query(*filters, select=({"query_field_id": 1},)):
+    return {"query_type_id": 10, "select_fields": list(select), "filter_fields": list(filters)}
+
+
+def test_valid_query_has_no_problems(compiler):
+    q = query({"query_field_id": 1, "filter_operator": "GreaterThan", "filter_values": ["2024-01-01"]},
+              {"query_field_id": 2, "operator": "Between", "values": [10, 100]},
+              {"query_field_id": 1, "filter_operator": "NotBlank"})
+    assert compiler.check(q) == []
+
+
+def test_unknown_query_type_and_field(compiler):
+    assert compiler.check({"query_type_id": 99, "select_fields": [{"id": 1}]}) == ["Unknown query_type_id 99"]
+    assert compiler.check(query(select=[{"id": 42}])) == ["select_fields[0]: field 42 is not in query type 10"]
+
+
+@pytest.mark.parametrize("operator, name", [(["Equals"], "list"), ({"op": "Equals"}, "dict"), (3, "int")])
+def test_operator_that_is_not_a_string_is_a_problem(compiler, operator, name):
+    problems = compiler.check(query({"query_field_id": 1, "filter_operator": operator, "filter_values": ["x"]}))
+    assert problems == [f"filter_fields[0]: filter operator must be a string, got {name}"]
+
+
+@pytest.mark.parametrize("values", [{"a": 1}, [["2024-01-01"]], [None], object()])
+def test_values_that_are_not_scalars_are_a_problem(compiler, values):
+    problems = compiler.check(query({"query_field_id": 1, "filter_operator": "Equals", "filter_values": values}))
+    assert len(problems) == 1 and "filter values must be" in problems[0]
+
+
+def test_value_counts(compiler):
+    between = compiler.check(query({"query_field_id": 2, "filter_operator": "Between", "filter_values": [10]}))
+    assert between == ["filter_fields[0]: Between needs exactly 2 values, got 1"]
+    empty = compiler.check(query({"query_field_id": 2, "filter_operator": "Equals", "filter_values": ""}))
+    assert empty == ["filter_fields[0]: Equals needs a value"]
+    assert compiler.check(query({"query_field_id": 2, "filter_operator": "Equals", "filter_values": 5})) == []
+
+
+def test_operator_the_field_does_not_allow(compiler):
+    problems = compiler.check(query({"query_field_id": 2, "filter_operator": "Contains", "filter_values": ["1"]}))
+    assert problems == ["filter_fields[0]: 'Gift Amount' (Currency) does not allow Contains; "
+                        "allowed: Equals, RelativeComparisons"]
+
+
+def test_field_on_several_nodes_must_allow_the_operator_on_each(compiler):
+    # Field 5 allows OneOf on the gift itself but not on the constituent node
+    problems = compiler.check(query({"query_field_id": 5, "filter_operator": "OneOf", "filter_values": ["Cash"]}))
+    assert problems == ["filter_fields[0]: 'Constituent Type' in node 367 (Lookup) does not allow OneOf; "
+                        "allowed: Equals"]
+
+
+def test_node_id_narrows_the_check_to_that_node(compiler):
+    gift = {"query_field_id": 5, "filter_operator": "OneOf", "filter_values": ["Cash"]}
+    node = dict(gift, node_id=367)
+    assert compiler.check(query(node)) == ["filter_fields[0]: 'Constituent Type' in node 367 (Lookup) does not "
+                                           "allow OneOf; allowed: Equals"]
+    assert compiler.check(query(dict(gift, filter_operator="Equals", node_id=367))) == []
+    assert compiler.check(query(dict(gift, node_id=999))) == ["filter_fields[0]: node 999 is not in query type 10"]
+    assert compiler.check(query(dict(gift, query_field_id=1, node_id=367))) == \
+        ["filter_fields[0]: field 1 is not in node 367"]
+
+
+def test_validate_raises_with_every_problem(compiler):
+    with pytest.raises(QueryValidationError) as info:
+        compiler.validate({"query_type_id": 10, "select_fields": [],
+                           "filter_fields": [{"query_field_id": 2, "filter_operator": "Nope"}]})
+    assert info.value.problems == ["'select_fields' is empty", "filter_fields[0]: unknown filter operator 'Nope'"]
+
+
+def test_compile_spec_resolves_names_and_validates(compiler):
+    request = compiler.compile_spec({
+        "query_type": "gift",
+        "select": ["Gift Date", {"name": "Name", "node": 367}],
+        "where": [["Gift Amount", "Between", 10, 100]],
+        "results_file_name": "gifts",
+    })
+    assert request == {
+        "results_file_name": "gifts",
+        "query": {
+            "query_type_id": 10,
+            "select_fields": [{"query_field_id": 1}, {"query_field_id": 7}],
+            "filter_fields": [{"query_field_id": 2, "filter_operator": "Between", "filter_values": [10, 100]}],
+        },
+    }
+
+
+def test_compile_spec_reports_unknown_names(compiler):
+    with pytest.raises(QueryValidationError) as info:
+        compiler.compile_spec({"query_type": 10, "select": ["Gift Dat"], "where": [["Gift Amount"]]})
+    assert info.value.problems[0].startswith("No field 'Gift Dat' in query type 10; did you mean Gift Date")
+    assert info.value.problems[1] == "where entry ['Gift Amount'] must be [field, operator, value...]"
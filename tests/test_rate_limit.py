@@ -0,0 +1,172 @@
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+
+requests = pytest.importorskip("requests")
+
+import bb_auth
+from bb_auth import (MAX_REQUEST_RETRIES, BlackbaudAuth, RateLimitGovernor, RequestFailedException,
+                     ResponseStatusCodes, backoff_delay, parse_retry_after)
+
+
+class Clock:
+    """Stands in for time.monotonic, time.time and time.sleep; sleeping moves the clock on."""
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bb_auth.time, "monotonic", clock)
+    monkeypatch.setattr(bb_auth.time, "time", clock)
+    monkeypatch.setattr(bb_auth.time, "sleep", clock.sleep)
+    return clock
+
+
+def response(status, headers=None, body=None):
+    result = requests.Response()
+    result.status_code = status
+    result.headers.update(headers or {})
+    result._content = json.dumps(body if body is not None else {"status": status}).encode()
+    return result
+
+
+class ScriptedSession:
+    """request() returns the scripted responses in order; the last one repeats."""
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def request(self, method, url, params=None, json=None):
+        self.calls.append(method)
+        return self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+
+
+@pytest.fixture
+def auth(clock, monkeypatch):
+    store = {"tokens.access_token": "access-1", "tokens.refresh_token": "refresh-1",
+             "tokens.expires_at": str(clock.now + 3600), "other.api_subscription_key": "api-key"}
+    monkeypatch.setattr(bb_auth.secure_keyring, "get_password", lambda key: store.get(key))
+    monkeypatch.setattr(bb_auth, "CLIENT_ID", "client")
+    monkeypatch.setattr(bb_auth, "CLIENT_SECRET", "secret")
+    auth = BlackbaudAuth()
+    yield auth
+    auth.close()
+
+
+def script(auth, *responses):
+    session = ScriptedSession(*responses)
+    auth.get_session = lambda use_payment_key=False: session
+    return session
+
+
+def test_bucket_allows_a_burst_then_paces_callers_at_the_rate(clock):
+    governor = RateLimitGovernor(rate=10, burst=5, daily_quota=None)
+    assert [governor.reserve() for _ in range(7)] == pytest.approx([0, 0, 0, 0, 0, 0.1, 0.2])
+
+    clock.now += 1  # refills to the burst size, not past it
+    assert governor.budget()["tokens_available"] == 5
+    for _ in range(7):
+        governor.acquire()
+    assert clock.sleeps == pytest.approx([0.1, 0.1])
+
+
+def test_daily_quota_is_counted_over_a_rolling_day(clock):
+    governor = RateLimitGovernor(rate=1e9, burst=1e9, daily_quota=3)
+    for _ in range(2):
+        governor.reserve()
+    assert governor.budget()["daily_remaining"] == 1
+
+    clock.now += 86400
+    governor.reserve()
+    assert governor.budget()["daily_calls"] == 1
+
+
+@pytest.mark.parametrize("value, seconds", [("120", 120), ("1.5", 1.5), ("-5", 0), ("soon", None), ("", None), (None, None)])
+def test_retry_after_in_seconds(value, seconds):
+    assert parse_retry_after(value) == seconds
+
+
+def test_retry_after_as_an_http_date():
+    later = datetime.now(timezone.utc) + timedelta(seconds=120)
+    assert parse_retry_after(format_datetime(later, usegmt=True)) == pytest.approx(120, abs=2)
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+
+
+def test_pause_after_a_429_holds_every_caller(clock):
+    governor = RateLimitGovernor(rate=10, burst=10, daily_quota=None)
+    governor.pause(2)
+
+    waits = []
+    workers = [threading.Thread(target=lambda: waits.append(governor.reserve())) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    # The saved-up burst is dropped as well, so the callers queue up behind the pause
+    assert sorted(waits) == pytest.approx([2, 2, 2])
+    assert governor.budget()["throttled_responses"] == 1
+
+    clock.now += 2
+    assert governor.reserve() == 0
+
+
+def test_backoff_is_full_jitter_up_to_the_cap(monkeypatch):
+    ranges = []
+    monkeypatch.setattr(bb_auth.random, "uniform", lambda low, high: ranges.append((low, high)) or high)
+    for attempt in range(8):
+        backoff_delay(attempt)
+    assert ranges == [(0, 1), (0, 2), (0, 4), (0, 8), (0, 16), (0, 32), (0, 60), (0, 60)]
+
+    monkeypatch.undo()
+    delays = [backoff_delay(3) for _ in range(200)]
+    assert all(0 <= delay <= 8 for delay in delays) and len(set(delays)) > 1
+
+
+def test_429_and_transient_errors_are_retried(auth, clock, monkeypatch):
+    monkeypatch.setattr(bb_auth, "backoff_delay", lambda attempt: 0.5)
+    session = script(auth, response(429, {"Retry-After": "3"}), response(503), response(200, body={"ok": True}))
+
+    assert auth.make_request("GET", "/query/jobs/1") == {"ok": True}
+    assert session.calls == ["GET"] * 3
+    # The 429 paused the shared governor; the 503 backed off in this caller only
+    assert auth.rate_limit_budget()["throttled_responses"] == 1
+    assert sum(clock.sleeps) == pytest.approx(3.5)
+
+
+def test_post_is_not_resent_after_a_server_error(auth, clock):
+    session = script(auth, response(503))
+    with pytest.raises(RequestFailedException) as failure:
+        auth.make_request("POST", "/query/jobs/1")
+    assert session.calls == ["POST"]
+    assert failure.value.status_code == 503 and not isinstance(failure.value, ResponseStatusCodes)
+
+
+def test_persistent_429_raises_after_the_last_retry(auth, clock):
+    session = script(auth, response(429, {"Retry-After": "7"}))
+    with pytest.raises(ResponseStatusCodes) as failure:
+        auth.make_request("GET", "/query/jobs/1")
+
+    assert len(session.calls) == MAX_REQUEST_RETRIES + 1
+    assert failure.value.status_code == 429 and failure.value.retry_after == 7
+    assert auth.rate_limit_budget()["throttled_responses"] == MAX_REQUEST_RETRIES
+
+
+def test_persistent_server_error_raises_after_the_last_retry(auth, clock):
+    session = script(auth, response(502))
+    with pytest.raises(ResponseStatusCodes) as failure:
+        auth.make_request("GET", "/query/jobs/1")
+    assert len(session.calls) == MAX_REQUEST_RETRIES + 1
+    assert failure.value.status_code == 502
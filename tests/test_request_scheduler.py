@@ -0,0 +1,134 @@
+import json
+import os
+
+import pytest
+
+import bb_metrics
+import bb_request_scheduler
+from bb_request_scheduler import RequestScheduler
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bb_request_scheduler.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def request_file(tmp_path):
+    def write(name, **fields):
+        path = str(tmp_path / name)
+        with open(path, "w") as f:
+            json.dump(fields, f)
+        return path
+    return write
+
+
+def drain(scheduler):
+    started = []
+    while True:
+        path = scheduler.next_ready()
+        if path is None:
+            return started
+        started.append(os.path.basename(path))
+
+
+def test_higher_priority_runs_first_and_ties_keep_arrival_order(clock, request_file):
+    scheduler = RequestScheduler(default_group_limit=None)
+    for name, priority in [("a.json", 0), ("b.json", 5), ("c.json", 0), ("d.json", 5)]:
+        scheduler.add(request_file(name, priority=priority))
+    assert drain(scheduler) == ["b.json", "d.json", "a.json", "c.json"]
+
+
+def test_file_priorities_apply_when_the_request_sets_none(clock, request_file):
+    scheduler = RequestScheduler(default_group_limit=None)
+    scheduler.add(request_file("report.json"))
+    scheduler.add(request_file("d1_file_import_id.json"))
+    assert drain(scheduler) == ["d1_file_import_id.json", "report.json"]
+
+
+def test_waiting_requests_age_past_newer_higher_priority_ones(clock, request_file):
+    scheduler = RequestScheduler(default_group_limit=None, age_promotion_seconds=60)
+    scheduler.add(request_file("old.json", priority=0))
+    clock.now += 60 * 3  # +3 from waiting
+    scheduler.add(request_file("new.json", priority=2))
+    assert drain(scheduler) == ["old.json", "new.json"]
+
+
+def test_group_limit_holds_requests_until_one_of_the_group_finishes(clock, request_file):
+    scheduler = RequestScheduler(group_limits={("RE", "Gift"): 1}, default_group_limit=2)
+    gifts = [request_file(f"gift{i}.json", product="RE", module="Gift", priority=10) for i in range(2)]
+    others = [request_file(f"other{i}.json", product="RE", module="Constituent") for i in range(3)]
+    for path in gifts + others:
+        scheduler.add(path)
+
+    assert drain(scheduler) == ["gift0.json", "other0.json", "other1.json"]
+    assert scheduler.next_ready() is None
+
+    scheduler.finish(gifts[0])
+    assert drain(scheduler) == ["gift1.json"]
+    scheduler.finish(others[0])
+    assert drain(scheduler) == ["other2.json"]
+
+
+def test_files_removed_while_queued_are_dropped(clock, request_file):
+    scheduler = RequestScheduler()
+    path = request_file("a.json")
+    scheduler.add(path)
+    os.remove(path)
+    assert scheduler.next_ready() is None
+    assert len(scheduler) == 0
+
+
+def test_adding_a_queued_file_again_does_not_duplicate_it(clock, request_file):
+    scheduler = RequestScheduler()
+    path = request_file("a.json")
+    assert scheduler.add(path)
+    assert scheduler.add(path)
+    assert len(scheduler) == 1
+
+
+def test_file_dropped_again_while_running_is_queued_after_it_finishes(clock, request_file):
+    scheduler = RequestScheduler()
+    path = request_file("d1_file_import_id.json")
+    scheduler.add(path)
+    assert scheduler.next_ready() == path
+
+    # The worker has moved the request out and the next one arrives under the same name
+    assert scheduler.add(path) is False
+    assert scheduler.next_ready() is None
+
+    scheduler.finish(path)
+    assert scheduler.next_ready() == path
+
+
+def test_rerun_is_skipped_if_the_new_file_is_gone_by_then(clock, request_file):
+    scheduler = RequestScheduler()
+    path = request_file("a.json")
+    scheduler.add(path)
+    scheduler.next_ready()
+    scheduler.add(path)
+    os.remove(path)
+    scheduler.finish(path)
+    assert scheduler.next_ready() is None
+
+
+def test_queue_wait_is_labelled_by_query(clock, request_file, monkeypatch):
+    registry = bb_metrics.MetricsRegistry()
+    monkeypatch.setattr(bb_request_scheduler, "observe", registry.observe)
+    scheduler = RequestScheduler()
+    scheduler.add(request_file("saved.json", id=42))
+    scheduler.add(request_file("generated_query.json", query={"query_type_id": 15}))
+    clock.now += 30
+    drain(scheduler)
+
+    assert sorted((s["labels"]["query"], s["sum"]) for s in registry.snapshot()) == [("42", 30.0), ("adhoc:15", 30.0)]
@@ -0,0 +1,202 @@
+import errno
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import bb_result_cache
+from bb_result_cache import RequestCoalescer, ResultCache, request_key
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bb_result_cache.time, "time", clock)
+    return clock
+
+
+def result(tmp_path, name, size):
+    path = tmp_path / name
+    path.write_bytes(b"x" * size)
+    return str(path)
+
+
+def test_request_key_ignores_order_and_output_naming():
+    a = request_key("/query/execute", {"a": 1}, {
+        "id": 5, "results_file_name": "one", "ask_fields": [{"id": 1}, {"id": 2}]})
+    b = request_key("/query/execute", {"a": 1}, {
+        "ask_fields": [{"id": 2}, {"id": 1}], "ux_mode": "Asynchronous", "id": 5, "results_file_name": "two"})
+    assert a == b
+    assert a != request_key("/query/execute", {"a": 1}, {"id": 6})
+    assert a != request_key("/query/execute", {"a": 2}, {"id": 5})
+
+
+def test_put_links_the_result_and_get_serves_it_within_max_staleness(tmp_path, clock):
+    cache = ResultCache(str(tmp_path / "cache"))
+    src = result(tmp_path, "gifts.csv", 10)
+    path = cache.put("k1", src, job_id="job1")
+
+    assert os.path.samefile(path, src)
+    clock.now += 600
+    cached = cache.get("k1", max_staleness_seconds=900)
+    assert cached == {"path": path, "job_id": "job1", "age_seconds": 600}
+    assert cache.get("k1", max_staleness_seconds=300) is None
+    assert cache.get("other", max_staleness_seconds=900) is None
+
+
+def test_result_older_than_the_ttl_is_never_served(tmp_path, clock):
+    cache = ResultCache(str(tmp_path / "cache"), ttl_seconds=3600)
+    cache.put("k1", result(tmp_path, "gifts.csv", 10))
+    clock.now += 3601
+    assert cache.get("k1", max_staleness_seconds=10 * 3600) is None
+
+
+def test_purge_removes_expired_results(tmp_path, clock):
+    cache = ResultCache(str(tmp_path / "cache"), ttl_seconds=3600)
+    old = cache.put("old", result(tmp_path, "old.csv", 10))
+    clock.now += 1800
+    new = cache.put("new", result(tmp_path, "new.csv", 10))
+    clock.now += 1801
+    cache.purge_expired()
+
+    assert not os.path.exists(old)
+    assert os.path.exists(new)
+    assert cache.get("new", max_staleness_seconds=3600) is not None
+
+
+def test_least_recently_used_results_are_evicted_beyond_max_bytes(tmp_path, clock):
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=250)
+    paths = {}
+    for key in ("a", "b"):
+        paths[key] = cache.put(key, result(tmp_path, f"{key}.csv", 100))
+        clock.now += 1
+    cache.get("a", max_staleness_seconds=60)  # b is now the least recently used
+    clock.now += 1
+    paths["c"] = cache.put("c", result(tmp_path, "c.csv", 100))
+
+    assert not os.path.exists(paths["b"])
+    assert cache.get("b", max_staleness_seconds=60) is None
+    assert cache.get("a", max_staleness_seconds=60) is not None
+    assert cache.get("c", max_staleness_seconds=60) is not None
+
+
+def test_put_replaces_an_older_result_for_the_same_key(tmp_path, clock):
+    cache = ResultCache(str(tmp_path / "cache"))
+    cache.put("k1", result(tmp_path, "first.csv", 10), job_id="job1")
+    clock.now += 5
+    path = cache.put("k1", result(tmp_path, "second.csv", 20), job_id="job2")
+
+    cached = cache.get("k1", max_staleness_seconds=60)
+    assert cached["job_id"] == "job2" and cached["age_seconds"] == 0
+    assert os.path.getsize(path) == 20
+
+
+def test_result_that_cannot_be_linked_is_not_copied(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "cache"))
+
+    def cross_device(src, dest):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setattr(bb_result_cache.os, "link", cross_device)
+    with pytest.raises(OSError):
+        cache.put("k1", result(tmp_path, "gifts.csv", 10))
+    assert cache.get("k1", max_staleness_seconds=60) is None
+    assert [f for f in os.listdir(cache.folder) if f != "index.sqlite"] == []
+
+
+def test_result_removed_from_disk_is_dropped_from_the_index(tmp_path, clock):
+    cache = ResultCache(str(tmp_path / "cache"))
+    os.remove(cache.put("k1", result(tmp_path, "gifts.csv", 10)))
+    assert cache.get("k1", max_staleness_seconds=60) is None
+
+
+class SlowQuery:
+    """run_query stand-in that blocks until released, so other requests can join it."""
+    def __init__(self, path=None, error=None):
+        self.path = path
+        self.error = error
+        self.calls = 0
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        assert self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return self.path, "job1"
+
+
+def run_together(coalescer, query, names, key="k1"):
+    """First name runs the query; the rest join it once it has started. Returns futures in order."""
+    pool = ThreadPoolExecutor(len(names))
+    futures = [pool.submit(coalescer.run, key, names[0], query)]
+    deadline = time.monotonic() + 5
+    while not query.calls:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    futures += [pool.submit(coalescer.run, key, name, query) for name in names[1:]]
+    while len(coalescer._running[key].copies) < len(names) - 1:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    query.release.set()
+    pool.shutdown(wait=True)
+    return futures
+
+
+def test_identical_requests_share_one_run_and_each_gets_its_own_file(tmp_path):
+    query = SlowQuery(result(tmp_path, "first.csv", 10))
+    names = [str(tmp_path / n) for n in ("first.csv", "second.csv", "third.csv")]
+    futures = run_together(RequestCoalescer(), query, names)
+
+    assert query.calls == 1
+    assert futures[0].result() == (names[0], "job1", False)
+    for name, future in zip(names[1:], futures[1:]):
+        assert future.result() == (name, "job1", True)
+        assert os.path.samefile(name, names[0])
+
+
+def test_failed_run_fails_every_waiting_request(tmp_path):
+    query = SlowQuery(error=RuntimeError("job failed"))
+    futures = run_together(RequestCoalescer(), query, [str(tmp_path / n) for n in ("a.csv", "b.csv", "c.csv")])
+
+    assert query.calls == 1
+    for future in futures:
+        with pytest.raises(RuntimeError, match="job failed"):
+            future.result()
+    assert os.listdir(tmp_path) == []
+
+
+def test_a_copy_that_cannot_be_made_fails_only_its_request(tmp_path):
+    query = SlowQuery(result(tmp_path, "first.csv", 10))
+    names = [str(tmp_path / "first.csv"), str(tmp_path / "missing" / "second.csv"), str(tmp_path / "third.csv")]
+    futures = run_together(RequestCoalescer(), query, names)
+
+    assert futures[0].result()[0] == names[0]
+    with pytest.raises(OSError):
+        futures[1].result()
+    assert futures[2].result() == (names[2], "job1", True)
+
+
+def test_a_request_after_the_run_finished_runs_again(tmp_path):
+    coalescer = RequestCoalescer()
+    for _ in range(2):
+        query = SlowQuery(result(tmp_path, "first.csv", 10))
+        query.release.set()
+        assert coalescer.run("k1", str(tmp_path / "first.csv"), query) == (str(tmp_path / "first.csv"), "job1", False)
+        assert query.calls == 1
+
+    failing = SlowQuery(error=ValueError("bad request"))
+    failing.release.set()
+    with pytest.raises(ValueError):
+        coalescer.run("k1", "x.csv", failing)
+    assert coalescer._running == {}
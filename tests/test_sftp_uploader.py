@@ -0,0 +1,296 @@
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import socket
+import threading
+
+import pytest
+
+paramiko = pytest.importorskip("paramiko")
+
+import bb_sftp_uploader
+from bb_sftp_uploader import CompressedCsv, CsvRowCounter, SftpConnectionPool, SftpUploader
+
+
+class SftpServer:
+    """Password-accepting SFTP server on localhost, serving the files under root."""
+    key = None
+
+    def __init__(self, root):
+        if SftpServer.key is None:
+            SftpServer.key = paramiko.RSAKey.generate(2048)
+        self.root = root
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(10)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        server = self
+        root = self.root
+
+        class Handle(paramiko.SFTPHandle):
+            def stat(self):
+                return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+        class Sftp(paramiko.SFTPServerInterface):
+            def _path(self, path):
+                return os.path.join(root, path.lstrip("/"))
+
+            def open(self, path, flags, attr):
+                fd = os.open(self._path(path), flags, 0o644)
+                mode = "rb"
+                if flags & (os.O_WRONLY | os.O_RDWR):
+                    mode = "wb" if flags & os.O_TRUNC else "r+b"
+                handle = Handle(flags)
+                handle.readfile = handle.writefile = os.fdopen(fd, mode)
+                return handle
+
+            def stat(self, path):
+                try:
+                    return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+
+            lstat = stat
+
+            def remove(self, path):
+                try:
+                    os.remove(self._path(path))
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+                return paramiko.SFTP_OK
+
+            def rename(self, old, new):
+                if os.path.exists(self._path(new)):
+                    return paramiko.SFTP_FAILURE
+                os.rename(self._path(old), self._path(new))
+                return paramiko.SFTP_OK
+
+            def posix_rename(self, old, new):
+                os.replace(self._path(old), self._path(new))
+                return paramiko.SFTP_OK
+
+        class Auth(paramiko.ServerInterface):
+            def check_auth_password(self, username, password):
+                return paramiko.AUTH_SUCCESSFUL
+
+            def get_allowed_auths(self, username):
+                return "password"
+
+            def check_channel_request(self, kind, chanid):
+                return paramiko.OPEN_SUCCEEDED
+
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(SftpServer.key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, Sftp)
+            transport.start_server(server=Auth())
+            server.transports.append(transport)
+
+    def close(self):
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
+
+
+@pytest.fixture
+def remote(tmp_path):
+    root = tmp_path / "remote"
+    root.mkdir()
+    server = SftpServer(str(root))
+    server.path = root
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def uploader(remote, monkeypatch):
+    monkeypatch.setattr(bb_sftp_uploader.time, "sleep", lambda seconds: None)
+    pool = SftpConnectionPool("127.0.0.1", "user", "secret", port=remote.port, size=2)
+    uploader = SftpUploader(pool, workers=2)
+    yield uploader
+    uploader.close()
+
+
+@pytest.fixture
+def export(tmp_path):
+    path = tmp_path / "feed.csv"
+    path.write_bytes(os.urandom(3 * bb_sftp_uploader.SFTP_WRITE_BLOCK + 123))
+    return path
+
+
+def test_upload_renames_the_verified_file_into_place(uploader, remote, export):
+    result = uploader.upload(str(export), "feed.csv")
+
+    assert (remote.path / "feed.csv").read_bytes() == export.read_bytes()
+    assert os.listdir(remote.path) == ["feed.csv"]
+    assert result["bytes"] == result["sent"] == export.stat().st_size
+    assert result["resumed_from"] == 0 and result["verified"] == "size"
+
+
+def test_upload_resumes_from_a_partial_file_and_checks_its_hash(uploader, remote, export):
+    data = export.read_bytes()
+    (remote.path / "feed.csv.part").write_bytes(data[:1_000_000])
+    result = uploader.upload(str(export))
+
+    assert (remote.path / "feed.csv").read_bytes() == data
+    assert result["resumed_from"] == 1_000_000
+    assert result["sent"] == len(data) - 1_000_000
+    assert result["verified"] == "sha256"
+
+
+def test_corrupt_partial_file_is_discarded_and_uploaded_again(uploader, remote, export):
+    (remote.path / "feed.csv.part").write_bytes(b"\0" * 1_000_000)
+    result = uploader.upload(str(export))
+
+    assert (remote.path / "feed.csv").read_bytes() == export.read_bytes()
+    assert result["resumed_from"] == 0
+    assert os.listdir(remote.path) == ["feed.csv"]
+
+
+def test_partial_file_larger_than_the_source_is_replaced(uploader, remote, export):
+    (remote.path / "feed.csv.part").write_bytes(b"x" * (export.stat().st_size + 10))
+    result = uploader.upload(str(export))
+    assert result["resumed_from"] == 0
+    assert (remote.path / "feed.csv").read_bytes() == export.read_bytes()
+
+
+def test_interrupted_transfer_resumes_on_a_new_connection(uploader, remote, export, monkeypatch):
+    blocks = SftpUploader._blocks
+    interrupted = []
+
+    def dropping_connection(local_path, source, offset):
+        for i, block in enumerate(blocks(local_path, source, offset)):
+            if i == 2 and not interrupted:
+                interrupted.append(offset)
+                raise EOFError("connection lost")
+            yield block
+
+    monkeypatch.setattr(SftpUploader, "_blocks", staticmethod(dropping_connection))
+    result = uploader.upload(str(export))
+
+    assert interrupted == [0]
+    assert result["resumed_from"] == 2 * bb_sftp_uploader.SFTP_WRITE_BLOCK
+    assert result["verified"] == "sha256"
+    assert (remote.path / "feed.csv").read_bytes() == export.read_bytes()
+
+
+def test_upload_replaces_an_existing_remote_file(uploader, remote, export):
+    (remote.path / "feed.csv").write_bytes(b"yesterday")
+    uploader.upload(str(export))
+    assert (remote.path / "feed.csv").read_bytes() == export.read_bytes()
+
+
+def test_uploads_run_concurrently_over_the_pool(uploader, remote, tmp_path):
+    paths = []
+    for i in range(4):
+        path = tmp_path / f"feed{i}.csv"
+        path.write_bytes(os.urandom(200_000))
+        paths.append(path)
+    futures = [uploader.submit(str(p)) for p in paths]
+
+    assert [f.result(timeout=30)["bytes"] for f in futures] == [200_000] * 4
+    assert sorted(os.listdir(remote.path)) == [p.name for p in paths]
+
+
+@pytest.mark.parametrize("text", [
+    "a,b\n1,2\n3,4\n",
+    "a,b\n1,2\n3,4",
+    'a,b\n"multi\nline",2\n"say ""hi""\n",4\n',
+    'a\n""\n"x""\n"""\n',
+    "a,b\n",
+    "",
+])
+def test_row_counter_matches_the_csv_module_fed_in_any_split(text):
+    expected = max(0, len(list(csv.reader(io.StringIO(text)))) - 1)
+    data = text.encode()
+    for size in (1, 2, 3, 7, len(data) or 1):
+        counter = CsvRowCounter()
+        for start in range(0, len(data), size):
+            counter.feed(data[start:start + size])
+        assert counter.data_rows == expected, (text, size)
+
+
+@pytest.fixture
+def csv_export(tmp_path):
+    path = tmp_path / "feed.csv"
+    rows = ["ImportID,Name,Notes"] + [f'{i},Name {i},"line one\nline {i % 7}"' for i in range(60_000)]
+    path.write_text("\n".join(rows) + "\n")
+    return path
+
+
+def test_compressed_stream_is_deterministic_and_tallied(csv_export):
+    source = CompressedCsv(str(csv_export), "gzip")
+    first = b"".join(source.blocks())
+    assert b"".join(CompressedCsv(str(csv_export), "gzip").blocks()) == first
+
+    data = csv_export.read_bytes()
+    assert gzip.decompress(first) == data
+    assert source.rows == 60_000
+    assert (source.source_bytes, source.source_sha256) == (len(data), hashlib.sha256(data).hexdigest())
+    assert (source.bytes, source.sha256) == (len(first), hashlib.sha256(first).hexdigest())
+
+
+def test_unknown_or_unavailable_compression_is_rejected(csv_export, monkeypatch):
+    with pytest.raises(ValueError, match="Unknown compression"):
+        CompressedCsv(str(csv_export), "bzip2")
+    monkeypatch.setattr(bb_sftp_uploader, "zstandard", None)
+    with pytest.raises(ValueError, match="zstandard"):
+        CompressedCsv(str(csv_export), "zstd")
+
+
+def upload_compressed(uploader, remote, path, compression):
+    result = uploader.upload(str(path), compression=compression)
+    manifest = json.loads((remote.path / (result["remote_path"] + ".manifest.json")).read_text())
+    return result, manifest, (remote.path / result["remote_path"]).read_bytes()
+
+
+def test_gzip_upload_with_manifest(uploader, remote, csv_export):
+    result, manifest, uploaded = upload_compressed(uploader, remote, csv_export, "gzip")
+
+    data = csv_export.read_bytes()
+    assert result["remote_path"] == "feed.csv.gz"
+    assert gzip.decompress(uploaded) == data
+    assert sorted(os.listdir(remote.path)) == ["feed.csv.gz", "feed.csv.gz.manifest.json"]
+    assert result["rows"] == manifest["rows"] == 60_000
+    assert manifest["file"] == "feed.csv.gz" and manifest["source_file"] == "feed.csv"
+    assert manifest["source_sha256"] == hashlib.sha256(data).hexdigest()
+    assert manifest["sha256"] == hashlib.sha256(uploaded).hexdigest()
+    assert manifest["bytes"] == len(uploaded) < len(data)
+
+
+def test_zstd_upload(uploader, remote, csv_export):
+    zstandard = pytest.importorskip("zstandard")
+    result, manifest, uploaded = upload_compressed(uploader, remote, csv_export, "zstd")
+
+    assert result["remote_path"] == "feed.csv.zst"
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(uploaded) == csv_export.read_bytes()
+    assert manifest["compression"] == "zstd" and manifest["rows"] == 60_000
+
+
+def test_compressed_upload_resumes_by_skipping_what_was_sent(uploader, remote, csv_export):
+    compressed = b"".join(CompressedCsv(str(csv_export), "gzip").blocks())
+    (remote.path / "feed.csv.gz.part").write_bytes(compressed[:len(compressed) // 2])
+    result, manifest, uploaded = upload_compressed(uploader, remote, csv_export, "gzip")
+
+    assert uploaded == compressed
+    assert result["resumed_from"] == len(compressed) // 2
+    assert result["verified"] == "sha256"
+    assert manifest["sha256"] == hashlib.sha256(compressed).hexdigest()
+
+
+def test_compressed_upload_restarts_over_a_stale_partial_file(uploader, remote, csv_export):
+    (remote.path / "feed.csv.gz.part").write_bytes(b"\0" * 10_000_000)
+    result, _, uploaded = upload_compressed(uploader, remote, csv_export, "gzip")
+    assert result["resumed_from"] == 0
+    assert gzip.decompress(uploaded) == csv_export.read_bytes()